@@ -0,0 +1,178 @@
+import os
+
+from fastapi import APIRouter, Depends, Header, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from .schemas import CreateCollection, CreateDocument, CreateIndex
+from .async_service import AsyncCollectionService
+from .dependencies import get_async_service, get_snapshot_directory
+from .routes import (JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE, parse_documents, parse_fields, parse_filter,
+                     parse_list, raw_documents_response, snapshot_path, snapshot_response)
+
+# Endpoints of the "async" SERVICE_MODE, the same as in routes, but as coroutines on AsyncCollectionService
+router = APIRouter()
+
+
+@router.post("/collections", status_code=201)
+async def create_collection(collection: CreateCollection,
+                            service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.create_collection(collection.name, collection.format, collection.shards)
+    return {"message": "Collection created successfully"}
+
+
+@router.get("/collections", status_code=200)
+async def get_collections(service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    return {"collections": await service.get_collections()}
+
+
+@router.get("/collections/{collection_name}", status_code=200)
+async def get_collection(collection_name: str, service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    return await service.get_collection(collection_name)
+
+
+@router.delete("/collections/{collection_name}", status_code=200)
+async def delete_collection(collection_name: str,
+                            service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.delete_collection(collection_name)
+    return {"message": "Collection deleted successfully"}
+
+
+@router.put("/collections/{collection_name}", status_code=200)
+async def update_collection(collection_name: str, new_collection: CreateCollection,
+                            service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.update_collection(collection_name, new_collection.dict(exclude_unset=True))
+    return {"message": "Collection updated successfully"}
+
+
+@router.post("/collections/{collection_name}/documents", status_code=201)
+async def create_document(collection_name: str, document: CreateDocument,
+                          service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    document_id = await service.add_document(collection_name, document.dict())
+    return {"message": "Document created successfully", "_document_id": document_id}
+
+
+@router.post("/collections/{collection_name}/documents/bulk", status_code=201)
+async def create_documents(collection_name: str, request: Request,
+                           content_type: str | None = Header(default=None),
+                           service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    document_ids = await service.add_documents(collection_name, parse_documents(await request.body(), content_type))
+    return {"message": "Documents created successfully", "_document_ids": document_ids}
+
+
+@router.get("/collections/{collection_name}/documents/{document_id}", status_code=200)
+async def get_document(collection_name: str, document_id: str, fields: str | None = None,
+                       service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    return Response(await service.get_document_raw(collection_name, document_id, parse_fields(fields)),
+                    media_type=JSON_MEDIA_TYPE)
+
+
+async def ndjson_lines(documents):
+    async for document in documents:
+        yield document + b"\n"
+
+
+@router.get("/collections/{collection_name}/documents", status_code=200)
+async def get_documents(collection_name: str,
+                        field=None, value=None, filter_expression: str | None = Query(default=None, alias="filter"),
+                        fields: str | None = None, stream: bool = False,
+                        limit: int | None = Query(default=None, gt=0), cursor: str | None = None,
+                        accept: str | None = Header(default=None),
+                        service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    """See routes.get_documents."""
+    expression = parse_filter(filter_expression, field)
+    keys = parse_fields(fields)
+    if limit is not None or cursor is not None:
+        if expression is not None:
+            return await service.find_documents_by_filter_page(collection_name, expression, limit, cursor, keys)
+        if field and value:
+            return await service.find_documents_by_field_page(collection_name, field, value, limit, cursor, keys)
+        return await service.get_documents_page(collection_name, limit, cursor, keys)
+    if expression is not None:
+        documents = await service.iter_documents_by_filter_raw(collection_name, expression, keys)
+    elif field and value:
+        documents = await service.iter_documents_by_field_raw(collection_name, field, value, keys)
+    else:
+        documents = await service.iter_documents_raw(collection_name, keys)
+    if stream or (accept and NDJSON_MEDIA_TYPE in accept):
+        return StreamingResponse(ndjson_lines(documents), media_type=NDJSON_MEDIA_TYPE)
+    return raw_documents_response([document async for document in documents])
+
+
+@router.get("/collections/{collection_name}/aggregate", status_code=200)
+async def aggregate(collection_name: str, group_by: str | None = None, aggregates: str = "count",
+                    filter_expression: str | None = Query(default=None, alias="filter"),
+                    service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    """See routes.aggregate."""
+    return await service.aggregate(collection_name, parse_list(group_by, "Group by"),
+                                   parse_list(aggregates, "Aggregates"), parse_filter(filter_expression, None))
+
+
+@router.delete("/collections/{collection_name}/documents/{document_id}", status_code=200)
+async def delete_document(collection_name: str, document_id: str,
+                          service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.delete_document(collection_name, document_id)
+    return {"message": "Document deleted successfully"}
+
+
+@router.put("/collections/{collection_name}/documents/{document_id}", status_code=200)
+async def update_document(collection_name: str, document_id: str, new_document: CreateDocument,
+                          service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.update_document(collection_name, document_id, new_document.dict())
+    return {"message": "Document updated successfully"}
+
+
+@router.post("/collections/{collection_name}/indexes", status_code=201)
+async def create_index(collection_name: str, index: CreateIndex,
+                       service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.create_index(collection_name, index.field)
+    return {"message": "Index created successfully"}
+
+
+@router.get("/collections/{collection_name}/indexes", status_code=200)
+async def get_indexes(collection_name: str, service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    return {"indexes": await service.get_indexes(collection_name)}
+
+
+@router.delete("/collections/{collection_name}/indexes/{field}", status_code=200)
+async def delete_index(collection_name: str, field: str,
+                       service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.delete_index(collection_name, field)
+    return {"message": "Index deleted successfully"}
+
+
+@router.get("/cache", status_code=200)
+async def get_cache_stats(service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    return await service.get_cache_stats()
+
+
+@router.delete("/collections", status_code=200)
+async def clean_up(service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    await service.clean_up()
+    return {"message": "All collections deleted successfully"}
+
+
+@router.get("/replication/log", status_code=200)
+async def get_log_entries(after: int = Query(ge=0), limit: int = Query(default=1000, gt=0),
+                          wait_ms: int = Query(default=0, ge=0, le=60000),
+                          service: AsyncCollectionService = Depends(get_async_service)) -> dict:
+    """See routes.get_log_entries."""
+    return {"entries": await service.get_log_entries(after, limit, wait_ms / 1000)}
+
+
+@router.get("/replication/snapshot", status_code=200)
+async def get_snapshot(service: AsyncCollectionService = Depends(get_async_service)):
+    """See routes.get_snapshot."""
+    path = snapshot_path()
+    try:
+        with open(path, "wb") as file:
+            lsn = await service.write_snapshot(file)
+    except BaseException:
+        os.remove(path)
+        raise
+    return snapshot_response(path, lsn)
+
+
+@router.post("/admin/snapshot", status_code=201)
+async def create_snapshot(service: AsyncCollectionService = Depends(get_async_service),
+                          directory: str = Depends(get_snapshot_directory)) -> dict:
+    """See routes.create_snapshot."""
+    return await service.save_snapshot(directory)
@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from .service import CollectionService
+from .storage import DEFAULT_FORMAT
+
+
+class AsyncCollectionService:
+    """Asynchronous variant of CollectionService, used by the endpoints of the "async" SERVICE_MODE.
+
+    Every call runs the blocking CollectionService method in a dedicated I/O executor, so the event loop never waits
+    for the disk and a request that waits for the executor doesn't hold a thread. io_threads bounds the number of file
+    operations running at the same time, independently of the number of open connections.
+    """
+
+    def __init__(self, service: CollectionService, io_threads: int = 32, stream_chunk_size: int = 100):
+        self.service = service
+        self._executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="collection-io")
+        # number of documents a streaming iteration reads per executor call
+        self.stream_chunk_size = stream_chunk_size
+
+    async def _run(self, func, *args, **kwargs):
+        # in a copy of the context, like asyncio.to_thread, so the call is traced with the request, see metrics
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+    async def _iterate(self, generator):
+        """async generator over a blocking generator, which reads it in chunks in the executor"""
+        while True:
+            chunk = await self._run(lambda: list(itertools.islice(generator, self.stream_chunk_size)))
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+
+    def shutdown(self, wait: bool = False):
+        """stops the executor, wait waits for the calls that are still running"""
+        self._executor.shutdown(wait=wait)
+
+    async def create_collection(self, collection_name: str, collection_format: str = DEFAULT_FORMAT,
+                                shards: int = 1) -> None:
+        return await self._run(self.service.create_collection, collection_name, collection_format, shards)
+
+    async def get_collection(self, collection_name: str):
+        # the catalog is in memory, there is no I/O to offload
+        return self.service.get_collection(collection_name)
+
+    async def get_collections(self):
+        # takes the catalog lock, which is held while collections.json is written
+        return await self._run(self.service.get_collections)
+
+    async def delete_collection(self, collection_name: str):
+        return await self._run(self.service.delete_collection, collection_name)
+
+    async def update_collection(self, collection_name: str, new_collection: dict):
+        return await self._run(self.service.update_collection, collection_name, new_collection)
+
+    async def add_document(self, collection_name: str, document: dict) -> str:
+        return await self._run(self.service.add_document, collection_name, document)
+
+    async def add_documents(self, collection_name: str, documents: list) -> list:
+        return await self._run(self.service.add_documents, collection_name, documents)
+
+    async def get_document(self, collection_name: str, document_id: str, fields: list = None):
+        return await self._run(self.service.get_document, collection_name, document_id, fields)
+
+    async def get_document_raw(self, collection_name: str, document_id: str, fields: list = None) -> bytes:
+        return await self._run(self.service.get_document_raw, collection_name, document_id, fields)
+
+    async def get_cache_stats(self) -> dict:
+        # the cache is in memory, there is no I/O to offload
+        return self.service.get_cache_stats()
+
+    async def get_documents(self, collection_name: str, fields: list = None):
+        return await self._run(self.service.get_documents, collection_name, fields)
+
+    async def iter_documents(self, collection_name: str, fields: list = None):
+        """Returns an async generator of the documents, the collection is checked right away."""
+        return self._iterate(await self._run(self.service.iter_documents, collection_name, fields))
+
+    async def iter_documents_raw(self, collection_name: str, fields: list = None):
+        return self._iterate(await self._run(self.service.iter_documents_raw, collection_name, fields))
+
+    async def delete_document(self, collection_name: str, document_id: str):
+        return await self._run(self.service.delete_document, collection_name, document_id)
+
+    async def update_document(self, collection_name: str, document_id: str, new_document: dict):
+        return await self._run(self.service.update_document, collection_name, document_id, new_document)
+
+    async def clean_up(self):
+        return await self._run(self.service.clean_up)
+
+    async def create_index(self, collection_name: str, field: str):
+        return await self._run(self.service.create_index, collection_name, field)
+
+    async def get_indexes(self, collection_name: str) -> list:
+        return await self._run(self.service.get_indexes, collection_name)
+
+    async def delete_index(self, collection_name: str, field: str):
+        return await self._run(self.service.delete_index, collection_name, field)
+
+    async def find_documents_by_field(self, collection_name: str, field: str, value, fields: list = None):
+        return await self._run(self.service.find_documents_by_field, collection_name, field, value, fields)
+
+    async def iter_documents_by_field(self, collection_name: str, field: str, value, fields: list = None):
+        return self._iterate(await self._run(self.service.iter_documents_by_field, collection_name, field, value,
+                                             fields))
+
+    async def iter_documents_by_field_raw(self, collection_name: str, field: str, value, fields: list = None):
+        return self._iterate(await self._run(self.service.iter_documents_by_field_raw, collection_name, field, value,
+                                             fields))
+
+    async def iter_documents_by_filter_raw(self, collection_name: str, expression: dict, fields: list = None):
+        return self._iterate(await self._run(self.service.iter_documents_by_filter_raw, collection_name, expression,
+                                             fields))
+
+    async def find_documents_by_filter_page(self, collection_name: str, expression: dict, limit: int = None,
+                                            cursor: str = None, fields: list = None) -> dict:
+        return await self._run(self.service.find_documents_by_filter_page, collection_name, expression, limit, cursor,
+                               fields)
+
+    async def get_documents_page(self, collection_name: str, limit: int = None, cursor: str = None,
+                                 fields: list = None) -> dict:
+        return await self._run(self.service.get_documents_page, collection_name, limit, cursor, fields)
+
+    async def find_documents_by_field_page(self, collection_name: str, field: str, value, limit: int = None,
+                                           cursor: str = None, fields: list = None) -> dict:
+        return await self._run(self.service.find_documents_by_field_page, collection_name, field, value, limit,
+                               cursor, fields)
+
+    async def aggregate(self, collection_name: str, group_by: list = None, aggregates: list = None,
+                        expression: dict = None) -> dict:
+        return await self._run(self.service.aggregate, collection_name, group_by, aggregates, expression)
+
+    async def get_log_entries(self, after: int, limit: int = 1000, wait: float = 0) -> list:
+        return await self._run(self.service.get_log_entries, after, limit, wait)
+
+    async def write_snapshot(self, fileobj) -> int:
+        return await self._run(self.service.write_snapshot, fileobj)
+
+    async def save_snapshot(self, directory: str) -> dict:
+        return await self._run(self.service.save_snapshot, directory)
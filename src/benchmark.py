@@ -0,0 +1,222 @@
+"""Benchmarks of CollectionService and of the HTTP API, reported as JSON so that runs can be compared over time.
+
+    python -m src.benchmark [--layer service http] [--sizes 1000 100000 1000000] [--concurrency 1 16 64]
+                            [--operations 1000] [--scan-operations 20] [--index] [--output results.json]
+
+The "service" layer calls the methods of CollectionService directly, the "http" layer sends the requests to the
+FastAPI app with an in-process client, without a server or a network. Every combination of layer, collection size
+and concurrency is a run: a collection of that many documents is loaded into a new temporary BASE_DIRECTORY, then
+every operation (add_document, get_document, find_documents_by_field and delete_document) is measured with that
+many concurrent callers. The service is configured like the server, from the environment (see Config).
+
+Every run has its own process, so peak_rss_bytes is the peak resident memory of that run, without the scan
+processes. The documents and the ids that are read are chosen with a fixed seed, so the runs are reproducible.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+LAYERS = ["service", "http"]
+COLLECTION = "benchmark"
+LOAD_BATCH_SIZE = 10000
+SEED = 42
+# documents with the same group, searched by find_documents_by_field
+GROUP_SIZE = 1000
+
+
+def make_document(number: int) -> dict:
+    return {"data": {"name": f"molecule {number}", "atoms": number % 100, "group": str(number // GROUP_SIZE),
+                     "properties": {"weight": number / 7, "stable": number % 3 == 0}}}
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    """nearest-rank percentile of sorted latencies"""
+    return latencies[max(0, math.ceil(fraction * len(latencies)) - 1)]
+
+
+def summary(latencies: list, seconds: float) -> dict:
+    """throughput and latency percentiles of operations that took latencies seconds each and seconds in total"""
+    latencies = sorted(latencies)
+    return {"operations": len(latencies), "seconds": round(seconds, 6),
+            "throughput": round(len(latencies) / seconds, 2) if seconds else None,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 4) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 4) if latencies else None}
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def workload(ids: list, documents: int, operations: int, scan_operations: int) -> dict:
+    """operation -> arguments of every call, the ids are the ones of the loaded documents"""
+    rng = random.Random(SEED)
+    groups = math.ceil(documents / GROUP_SIZE)
+    return {
+        "add_document": [make_document(documents + i) for i in range(operations)],
+        "get_document": [rng.choice(ids) for _ in range(operations)],
+        "find_documents_by_field": [str(rng.randrange(groups)) for _ in range(scan_operations)],
+        # the last operation, so the other ones always find their documents
+        "delete_document": rng.sample(ids, min(operations, len(ids))),
+    }
+
+
+def measure_threads(call, arguments: list, concurrency: int) -> dict:
+    """calls call with every argument from concurrency threads"""
+    def timed(argument):
+        start = time.perf_counter()
+        call(argument)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(timed, arguments))
+    return summary(latencies, time.perf_counter() - start)
+
+
+async def measure_tasks(call, arguments: list, concurrency: int) -> dict:
+    """awaits call with every argument, concurrency calls at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(argument):
+        async with semaphore:
+            start = time.perf_counter()
+            await call(argument)
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[timed(argument) for argument in arguments])
+    return summary(list(latencies), time.perf_counter() - start)
+
+
+def run_service(documents: int, concurrency: int, operations: int, scan_operations: int, index: bool) -> dict:
+    from .dependencies import get_service
+
+    service = get_service()
+    try:
+        start = time.perf_counter()
+        ids = []
+        for batch in range(0, documents, LOAD_BATCH_SIZE):
+            ids += service.add_documents(COLLECTION, [make_document(number) for number
+                                                      in range(batch, min(batch + LOAD_BATCH_SIZE, documents))])
+        load = time.perf_counter() - start
+        if index:
+            service.create_index(COLLECTION, "group")
+
+        calls = {
+            "add_document": lambda document: service.add_document(COLLECTION, document),
+            "get_document": lambda document_id: service.get_document(COLLECTION, document_id),
+            "find_documents_by_field": lambda group: service.find_documents_by_field(COLLECTION, "group", group),
+            "delete_document": lambda document_id: service.delete_document(COLLECTION, document_id),
+        }
+        results = {operation: measure_threads(calls[operation], arguments, concurrency)
+                   for operation, arguments in workload(ids, documents, operations, scan_operations).items()}
+    finally:
+        service.close()
+    return {"load": summary([load], load), "operations": results}
+
+
+async def run_http(documents: int, concurrency: int, operations: int, scan_operations: int, index: bool) -> dict:
+    import httpx
+    from .dependencies import get_service
+    from .main import app
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        async def request(method: str, url: str, **kwargs) -> httpx.Response:
+            response = await client.request(method, url, **kwargs)
+            response.raise_for_status()
+            return response
+
+        documents_url = f"/collections/{COLLECTION}/documents"
+        start = time.perf_counter()
+        ids = []
+        for batch in range(0, documents, LOAD_BATCH_SIZE):
+            response = await request("POST", f"{documents_url}/bulk", json=[
+                make_document(number) for number in range(batch, min(batch + LOAD_BATCH_SIZE, documents))])
+            ids += response.json()["_document_ids"]
+        load = time.perf_counter() - start
+        if index:
+            await request("POST", f"/collections/{COLLECTION}/indexes", json={"field": "group"})
+
+        calls = {
+            "add_document": lambda document: request("POST", documents_url, json=document),
+            "get_document": lambda document_id: request("GET", f"{documents_url}/{document_id}"),
+            "find_documents_by_field": lambda group: request("GET", documents_url,
+                                                             params={"field": "group", "value": group}),
+            "delete_document": lambda document_id: request("DELETE", f"{documents_url}/{document_id}"),
+        }
+        results = {}
+        for operation, arguments in workload(ids, documents, operations, scan_operations).items():
+            results[operation] = await measure_tasks(calls[operation], arguments, concurrency)
+    get_service().close()
+    return {"load": summary([load], load), "operations": results}
+
+
+def run(layer: str, documents: int, concurrency: int, operations: int, scan_operations: int, index: bool) -> dict:
+    """Runs one benchmark in a new temporary BASE_DIRECTORY, in a process of its own."""
+    with tempfile.TemporaryDirectory(prefix="http_database_benchmark_") as directory:
+        # read by get_config, before the service is created
+        os.environ["BASE_DIRECTORY"] = directory
+        from .dependencies import get_config, get_service
+
+        get_service().create_collection(COLLECTION)
+        if layer == "service":
+            result = run_service(documents, concurrency, operations, scan_operations, index)
+        else:
+            result = asyncio.run(run_http(documents, concurrency, operations, scan_operations, index))
+        config = get_config()
+    return {"layer": layer, "documents": documents, "concurrency": concurrency, "index": index,
+            "service_mode": config.SERVICE_MODE if layer == "http" else None, "wal_fsync": config.WAL_FSYNC,
+            "codec": get_service().codec.name, **result, "peak_rss_bytes": peak_rss_bytes()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark",
+                                     description="Benchmarks CollectionService and the HTTP API.")
+    parser.add_argument("--layer", nargs="+", choices=LAYERS, default=LAYERS, help="layers to benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 100000, 1000000],
+                        help="numbers of documents in the collection")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 16, 64],
+                        help="numbers of concurrent callers")
+    parser.add_argument("--operations", type=int, default=1000,
+                        help="calls of add_document, get_document and delete_document per run")
+    parser.add_argument("--scan-operations", type=int, default=20,
+                        help="calls of find_documents_by_field per run, which read the whole collection without index")
+    parser.add_argument("--index", action="store_true", help="index the searched field")
+    parser.add_argument("--output", help="file to write the results to, standard output by default")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for layer in args.layer:
+        for documents in args.sizes:
+            for concurrency in args.concurrency:
+                # spawned, so that the memory of a run is not inherited from the previous ones
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    runs.append(executor.submit(run, layer, documents, concurrency, args.operations,
+                                                args.scan_operations, args.index).result())
+                print(f"Benchmarked {layer} with {documents} documents and concurrency {concurrency}",
+                      file=sys.stderr)
+
+    report = json.dumps({"date": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+                         "platform": platform.platform(), "cpus": os.cpu_count(), "runs": runs}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least-recently-used cache of documents, keyed by collection name and document id.
+
+    The documents are cached encoded, as JSON bytes, so they can't be modified through the cache and their size is
+    known. The total size of the cached documents is kept under max_bytes by evicting the least recently used ones,
+    a max_bytes of 0 disables the cache. The cache is thread-safe.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # (collection name, document id) -> document, from the least to the most recently used
+        self._entries = OrderedDict()
+        # collection name -> ids of its cached documents, to invalidate a whole collection
+        self._collections = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, collection_name: str, document_id: str):
+        """returns the cached document, or None"""
+        with self._lock:
+            document = self._entries.get((collection_name, document_id))
+            if document is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((collection_name, document_id))
+            self.hits += 1
+            return document
+
+    def put(self, collection_name: str, document_id: str, document: bytes):
+        if len(document) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove((collection_name, document_id))
+            self._entries[(collection_name, document_id)] = document
+            self._collections.setdefault(collection_name, set()).add(document_id)
+            self.size += len(document)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: tuple):
+        document = self._entries.pop(key, None)
+        if document is None:
+            return
+        self.size -= len(document)
+        ids = self._collections[key[0]]
+        ids.discard(key[1])
+        if not ids:
+            del self._collections[key[0]]
+
+    def invalidate(self, collection_name: str, document_id: str):
+        with self._lock:
+            self._remove((collection_name, document_id))
+
+    def invalidate_collection(self, collection_name: str):
+        with self._lock:
+            for document_id in list(self._collections.get(collection_name, ())):
+                self._remove((collection_name, document_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._collections.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes}
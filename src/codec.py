@@ -0,0 +1,126 @@
+import abc
+import json
+import math
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class JsonCodec:
+    """Codec of the standard library, always available."""
+    name = "json"
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+# integers that may not fit in 64 bits, which the faster libraries reject or read as floats
+_LONG_NUMBER = re.compile(rb"\d{19}")
+
+
+def _has_non_finite(obj) -> bool:
+    """whether obj holds a NaN or an infinity"""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+class _FastCodec(abc.ABC):
+    """Base of the codecs of the faster libraries, which fall back to the standard library for the data they don't
+    handle like it: integers beyond 64 bits, NaN and infinities. The standard library then also raises the errors of
+    invalid data, so every codec accepts and rejects the same data."""
+    # errors of the library for the data it doesn't handle
+    errors = ()
+
+    @abc.abstractmethod
+    def _dumps(self, obj) -> bytes:
+        """encodes obj with the library"""
+
+    @abc.abstractmethod
+    def _loads(self, data: bytes):
+        """decodes data with the library"""
+
+    def dumps(self, obj) -> bytes:
+        try:
+            data = self._dumps(obj)
+        except self.errors:
+            return json.dumps(obj).encode()
+        # NaN and infinities are written as null, the standard library writes them as NaN and Infinity. Only the
+        # objects with a null, like None values, are walked to find them.
+        if b"null" in data and _has_non_finite(obj):
+            return json.dumps(obj).encode()
+        return data
+
+    def loads(self, data: bytes):
+        if _LONG_NUMBER.search(data):
+            return json.loads(data)
+        try:
+            return self._loads(data)
+        except self.errors:
+            return json.loads(data)
+
+
+class OrjsonCodec(_FastCodec):
+    name = "orjson"
+    errors = (TypeError, ValueError)
+
+    def _dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def _loads(self, data: bytes):
+        return orjson.loads(data)
+
+
+class MsgspecCodec(_FastCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        self.errors = (msgspec.MsgspecError, TypeError, ValueError, OverflowError)
+
+    def _dumps(self, obj) -> bytes:
+        return self._encoder.encode(obj)
+
+    def _loads(self, data: bytes):
+        return self._decoder.decode(data)
+
+
+# codec name -> (codec class, whether its library is installed), in order of preference for "auto"
+CODECS = {
+    "orjson": (OrjsonCodec, orjson is not None),
+    "msgspec": (MsgspecCodec, msgspec is not None),
+    "json": (JsonCodec, True),
+}
+
+
+def get_codec(name: str = "auto"):
+    """Returns the JSON codec with the given name, "auto" picks the fastest one that is installed.
+
+    Every codec writes standard JSON, so files written with one codec are read by the others. They only differ in
+    whitespace and in the escaping of non-ASCII characters. The faster codecs fall back to the standard library for
+    the values they don't support, so they read and write the same values, see _FastCodec.
+    """
+    if name == "auto":
+        name = next(name for name, (_, installed) in CODECS.items() if installed)
+    if name not in CODECS:
+        raise ValueError(f"Invalid codec '{name}'")
+    codec_class, installed = CODECS[name]
+    if not installed:
+        raise ValueError(f"Codec '{name}' is not installed")
+    return codec_class()
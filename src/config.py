@@ -8,12 +8,48 @@ class Config(BaseSettings):
     The BASE_DIRECTORY_CREATE_TYPE defines how the base directory is created. If it is set to "update", the directory
     is updated with the new files. If it is set to "create", the directory is replaced with the new files every time
     the application starts.
+    COMPACTION_RATIO is the ratio of dead records (overwritten or deleted documents) in a collection file at which the
+    file is compacted in the background.
+    SERVICE_MODE selects the endpoints: "sync" endpoints are blocking functions run in the threadpool of the server,
+    "async" endpoints are coroutines that run the file I/O in a dedicated executor of IO_THREADS threads.
+    WAL_FSYNC decides when the write-ahead log is fsynced: "always" before a write returns (concurrent writes share
+    one fsync), "interval" every WAL_FSYNC_INTERVAL_MS milliseconds in the background, or "never". The write-ahead log
+    is checkpointed once it holds WAL_CHECKPOINT_BYTES.
+    SCAN_PROCESSES is the number of processes that scan the shards of sharded collections, and the collection files
+    of at least PARALLEL_SCAN_BYTES, in parallel for the searches that read every document. It is every core by
+    default, and a PARALLEL_SCAN_BYTES of 0 only scans sharded collections in parallel.
+    CACHE_BYTES is the size of the cache of the documents read by id, 0 disables the cache.
+    LEADER_URL makes the application a follower of the instance at that URL (e.g. "http://localhost:8000"), which
+    serves the reads from its own copy of the collections and forwards the writes to the leader, see replication.
+    REPLICATION_WAIT_MS is how long the leader holds a poll of a follower when there is no new mutation.
+    SNAPSHOT_DIRECTORY is where POST /admin/snapshot writes the snapshots, BASE_DIRECTORY/snapshots by default.
+    SLOW_REQUEST_MS is the duration above which a request is logged with what it did, 0 disables the log. With
+    PROFILING, the requests with an X-Profile header are profiled, and their profiles are written to PROFILE_DIRECTORY
+    (BASE_DIRECTORY/profiles by default), see diagnostics.
+    CODEC is the JSON library used for the documents and the responses: "orjson", "msgspec" or "json" (the standard
+    library). "auto" picks the fastest one that is installed.
 
     These settings are supposed to be provided as environment variables or in a .env file. Environment variables always
     override the values in the .env file(Because of how BaseSettings is implemented in pydantic_settings).
     """
     BASE_DIRECTORY: str
     BASE_DIRECTORY_CREATE_TYPE: str = "update"
+    COMPACTION_RATIO: float = 0.5
+    SERVICE_MODE: str = "sync"
+    IO_THREADS: int = 32
+    WAL_FSYNC: str = "always"
+    WAL_FSYNC_INTERVAL_MS: int = 100
+    WAL_CHECKPOINT_BYTES: int = 64 * 1024 * 1024
+    CODEC: str = "auto"
+    CACHE_BYTES: int = 64 * 1024 * 1024
+    LEADER_URL: str | None = None
+    SCAN_PROCESSES: int | None = None
+    PARALLEL_SCAN_BYTES: int = 32 * 1024 * 1024
+    REPLICATION_WAIT_MS: int = 1000
+    SNAPSHOT_DIRECTORY: str | None = None
+    SLOW_REQUEST_MS: int = 1000
+    PROFILING: bool = False
+    PROFILE_DIRECTORY: str | None = None
 
     model_config = {
         "env_file": "HTTP_database/.env"
@@ -26,4 +62,51 @@ class Config(BaseSettings):
             raise ValueError('Invalid BASE_DIRECTORY_CREATE_TYPE')
         return v
 
+    @field_validator('COMPACTION_RATIO')
+    @classmethod
+    def validate_compaction_ratio(cls, v):
+        if not 0 < v <= 1:
+            raise ValueError('COMPACTION_RATIO must be in the range (0, 1]')
+        return v
+
+    @field_validator('SERVICE_MODE')
+    @classmethod
+    def validate_service_mode(cls, v):
+        if v not in {'sync', 'async'}:
+            raise ValueError('Invalid SERVICE_MODE')
+        return v
 
+    @field_validator('WAL_FSYNC')
+    @classmethod
+    def validate_wal_fsync(cls, v):
+        if v not in {'always', 'interval', 'never'}:
+            raise ValueError('Invalid WAL_FSYNC')
+        return v
+
+    @field_validator('WAL_FSYNC_INTERVAL_MS', 'WAL_CHECKPOINT_BYTES', 'REPLICATION_WAIT_MS')
+    @classmethod
+    def validate_positive(cls, v):
+        if v <= 0:
+            raise ValueError('must be positive')
+        return v
+
+    @field_validator('CODEC')
+    @classmethod
+    def validate_codec(cls, v):
+        if v not in {'auto', 'orjson', 'msgspec', 'json'}:
+            raise ValueError('Invalid CODEC')
+        return v
+
+    @field_validator('SCAN_PROCESSES')
+    @classmethod
+    def validate_scan_processes(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError('SCAN_PROCESSES must be positive')
+        return v
+
+    @field_validator('CACHE_BYTES', 'PARALLEL_SCAN_BYTES', 'SLOW_REQUEST_MS')
+    @classmethod
+    def validate_not_negative(cls, v):
+        if v < 0:
+            raise ValueError('must not be negative')
+        return v
@@ -1,6 +1,9 @@
+import os
 from functools import lru_cache
 from .config import Config
 from .service import CollectionService
+from .async_service import AsyncCollectionService
+from .replication import Follower
 
 
 @lru_cache
@@ -10,4 +13,29 @@ def get_config():
 
 @lru_cache
 def get_service():
-    return CollectionService(get_config().BASE_DIRECTORY)
+    config = get_config()
+    return CollectionService(config.BASE_DIRECTORY, compaction_ratio=config.COMPACTION_RATIO,
+                             wal_fsync=config.WAL_FSYNC, wal_fsync_interval_ms=config.WAL_FSYNC_INTERVAL_MS,
+                             wal_checkpoint_bytes=config.WAL_CHECKPOINT_BYTES, codec=config.CODEC,
+                             cache_bytes=config.CACHE_BYTES, scan_processes=config.SCAN_PROCESSES,
+                             parallel_scan_bytes=config.PARALLEL_SCAN_BYTES)
+
+
+@lru_cache
+def get_async_service():
+    return AsyncCollectionService(get_service(), io_threads=get_config().IO_THREADS)
+
+
+def get_snapshot_directory() -> str:
+    """the directory of the snapshots written by POST /admin/snapshot"""
+    config = get_config()
+    return config.SNAPSHOT_DIRECTORY or os.path.join(config.BASE_DIRECTORY, "snapshots")
+
+
+@lru_cache
+def get_follower():
+    """the Follower of the leader at LEADER_URL, None if this instance is not a follower"""
+    config = get_config()
+    if config.LEADER_URL is None:
+        return None
+    return Follower(get_service(), config.LEADER_URL, wait_ms=config.REPLICATION_WAIT_MS)
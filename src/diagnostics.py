@@ -0,0 +1,160 @@
+"""Diagnostics of single HTTP requests: the slow request log and the opt-in profiles.
+
+Every request is traced (see metrics.RequestTrace) until its response is sent. A request that takes more than
+SLOW_REQUEST_MS (see Config) is logged with its endpoint, collection, status, the time until the response started and
+the time spent sending it, the time spent in every CollectionService method and the counts of the trace, like the
+documents scanned and returned by the searches.
+
+With PROFILING enabled, a request with the X-Profile header is profiled by a SamplingProfiler, and the profile is
+written to PROFILE_DIRECTORY. The response tells where, in its X-Profile header.
+"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+import weakref
+
+from . import metrics
+
+PROFILE_HEADER = "X-Profile"
+# the directory of the modules of the application, the profiles only keep the stacks that run its code
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class SamplingProfiler:
+    """Samples the stacks of the threads that run code of the application, every interval seconds.
+
+    The blocking calls of a request run in threads of a pool, which a deterministic profiler like cProfile doesn't
+    follow, so every thread is sampled. The requests served at the same time are sampled too: a profile is only
+    accurate on an otherwise quiet instance.
+
+    The profile is written in the folded stack format, one line per stack, from the outermost frame, with the number
+    of samples, e.g. for flamegraph.pl or speedscope:
+        _worker (thread.py:69);run (thread.py:53);get_documents (routes.py:171) 12
+    """
+
+    def __init__(self, interval: float = 0.002, max_seconds: float = 300):
+        self.interval = interval
+        # the sampling stops by itself after max_seconds, in case the profiled request is never finished
+        self.max_seconds = max_seconds
+        # folded stack -> samples
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stopped.wait(self.interval) and time.monotonic() < deadline:
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                application = False
+                while frame is not None:
+                    code = frame.f_code
+                    application = application or code.co_filename.startswith(PACKAGE_DIRECTORY)
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if application:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        with open(path, "w") as file:
+            for stack, samples in self.stacks.most_common():
+                file.write(f"{stack} {samples}\n")
+
+
+def profile_path(directory: str, operation: str) -> str:
+    """returns a new path for the profile of a request to the endpoint operation"""
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{operation}-{uuid.uuid4().hex[:8]}.folded")
+
+
+def describe(request, status: int, trace: metrics.RequestTrace, response_seconds: float, body_seconds: float) -> str:
+    """one line that tells what the request did and where its time went"""
+    route = request.scope.get("route")
+    operation = f"{request.method} {route.path} ({route.name})" if route is not None else \
+        f"{request.method} {request.url.path}"
+    parts = [f"{operation} status={status}"]
+    collection = request.path_params.get("collection_name")
+    if collection is not None:
+        parts.append(f"collection={collection}")
+    parts.append(f"total={(response_seconds + body_seconds) * 1000:.1f}ms response={response_seconds * 1000:.1f}ms "
+                 f"body={body_seconds * 1000:.1f}ms")
+    if trace.durations:
+        parts.append("service: " + " ".join(f"{method}={seconds * 1000:.1f}ms" + (f"x{calls}" if calls > 1 else "")
+                                            for method, (calls, seconds) in trace.durations.items()))
+    if trace.counts:
+        parts.append("counts: " + " ".join(f"{name}={count}" for name, count in sorted(trace.counts.items())))
+    return " ".join(parts)
+
+
+async def trace_request(request, call_next, slow_request_ms: int, profile_directory: str = None):
+    """Serves the request with call_next, traced until its response is sent, see the module docstring.
+    profile_directory is None unless PROFILING is enabled."""
+    trace = metrics.RequestTrace()
+    profiler = None
+    if profile_directory is not None and PROFILE_HEADER in request.headers:
+        profiler = SamplingProfiler()
+        profiler.start()
+    start = time.perf_counter()
+    # the endpoint runs in a task that copies the context, it sees the trace until its response is sent
+    token = metrics.TRACE.set(trace)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        if profiler is not None:
+            profiler.stop()
+        raise
+    finally:
+        metrics.TRACE.reset(token)
+    response_seconds = time.perf_counter() - start
+    path = None
+    if profiler is not None:
+        route = request.scope.get("route")
+        path = profile_path(profile_directory, route.name if route is not None else "unmatched")
+        response.headers[PROFILE_HEADER] = path
+
+    # finish doesn't hold the response, which holds the body that is watched below
+    status = response.status_code
+    finished = threading.Lock()
+
+    def finish():
+        # runs once, in a thread as the profiler joins its thread and writes the profile
+        if not finished.acquire(blocking=False):
+            return
+        body_seconds = time.perf_counter() - start - response_seconds
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(path)
+        if slow_request_ms and (response_seconds + body_seconds) * 1000 >= slow_request_ms:
+            logging.warning("Slow request " + describe(request, status, trace, response_seconds, body_seconds))
+
+    body = response.body_iterator
+
+    async def traced_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            # also when the response is cancelled because the client disconnected, the thread finishes anyway
+            await asyncio.shield(asyncio.to_thread(finish))
+
+    response.body_iterator = traced_body()
+    # the body is never iterated if the client disconnects before the response starts
+    weakref.finalize(response.body_iterator, lambda: threading.Thread(target=finish, daemon=True).start())
+    return response
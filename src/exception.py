@@ -23,4 +23,24 @@ class ValidationException(Exception):
 
     def __init__(self, message: str):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class IndexAlreadyExistsException(Exception):
+
+    def __init__(self, collection_name: str, field: str):
+        self.message = f"Index on field '{field}' already exists in collection '{collection_name}'."
+        super().__init__(self.message)
+
+
+class NoSuchIndexException(Exception):
+
+    def __init__(self, collection_name: str, field: str):
+        self.message = f"Index on field '{field}' does not exist in collection '{collection_name}'."
+        super().__init__(self.message)
+
+
+class SnapshotRequiredException(Exception):
+
+    def __init__(self, lsn: int):
+        self.message = f"The write-ahead log entries after lsn {lsn} were checkpointed, a snapshot is required."
+        super().__init__(self.message)
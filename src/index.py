@@ -0,0 +1,61 @@
+class FieldIndex:
+    """In-memory equality index on one field of the documents' data.
+
+    Values are indexed by their string representation, which is how find_documents_by_field compares them, so
+    searching for "1" finds documents where the field is 1 or "1". Documents that don't have the field are not indexed.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        # key -> ids of the documents with that key, a dict is used as an ordered set
+        self.entries = {}
+        # document id -> key, needed to unindex the old version of a document without reading it
+        self._keys = {}
+
+    @staticmethod
+    def key(value) -> str:
+        return str(value)
+
+    @staticmethod
+    def only_strings(key: str) -> bool:
+        """whether only a string value, equal to the key, has that key: the other values have keys like 1, 1.5, True,
+        None, [1] or {'a': 1}"""
+        if key in ("True", "False", "None") or key.startswith(("[", "{")):
+            return False
+        try:
+            float(key)
+        except ValueError:
+            return True
+        return False
+
+    def add(self, document: dict):
+        """indexes the document, replacing its previous version if there is one"""
+        self.remove(document["_document_id"])
+        data = document.get("data", {})
+        if self.field not in data:
+            return
+        key = FieldIndex.key(data[self.field])
+        self.entries.setdefault(key, {})[document["_document_id"]] = None
+        self._keys[document["_document_id"]] = key
+
+    def remove(self, document_id: str):
+        key = self._keys.pop(document_id, None)
+        if key is None:
+            return
+        ids = self.entries[key]
+        del ids[document_id]
+        if not ids:
+            del self.entries[key]
+
+    def dump(self) -> dict:
+        """returns the entries of the index as JSON, see load"""
+        return {key: list(ids) for key, ids in self.entries.items()}
+
+    def load(self, entries: dict):
+        """replaces the entries of the index with ones returned by dump"""
+        self.entries = {key: dict.fromkeys(ids) for key, ids in entries.items()}
+        self._keys = {document_id: key for key, ids in entries.items() for document_id in ids}
+
+    def lookup(self, value) -> list:
+        """returns the ids of the documents whose field is equal to the value"""
+        return list(self.entries.get(FieldIndex.key(value), ()))
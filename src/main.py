@@ -1,14 +1,41 @@
 
-from fastapi import FastAPI, Depends
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import Response
 from .exception import CollectionAlreadyExistsException, NoSuchCollectionException, \
     NoSuchDocumentException, \
-    ValidationException
-from .schemas import CreateCollection, CreateDocument
-from .service import CollectionService
-from .dependencies import get_service
-
-app = FastAPI()
+    ValidationException, IndexAlreadyExistsException, NoSuchIndexException, SnapshotRequiredException
+from .dependencies import get_async_service, get_config, get_follower, get_service
+from .replication import LSN_HEADER, WRITE_METHODS
+from . import diagnostics, metrics, routes, async_routes
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # a follower replicates its leader while it is running
+    follower = get_follower()
+    if follower is not None:
+        follower.start()
+    yield
+    if follower is not None:
+        await follower.stop()
+    # a clean shutdown leaves no write-ahead log to replay and up to date index checkpoints, see
+    # CollectionService.close. The services are only closed if they were created, and the calls still running in the
+    # executor of the async service finish first
+    if get_async_service.cache_info().currsize:
+        get_async_service().shutdown(wait=True)
+        get_async_service.cache_clear()
+    if get_service.cache_info().currsize:
+        get_service().close()
+        get_service.cache_clear()
+
+
+# responses are encoded with the codec selected by Config.CODEC
+app = FastAPI(default_response_class=routes.CodecJSONResponse, lifespan=lifespan)
 
 #fastapi
 
@@ -32,79 +59,68 @@ async def validation_exception_handler(request, exc: ValidationException):
     raise HTTPException(status_code=400, detail=exc.message)
 
 
-@app.get("/")
-def read_root():
-    return {"Hello": "World"}
-
-
-@app.post("/collections", status_code=201)
-def create_collection(collection: CreateCollection, service: CollectionService = Depends(get_service)) -> dict:
-    service.create_collection(collection.name)
-    return {"message": "Collection created successfully"}
-
-
-@app.get("/collections", status_code=200)
-def get_collections(service: CollectionService = Depends(get_service)) -> dict:
-    return {"collections": service.get_collections()}
-
-
-@app.get("/collections/{collection_name}", status_code=200)
-def get_collection(collection_name: str, service: CollectionService = Depends(get_service)) -> dict:
-    return service.get_collection(collection_name)
+@app.exception_handler(IndexAlreadyExistsException)
+async def index_already_exists_exception_handler(request, exc: IndexAlreadyExistsException):
+    raise HTTPException(status_code=400, detail=exc.message)
 
 
-@app.delete("/collections/{collection_name}", status_code=200)
-def delete_collection(collection_name: str, service: CollectionService = Depends(get_service)) -> dict:
-    service.delete_collection(collection_name)
-    return {"message": "Collection deleted successfully"}
+@app.exception_handler(NoSuchIndexException)
+async def no_such_index_exception_handler(request, exc: NoSuchIndexException):
+    raise HTTPException(status_code=404, detail=exc.message)
 
 
-@app.put("/collections/{collection_name}", status_code=200)
-def update_collection(collection_name: str, new_collection: CreateCollection,
-                      service: CollectionService = Depends(get_service)) -> dict:
-    service.update_collection(collection_name, new_collection.dict())
-    return {"message": "Collection updated successfully"}
+@app.exception_handler(SnapshotRequiredException)
+async def snapshot_required_exception_handler(request, exc: SnapshotRequiredException):
+    raise HTTPException(status_code=410, detail=exc.message)
 
 
-@app.post("/collections/{collection_name}/documents", status_code=201)
-def create_document(collection_name: str, document: CreateDocument,
-                    service: CollectionService = Depends(get_service)) -> dict:
-    document_id = service.add_document(collection_name, document.dict())
-    """
-    :param document: should be of the form {"data": {"field1": "value1", "field2": "value2"}}
-                    so "data" dictionary is a required field
-    """
-    return {"message": "Document created successfully", "_document_id": document_id}
+@app.middleware("http")
+async def replicate_writes(request: Request, call_next):
+    """A follower forwards the writes to its leader. The leader tells, in the responses to the writes, which lsn the
+    followers must have applied to serve them. The admin endpoints are served by the instance itself."""
+    if request.method not in WRITE_METHODS or request.url.path.startswith("/admin/"):
+        return await call_next(request)
+    follower = get_follower()
+    if follower is not None:
+        return await follower.forward(request)
+    response = await call_next(request)
+    response.headers[LSN_HEADER] = str(get_service().last_lsn)
+    return response
 
 
-@app.get("/collections/{collection_name}/documents/{document_id}", status_code=200)
-def get_document(collection_name: str, document_id: str, service: CollectionService = Depends(get_service)) -> dict:
-    return service.get_document(collection_name, document_id)
+@app.middleware("http")
+async def record_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # the path of the endpoint, like /collections/{collection_name}, so the requests of an endpoint share a histogram
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, request.method,
+                                    route.path if route is not None else "unmatched", str(response.status_code))
+    return response
 
 
-@app.get("/collections/{collection_name}/documents", status_code=200)
-def get_documents(collection_name: str,
-                  field=None, value=None,
-                  service: CollectionService = Depends(get_service)) -> dict:
-    if field and value:
-        return {"documents": service.find_documents_by_field(collection_name, field, value)}
-    return {"documents": service.get_documents(collection_name)}
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Logs the slow requests, and profiles the requests that ask for it, see diagnostics."""
+    config = get_config()
+    profile_directory = None
+    if config.PROFILING:
+        profile_directory = config.PROFILE_DIRECTORY or os.path.join(config.BASE_DIRECTORY, "profiles")
+    return await diagnostics.trace_request(request, call_next, config.SLOW_REQUEST_MS, profile_directory)
 
 
-@app.delete("/collections/{collection_name}/documents/{document_id}", status_code=200)
-def delete_document(collection_name: str, document_id: str, service: CollectionService = Depends(get_service)) -> dict:
-    service.delete_document(collection_name, document_id)
-    return {"message": "Document deleted successfully"}
+@app.get("/")
+def read_root():
+    return {"Hello": "World"}
 
 
-@app.put("/collections/{collection_name}/documents/{document_id}", status_code=200)
-def update_document(collection_name: str, document_id: str, new_document: CreateDocument,
-                    service: CollectionService = Depends(get_service)) -> dict:
-    service.update_document(collection_name, document_id, new_document.dict())
-    return {"message": "Document updated successfully"}
+@app.get("/metrics")
+def get_metrics():
+    """The metrics of the service in the Prometheus text format, see metrics."""
+    get_service().collect_metrics()
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
-@app.delete("/collections", status_code=200)
-def clean_up(service: CollectionService = Depends(get_service)) -> dict:
-    service.clean_up()
-    return {"message": "All collections deleted successfully"}
+# The endpoints are either blocking functions run in the threadpool, or coroutines that offload the file I/O to a
+# dedicated executor, depending on SERVICE_MODE
+app.include_router(async_routes.router if get_config().SERVICE_MODE == "async" else routes.router)
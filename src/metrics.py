@@ -0,0 +1,208 @@
+"""Metrics of the service, exposed in the Prometheus text format by GET /metrics.
+
+The metrics are recorded as the operations happen, in the module-level metrics below, so they are shared by every
+part of the application. Recording one value only takes a lock and a dict lookup. Per-record counts, like the
+documents read by a scan, are summed locally and recorded once per operation.
+
+A few metrics describe the state of the service rather than events, like the sizes of the collection files. They are
+set by CollectionService.collect_metrics just before the metrics are rendered.
+
+The counters with a trace name, and the durations of the CollectionService methods, are also recorded in the
+RequestTrace of the HTTP request being served, if any, see TRACE.
+"""
+import bisect
+import contextvars
+import functools
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# upper bounds in seconds of the buckets of the duration histograms
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """A metric with a value per combination of label values, given positionally in the order of labelnames."""
+    kind = None
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        # label values -> value
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> list:
+        """returns (name suffix, label names, label values, value) of the samples of the metric"""
+        with self._lock:
+            return [("", self.labelnames, labels, value) for labels, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{_format_labels(names, labels)} {_format_value(value)}"
+                  for suffix, names, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), trace_name: str = None):
+        super().__init__(name, description, labelnames)
+        # name of the count in RequestTrace, followed by the label values
+        self.trace_name = trace_name
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+        if self.trace_name is not None:
+            trace = TRACE.get()
+            if trace is not None:
+                trace.count("_".join((self.trace_name,) + labels), amount)
+
+    def set(self, value, *labels):
+        """for counts that are kept elsewhere, e.g. by the document cache"""
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Counts of the observed values in buckets, with their sum, see DURATION_BUCKETS."""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # the count of the bucket the value falls in, the cumulative counts are only computed by samples
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # a count per bucket, the values above the last bucket, and the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        samples = []
+        names = self.labelnames + ("le",)
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                samples.append(("_bucket", names, labels + (_format_value(bound),), total))
+            samples.append(("_sum", self.labelnames, labels, counts[-1]))
+            samples.append(("_count", self.labelnames, labels, total))
+        return samples
+
+
+class RequestTrace:
+    """What one HTTP request did, for the slow request log: the counts of the traced counters and the time spent in
+    the CollectionService methods, see diagnostics."""
+
+    def __init__(self):
+        # trace name of a counter -> count
+        self.counts = {}
+        # CollectionService method -> [calls, seconds]
+        self.durations = {}
+        # updated by the threads that run the blocking calls of the request
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def time(self, method: str, seconds: float):
+        with self._lock:
+            duration = self.durations.setdefault(method, [0, 0.0])
+            duration[0] += 1
+            duration[1] += seconds
+
+
+# RequestTrace of the request being served. The threads that run the blocking calls of a request get a copy of its
+# context, see AsyncCollectionService._run, so they see it too.
+TRACE = contextvars.ContextVar("trace", default=None)
+
+# every metric, in the order they are rendered
+REGISTRY = []
+
+REQUEST_SECONDS = Histogram("http_database_request_duration_seconds",
+                            "Time until the response of an HTTP request starts, by endpoint and status.",
+                            ("method", "route", "status"))
+SERVICE_SECONDS = Histogram("http_database_service_duration_seconds",
+                            "Duration of the calls of the CollectionService methods. Methods that return generators "
+                            "are only timed until the generator is returned.", ("method",))
+BYTES_READ = Counter("http_database_read_bytes_total", "Bytes of records read from the collection files.",
+                     trace_name="read_bytes")
+BYTES_WRITTEN = Counter("http_database_written_bytes_total",
+                        "Bytes written to the collection files and to the write-ahead log.", ("file",),
+                        trace_name="written_bytes")
+DOCUMENTS_SCANNED = Counter("http_database_scanned_documents_total",
+                            "Documents parsed by the searches to be compared with the query.", trace_name="scanned")
+DOCUMENTS_RETURNED = Counter("http_database_returned_documents_total",
+                             "Documents of the searches that matched the query.", trace_name="returned")
+INDEX_QUERIES = Counter("http_database_index_queries_total",
+                        "Searches served by an index (hit) or by reading the whole collection (miss).", ("result",),
+                        trace_name="index")
+CACHE_REQUESTS = Counter("http_database_cache_requests_total",
+                         "Reads of documents by id, served by the document cache (hit) or not (miss).", ("result",))
+CACHE_EVICTIONS = Counter("http_database_cache_evictions_total", "Documents evicted from the document cache.")
+CACHE_BYTES = Gauge("http_database_cache_bytes", "Size of the documents in the document cache.")
+COLLECTION_FILE_BYTES = Gauge("http_database_collection_file_bytes",
+                              "Size of the files of a collection, live and dead records.", ("collection",))
+COLLECTION_DOCUMENTS = Gauge("http_database_collection_documents", "Live documents of a collection.",
+                             ("collection",))
+
+
+def timed(function):
+    """records the duration of every call of the CollectionService method in SERVICE_SECONDS"""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            SERVICE_SECONDS.observe(seconds, name)
+            trace = TRACE.get()
+            if trace is not None:
+                trace.time(name, seconds)
+    return wrapper
+
+
+def render() -> str:
+    """returns every metric in the Prometheus text format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
@@ -0,0 +1,32 @@
+"""Converts collections to another record format.
+
+    python -m src.migrate --format binary [collection ...]
+
+The collections are found like by the server, from BASE_DIRECTORY (see Config). Without collection names, every
+collection is converted. The server must not be running on the same directory.
+"""
+import argparse
+
+from .dependencies import get_service
+from .storage import FORMATS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.migrate", description="Converts collections to another "
+                                                                               "record format.")
+    parser.add_argument("--format", required=True, choices=list(FORMATS), help="record format to convert to")
+    parser.add_argument("collections", nargs="*", help="names of the collections to convert, all by default")
+    args = parser.parse_args(argv)
+
+    service = get_service()
+    try:
+        names = args.collections or [collection["name"] for collection in service.get_collections()]
+        for name in names:
+            service.convert_collection(name, args.format)
+            print(f"Converted collection {name} to {args.format}")
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import json
+
+from .exception import ValidationException
+from .index import FieldIndex
+
+# operator -> whether the value of the field and the operand satisfy it, for fields that exist
+COMPARISONS = {
+    "$eq": lambda value, operand: _equal(value, operand),
+    "$ne": lambda value, operand: not _equal(value, operand),
+    "$gt": lambda value, operand: _ordered(value, operand) and value > operand,
+    "$gte": lambda value, operand: _ordered(value, operand) and value >= operand,
+    "$lt": lambda value, operand: _ordered(value, operand) and value < operand,
+    "$lte": lambda value, operand: _ordered(value, operand) and value <= operand,
+    "$in": lambda value, operand: any(_equal(value, item) for item in operand),
+}
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+AGGREGATE_FUNCTIONS = {"count", "sum", "avg", "min", "max"}
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _equal(value, operand) -> bool:
+    """typed equality: 1 and 1.0 are equal, 1 and "1" or 1 and true are not"""
+    if _is_number(value) and _is_number(operand):
+        return value == operand
+    return type(value) is type(operand) and value == operand
+
+
+def _ordered(value, operand) -> bool:
+    """whether the value can be compared with the operand: numbers with numbers and strings with strings"""
+    return (_is_number(value) and _is_number(operand)) or (isinstance(value, str) and isinstance(operand, str))
+
+
+_MISSING = object()
+
+
+def _resolve(data, path: str):
+    """returns the value at the dotted path in the data, e.g. "properties.weight" or "synonyms.0", or _MISSING"""
+    for part in path.split("."):
+        if isinstance(data, dict) and part in data:
+            data = data[part]
+        elif isinstance(data, list) and part.isdigit() and int(part) < len(data):
+            data = data[int(part)]
+        else:
+            return _MISSING
+    return data
+
+
+class Condition:
+    """Comparison of the value at a path of the documents' data with an operand."""
+
+    def __init__(self, path: str, operator: str, operand):
+        self.path = path
+        self.operator = operator
+        self.operand = operand
+        self._compare = COMPARISONS[operator]
+
+    def matches(self, data: dict) -> bool:
+        value = _resolve(data, self.path)
+        if value is _MISSING:
+            # a missing field is only different from everything
+            return self.operator == "$ne"
+        return self._compare(value, self.operand)
+
+    def candidates(self, field_indexes: dict):
+        """returns the ids of the documents that may match according to an index, or None if no index applies"""
+        field_index = field_indexes.get(self.path)
+        if field_index is None or "." in self.path or self.operator not in {"$eq", "$in"}:
+            return None
+        operands = self.operand if self.operator == "$in" else [self.operand]
+        if any(isinstance(operand, (dict, list)) for operand in operands):
+            return None
+        ids = set()
+        for operand in operands:
+            for key in _index_keys(operand):
+                ids.update(field_index.entries.get(key, ()))
+        return ids
+
+
+def _index_keys(operand) -> set:
+    """the keys of FieldIndex under which the values equal to the operand are indexed"""
+    keys = {FieldIndex.key(operand)}
+    if _is_number(operand) and float(operand).is_integer():
+        # 1 and 1.0 are equal but are indexed as "1" and "1.0"
+        keys |= {FieldIndex.key(int(operand)), FieldIndex.key(float(operand))}
+    return keys
+
+
+class And:
+    def __init__(self, children: list):
+        self.children = children
+
+    def matches(self, data: dict) -> bool:
+        return all(child.matches(data) for child in self.children)
+
+    def candidates(self, field_indexes: dict):
+        # any indexed child narrows the documents down, the smallest set is kept
+        sets = [ids for ids in (child.candidates(field_indexes) for child in self.children) if ids is not None]
+        return min(sets, key=len) if sets else None
+
+
+class Or:
+    def __init__(self, children: list):
+        self.children = children
+
+    def matches(self, data: dict) -> bool:
+        return any(child.matches(data) for child in self.children)
+
+    def candidates(self, field_indexes: dict):
+        # only usable if every child is indexed
+        ids = set()
+        for child in self.children:
+            child_ids = child.candidates(field_indexes)
+            if child_ids is None:
+                return None
+            ids |= child_ids
+        return ids
+
+
+class Filter:
+    """Filter expression on the documents' data, compiled once into a tree of conditions.
+
+    The expression is a JSON object in the style of MongoDB:
+        {"name": "Methane"}                               typed equality, 1 doesn't match "1"
+        {"atoms": {"$gte": 2, "$lt": 10}}                 $eq, $ne, $gt, $gte, $lt, $lte, and $in with a list
+        {"properties.weight": {"$gt": 16}}                dotted paths into nested objects and lists
+        {"$or": [{"name": "Methane"}, {"atoms": 9}]}       $and and $or take a list of expressions
+    The fields of an object are combined with AND. Ranges only compare numbers with numbers and strings with strings.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.root = Filter._compile(expression)
+
+    def __reduce__(self):
+        # the compiled conditions hold lambdas, a filter is pickled as its expression, e.g. for the scan processes
+        return Filter, (self.expression,)
+
+    def matches(self, document: dict) -> bool:
+        return self.root.matches(document.get("data", {}))
+
+    def candidates(self, field_indexes: dict):
+        """returns the ids of the documents that may match, found with the indexes, or None if every document has to
+        be checked. The candidates still have to be checked with matches."""
+        return self.root.candidates(field_indexes)
+
+    @staticmethod
+    def _compile(expression):
+        if not isinstance(expression, dict):
+            raise ValidationException("Invalid filter: an expression must be an object.")
+        children = []
+        for key, value in expression.items():
+            if key in {"$and", "$or"}:
+                if not isinstance(value, list) or not value:
+                    raise ValidationException(f"Invalid filter: {key} takes a non-empty list of expressions.")
+                nodes = [Filter._compile(item) for item in value]
+                children.append(And(nodes) if key == "$and" else Or(nodes))
+            elif key.startswith("$"):
+                raise ValidationException(f"Invalid filter: unknown operator {key}.")
+            elif isinstance(value, dict) and value and all(operator.startswith("$") for operator in value):
+                children.extend(Filter._condition(key, operator, operand) for operator, operand in value.items())
+            else:
+                children.append(Condition(key, "$eq", value))
+        return children[0] if len(children) == 1 else And(children)
+
+    @staticmethod
+    def _condition(path: str, operator: str, operand) -> Condition:
+        if operator not in COMPARISONS:
+            raise ValidationException(f"Invalid filter: unknown operator {operator}.")
+        if operator == "$in" and not isinstance(operand, list):
+            raise ValidationException("Invalid filter: $in takes a list.")
+        if operator in RANGE_OPERATORS and not (_is_number(operand) or isinstance(operand, str)):
+            raise ValidationException(f"Invalid filter: {operator} takes a number or a string.")
+        return Condition(path, operator, operand)
+
+
+class FieldEquals:
+    """Predicate of the searches by field: the field of the documents' data is equal to the value, compared as
+    strings like in FieldIndex."""
+
+    def __init__(self, field: str, value):
+        self.field = field
+        self.value = value
+
+    def matches(self, document: dict) -> bool:
+        data = document["data"]
+        return self.field in data and str(data[self.field]) == self.value
+
+
+def project(document: dict, fields: list) -> dict:
+    """returns the document with only the given keys of its data, the keys that the data doesn't have are left out"""
+    data = document.get("data", {})
+    return {"data": {field: data[field] for field in fields if field in data}, "_document_id": document["_document_id"]}
+
+
+def _group_key(value):
+    """hashable key of a value of a group-by field, equal for values that are equal in filters: 1 and 1.0 are in the
+    same group, 1, "1" and true are not"""
+    if _is_number(value):
+        return "number", value
+    if isinstance(value, (dict, list)):
+        return "json", json.dumps(value, sort_keys=True)
+    return type(value).__name__, value
+
+
+class Aggregation:
+    """Aggregates of the documents' data, computed in one pass over the documents and grouped by fields.
+
+    group_by lists the paths of the fields to group by, dotted like in Filter. Documents that don't have a field are
+    grouped under null. aggregates lists "count" and "<function>:<path>" with the functions sum, avg, min and max:
+        ["count", "sum:atoms", "max:properties.weight"]
+    sum and avg only take numbers into account. min and max compare numbers with numbers and strings with strings,
+    numbers come before strings. They are null for a group without such values.
+    """
+
+    def __init__(self, group_by: list, aggregates: list):
+        self.group_by = group_by
+        # (name in the result, function, path)
+        self.aggregates = [Aggregation._parse(aggregate) for aggregate in aggregates]
+        if not self.aggregates:
+            raise ValidationException("Invalid aggregation: at least one aggregate is needed.")
+        # group key -> (values of the group-by fields, state of every aggregate), in the order they were found
+        self._groups = {}
+
+    @staticmethod
+    def _parse(aggregate: str) -> tuple:
+        function, _, path = aggregate.partition(":")
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValidationException(f"Invalid aggregation: unknown function {function}.")
+        if (function == "count") != (path == ""):
+            raise ValidationException(f"Invalid aggregation: {aggregate}, only count doesn't take a field.")
+        return aggregate, function, path
+
+    def counts_only(self) -> bool:
+        return all(function == "count" for _, function, _ in self.aggregates)
+
+    def _group(self, data: dict) -> list:
+        values = [_resolve(data, path) for path in self.group_by]
+        values = [None if value is _MISSING else value for value in values]
+        key = tuple(_group_key(value) for value in values)
+        if key not in self._groups:
+            self._groups[key] = (values, [0 if function == "count" else (0, 0) if function in {"sum", "avg"}
+                                          else None for _, function, _ in self.aggregates])
+        return self._groups[key][1]
+
+    def add(self, document: dict):
+        data = document.get("data", {})
+        state = self._group(data)
+        for i, (_, function, path) in enumerate(self.aggregates):
+            if function == "count":
+                state[i] += 1
+                continue
+            value = _resolve(data, path)
+            if function in {"sum", "avg"}:
+                if _is_number(value):
+                    state[i] = (state[i][0] + value, state[i][1] + 1)
+            elif _is_number(value) or isinstance(value, str):
+                # numbers are ranked before strings, so they are never compared with each other
+                ranked = (isinstance(value, str), value)
+                if state[i] is None or (ranked < state[i] if function == "min" else ranked > state[i]):
+                    state[i] = ranked
+
+    def add_count(self, document: dict, count: int):
+        """counts count documents in the group of the document at once, for aggregations with counts_only"""
+        state = self._group(document.get("data", {}))
+        for i in range(len(state)):
+            state[i] += count
+
+    def result(self) -> dict:
+        """{"groups": [{"key": {<group-by field>: <value>}, <aggregate>: <result>, ...}, ...]}"""
+        groups = []
+        for values, state in self._groups.values():
+            group = {"key": dict(zip(self.group_by, values))}
+            for (name, function, _), aggregate in zip(self.aggregates, state):
+                if function == "sum":
+                    aggregate = aggregate[0]
+                elif function == "avg":
+                    aggregate = aggregate[0] / aggregate[1] if aggregate[1] else None
+                elif function in {"min", "max"} and aggregate is not None:
+                    aggregate = aggregate[1]
+                group[name] = aggregate
+            groups.append(group)
+        return {"groups": groups}
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import tempfile
+import threading
+
+import httpx
+from fastapi.responses import Response
+
+from .service import CollectionService
+
+# header of the responses to writes on the leader: the lsn that a follower must reach to serve the write
+LSN_HEADER = "X-Replication-Lsn"
+# methods of the requests that a follower forwards to its leader
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+# headers that describe one connection, they are not copied between the forwarded request and response
+HOP_HEADERS = {"host", "connection", "content-length", "content-encoding", "transfer-encoding", "keep-alive"}
+
+
+class Follower:
+    """Keeps the collections of a follower up to date with the ones of its leader.
+
+    A background thread long-polls GET /replication/log of the leader for the write-ahead log entries after the last
+    lsn of the service, and applies them (see CollectionService.apply_log_entries). When the leader has already
+    checkpointed them away, it answers 410 and the follower restores GET /replication/snapshot before polling again.
+
+    The follower serves the reads itself and forwards the writes to the leader (see forward). A forwarded write is
+    answered once the follower applied it, so a client of the follower reads its own writes.
+    """
+
+    def __init__(self, service: CollectionService, leader_url: str, wait_ms: int = 1000, batch_size: int = 1000,
+                 write_timeout: float = 5.0):
+        self.service = service
+        self.leader_url = leader_url.rstrip("/")
+        # how long the leader holds a poll that has no entry to return yet
+        self.wait_ms = wait_ms
+        self.batch_size = batch_size
+        # how long a forwarded write waits to be applied on the follower
+        self.write_timeout = write_timeout
+        self._stopped = threading.Event()
+        self._thread = None
+        # client of the forwarded writes, created in the event loop of the app
+        self._client = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._replicate, name="replication", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._client is not None:
+            await self._client.aclose()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, self.wait_ms / 1000 + 1)
+
+    def _replicate(self):
+        with httpx.Client(base_url=self.leader_url, timeout=self.wait_ms / 1000 + 10) as client:
+            while not self._stopped.is_set():
+                try:
+                    self.poll(client)
+                except Exception:
+                    logging.exception(f"Replication from {self.leader_url} failed, retrying")
+                    self._stopped.wait(1)
+
+    def poll(self, client: httpx.Client) -> int:
+        """Applies the next entries of the leader, restoring a snapshot first if needed. Returns the number of
+        entries received."""
+        response = client.get("/replication/log", params={"after": self.service.last_lsn, "limit": self.batch_size,
+                                                          "wait_ms": self.wait_ms})
+        if response.status_code == 410:
+            self.catch_up(client)
+            return 0
+        response.raise_for_status()
+        entries = response.json()["entries"]
+        self.service.apply_log_entries(entries)
+        return len(entries)
+
+    def catch_up(self, client: httpx.Client):
+        """Replaces the collections of the follower with a snapshot of the leader."""
+        with tempfile.TemporaryFile() as file:
+            with client.stream("GET", "/replication/snapshot") as response:
+                response.raise_for_status()
+                for chunk in response.iter_raw():
+                    file.write(chunk)
+            file.seek(0)
+            lsn = self.service.restore_snapshot(file)
+        logging.info(f"Restored a snapshot of {self.leader_url} at lsn {lsn}")
+
+    async def forward(self, request) -> Response:
+        """Sends the request to the leader, and answers with its response once the write is applied here."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.leader_url, timeout=30)
+        response = await self._client.request(
+            request.method, request.url.path, params=request.query_params, content=await request.body(),
+            headers={key: value for key, value in request.headers.items() if key.lower() not in HOP_HEADERS})
+        lsn = response.headers.get(LSN_HEADER)
+        if lsn is not None and not await asyncio.to_thread(self.service.wait_for_lsn, int(lsn), self.write_timeout):
+            logging.warning(f"Write forwarded to {self.leader_url} was not replicated within {self.write_timeout}s")
+        return Response(response.content, response.status_code,
+                        headers={key: value for key, value in response.headers.items()
+                                 if key.lower() not in HOP_HEADERS})
@@ -0,0 +1,294 @@
+import json
+import os
+import tempfile
+
+from fastapi import APIRouter, Depends, Header, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import ValidationError
+from starlette.background import BackgroundTask
+from .exception import ValidationException
+from .replication import LSN_HEADER
+from .schemas import CreateCollection, CreateDocument, CreateIndex
+from .service import CollectionService
+from .dependencies import get_service, get_snapshot_directory
+
+# Endpoints of the "sync" SERVICE_MODE, Starlette runs them in its threadpool. async_routes has the same endpoints
+# for the "async" mode.
+router = APIRouter()
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JSON_MEDIA_TYPE = "application/json"
+
+
+class CodecJSONResponse(JSONResponse):
+    """JSONResponse encoded with the codec of the service (Config.CODEC), the default response class of the app."""
+
+    def render(self, content) -> bytes:
+        return get_service().codec.dumps(content)
+
+
+def raw_documents_response(documents) -> Response:
+    """{"documents": [...]} joined from encoded documents, which are sent as they are stored"""
+    return Response(b'{"documents": [' + b", ".join(documents) + b"]}", media_type=JSON_MEDIA_TYPE)
+
+
+@router.post("/collections", status_code=201)
+def create_collection(collection: CreateCollection, service: CollectionService = Depends(get_service)) -> dict:
+    service.create_collection(collection.name, collection.format, collection.shards)
+    return {"message": "Collection created successfully"}
+
+
+@router.get("/collections", status_code=200)
+def get_collections(service: CollectionService = Depends(get_service)) -> dict:
+    return {"collections": service.get_collections()}
+
+
+@router.get("/collections/{collection_name}", status_code=200)
+def get_collection(collection_name: str, service: CollectionService = Depends(get_service)) -> dict:
+    return service.get_collection(collection_name)
+
+
+@router.delete("/collections/{collection_name}", status_code=200)
+def delete_collection(collection_name: str, service: CollectionService = Depends(get_service)) -> dict:
+    service.delete_collection(collection_name)
+    return {"message": "Collection deleted successfully"}
+
+
+@router.put("/collections/{collection_name}", status_code=200)
+def update_collection(collection_name: str, new_collection: CreateCollection,
+                      service: CollectionService = Depends(get_service)) -> dict:
+    # the format is only compared with the current one if it is given
+    service.update_collection(collection_name, new_collection.dict(exclude_unset=True))
+    return {"message": "Collection updated successfully"}
+
+
+@router.post("/collections/{collection_name}/documents", status_code=201)
+def create_document(collection_name: str, document: CreateDocument,
+                    service: CollectionService = Depends(get_service)) -> dict:
+    document_id = service.add_document(collection_name, document.dict())
+    """
+    :param document: should be of the form {"data": {"field1": "value1", "field2": "value2"}}
+                    so "data" dictionary is a required field
+    """
+    return {"message": "Document created successfully", "_document_id": document_id}
+
+
+async def read_body(request: Request) -> bytes:
+    return await request.body()
+
+
+def parse_documents(body: bytes, content_type: str | None) -> list:
+    """Parses a JSON array of documents, or one document per line if the content type is application/x-ndjson."""
+    try:
+        if content_type and NDJSON_MEDIA_TYPE in content_type:
+            documents = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            documents = json.loads(body)
+    except ValueError:
+        raise ValidationException("Body is not valid JSON.")
+    if not isinstance(documents, list):
+        raise ValidationException("Body must be a JSON array of documents.")
+
+    for i, document in enumerate(documents):
+        try:
+            documents[i] = CreateDocument.model_validate(document).dict()
+        except ValidationError as e:
+            raise ValidationException(f"Document {i} is invalid: {e.errors()[0]['msg']}")
+    return documents
+
+
+@router.post("/collections/{collection_name}/documents/bulk", status_code=201)
+def create_documents(collection_name: str, body: bytes = Depends(read_body),
+                     content_type: str | None = Header(default=None),
+                     service: CollectionService = Depends(get_service)) -> dict:
+    """
+    :param body: either a JSON array of documents, or with "Content-Type: application/x-ndjson" one document per line.
+                 Every document should be of the form {"data": {...}}, like in create_document
+    """
+    document_ids = service.add_documents(collection_name, parse_documents(body, content_type))
+    return {"message": "Documents created successfully", "_document_ids": document_ids}
+
+
+@router.get("/collections/{collection_name}/documents/{document_id}", status_code=200)
+def get_document(collection_name: str, document_id: str, fields: str | None = None,
+                 service: CollectionService = Depends(get_service)) -> dict:
+    # the document is sent as it is stored, without being parsed and encoded again, unless fields are given
+    return Response(service.get_document_raw(collection_name, document_id, parse_fields(fields)),
+                    media_type=JSON_MEDIA_TYPE)
+
+
+def parse_list(value: str | None, name: str):
+    """parses a comma-separated query parameter, None if it is not given"""
+    if value is None:
+        return None
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if not items:
+        raise ValidationException(f"{name} must not be empty.")
+    return items
+
+
+def parse_fields(fields: str | None):
+    """parses the fields query parameter, the keys of the data to return"""
+    return parse_list(fields, "Fields")
+
+
+def parse_filter(filter_expression: str | None, field: str | None):
+    """parses the filter query parameter, a JSON object that is compiled by the service, None if it is not given"""
+    if filter_expression is None:
+        return None
+    if field:
+        raise ValidationException("Use either filter, or field and value.")
+    try:
+        return json.loads(filter_expression)
+    except ValueError:
+        raise ValidationException("Filter is not valid JSON.")
+
+
+def ndjson_lines(documents):
+    """lines of the encoded documents"""
+    for document in documents:
+        yield document + b"\n"
+
+
+@router.get("/collections/{collection_name}/documents", status_code=200)
+def get_documents(collection_name: str,
+                  field=None, value=None, filter_expression: str | None = Query(default=None, alias="filter"),
+                  fields: str | None = None, stream: bool = False,
+                  limit: int | None = Query(default=None, gt=0), cursor: str | None = None,
+                  accept: str | None = Header(default=None),
+                  service: CollectionService = Depends(get_service)) -> dict:
+    """
+    With ?filter= only the documents that match the filter, a JSON object like {"atoms": {"$gt": 3}}, are returned,
+    see query.Filter for its syntax. It can't be combined with field and value.
+
+    With ?stream=true or "Accept: application/x-ndjson" the documents are streamed one per line as they are read,
+    instead of being collected into {"documents": [...]}.
+
+    With ?fields=name,atoms only these keys of the data of the documents are returned, with their _document_id.
+
+    With limit (and cursor) one page is returned as {"documents": [...], "next_cursor": "..."}, pass next_cursor back
+    as cursor to get the next page. Pages are not streamed.
+
+    Except for pages and projections on fields, the documents are sent as they are stored, without being parsed and
+    encoded again.
+    """
+    expression = parse_filter(filter_expression, field)
+    keys = parse_fields(fields)
+    if limit is not None or cursor is not None:
+        if expression is not None:
+            return service.find_documents_by_filter_page(collection_name, expression, limit, cursor, keys)
+        if field and value:
+            return service.find_documents_by_field_page(collection_name, field, value, limit, cursor, keys)
+        return service.get_documents_page(collection_name, limit, cursor, keys)
+    if expression is not None:
+        documents = service.iter_documents_by_filter_raw(collection_name, expression, keys)
+    elif field and value:
+        documents = service.iter_documents_by_field_raw(collection_name, field, value, keys)
+    else:
+        documents = service.iter_documents_raw(collection_name, keys)
+    if stream or (accept and NDJSON_MEDIA_TYPE in accept):
+        return StreamingResponse(ndjson_lines(documents), media_type=NDJSON_MEDIA_TYPE)
+    return raw_documents_response(documents)
+
+
+@router.get("/collections/{collection_name}/aggregate", status_code=200)
+def aggregate(collection_name: str, group_by: str | None = None, aggregates: str = "count",
+              filter_expression: str | None = Query(default=None, alias="filter"),
+              service: CollectionService = Depends(get_service)) -> dict:
+    """
+    Aggregates of the documents, e.g. ?group_by=kind&aggregates=count,sum:atoms,max:properties.weight gives
+    {"groups": [{"key": {"kind": "gas"}, "count": 2, "sum:atoms": 8, "max:properties.weight": 16.04}, ...]}.
+    group_by and aggregates are comma-separated, see query.Aggregation. ?filter= restricts the documents, like in
+    get_documents.
+    """
+    return service.aggregate(collection_name, parse_list(group_by, "Group by"), parse_list(aggregates, "Aggregates"),
+                             parse_filter(filter_expression, None))
+
+
+@router.delete("/collections/{collection_name}/documents/{document_id}", status_code=200)
+def delete_document(collection_name: str, document_id: str, service: CollectionService = Depends(get_service)) -> dict:
+    service.delete_document(collection_name, document_id)
+    return {"message": "Document deleted successfully"}
+
+
+@router.put("/collections/{collection_name}/documents/{document_id}", status_code=200)
+def update_document(collection_name: str, document_id: str, new_document: CreateDocument,
+                    service: CollectionService = Depends(get_service)) -> dict:
+    service.update_document(collection_name, document_id, new_document.dict())
+    return {"message": "Document updated successfully"}
+
+
+@router.post("/collections/{collection_name}/indexes", status_code=201)
+def create_index(collection_name: str, index: CreateIndex, service: CollectionService = Depends(get_service)) -> dict:
+    service.create_index(collection_name, index.field)
+    return {"message": "Index created successfully"}
+
+
+@router.get("/collections/{collection_name}/indexes", status_code=200)
+def get_indexes(collection_name: str, service: CollectionService = Depends(get_service)) -> dict:
+    return {"indexes": service.get_indexes(collection_name)}
+
+
+@router.delete("/collections/{collection_name}/indexes/{field}", status_code=200)
+def delete_index(collection_name: str, field: str, service: CollectionService = Depends(get_service)) -> dict:
+    service.delete_index(collection_name, field)
+    return {"message": "Index deleted successfully"}
+
+
+@router.get("/cache", status_code=200)
+def get_cache_stats(service: CollectionService = Depends(get_service)) -> dict:
+    """hits, misses and evictions of the cache of the documents read by id, its number of entries and its size"""
+    return service.get_cache_stats()
+
+
+@router.delete("/collections", status_code=200)
+def clean_up(service: CollectionService = Depends(get_service)) -> dict:
+    service.clean_up()
+    return {"message": "All collections deleted successfully"}
+
+
+@router.get("/replication/log", status_code=200)
+def get_log_entries(after: int = Query(ge=0), limit: int = Query(default=1000, gt=0),
+                    wait_ms: int = Query(default=0, ge=0, le=60000),
+                    service: CollectionService = Depends(get_service)) -> dict:
+    """
+    Write-ahead log entries of the mutations after the lsn after, polled by the followers (see replication). If there
+    is none yet, the request waits up to wait_ms for one. Answers 410 if the entries were checkpointed away, the
+    follower has to restore /replication/snapshot first.
+    """
+    return {"entries": service.get_log_entries(after, limit, wait_ms / 1000)}
+
+
+def snapshot_path() -> str:
+    """path of a new temporary file for a snapshot"""
+    file, path = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(file)
+    return path
+
+
+def snapshot_response(path: str, lsn: int) -> FileResponse:
+    """sends the snapshot at path, which is deleted once it is sent"""
+    return FileResponse(path, media_type="application/gzip", headers={LSN_HEADER: str(lsn)},
+                        background=BackgroundTask(os.remove, path))
+
+
+@router.get("/replication/snapshot", status_code=200)
+def get_snapshot(service: CollectionService = Depends(get_service)):
+    """Consistent snapshot of the collections as a tar.gz archive, for the followers that fell behind."""
+    path = snapshot_path()
+    try:
+        with open(path, "wb") as file:
+            lsn = service.write_snapshot(file)
+    except BaseException:
+        os.remove(path)
+        raise
+    return snapshot_response(path, lsn)
+
+
+@router.post("/admin/snapshot", status_code=201)
+def create_snapshot(service: CollectionService = Depends(get_service),
+                    directory: str = Depends(get_snapshot_directory)) -> dict:
+    """Writes a consistent snapshot of the collections, with their indexes, to a new tar.gz archive in
+    SNAPSHOT_DIRECTORY. Writers only wait while the files are opened, not while they are copied. The archive can be
+    restored with python -m src.snapshot restore."""
+    return service.save_snapshot(directory)
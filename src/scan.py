@@ -0,0 +1,71 @@
+import array
+import contextvars
+import functools
+import itertools
+import math
+import mmap
+
+from . import metrics
+from .codec import get_codec
+from .storage import DocumentLog, FORMATS
+
+
+def scan_records(path: str, record_format: str, codec_name: str, locations: array.array, query, raw: bool) -> list:
+    """Runs in a scan process: returns (offset, document) of the records at the locations (offset and length pairs,
+    in file order) of the file at path that match the query. The documents are given as JSON with raw."""
+    record_format = FORMATS[record_format](get_codec(codec_name))
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    matches = []
+    with data:
+        for offset, length in zip(locations[::2], locations[1::2]):
+            record = data[offset:offset + length]
+            document = record_format.decode(record)
+            if query.matches(document):
+                matches.append((offset, record_format.to_json(record) if raw else document))
+    return matches
+
+
+def submit_scan(executor, log: DocumentLog, query, after: int = -1, raw: bool = False, chunks: int = 1) -> list:
+    """Submits the scan of the live records of the log after the offset to the processes of executor, split into
+    chunks of consecutive records. Only the matching records come back from the processes, see scan_records. Returns
+    the futures of the chunks, in file order. The query must be picklable, like Filter and FieldEquals.
+
+    The log waits for the futures before its file is renamed, replaced or removed, see DocumentLog.wait_for_scans.
+    """
+    locations = sorted(location for location in log.index.values() if location[0] > after)
+    size = max(1, math.ceil(len(locations) / chunks))
+    futures = []
+    for start in range(0, len(locations), size):
+        chunk = locations[start:start + size]
+        future = executor.submit(scan_records, log.path, log.format.name, log.codec.name,
+                                 array.array("q", itertools.chain.from_iterable(chunk)), query, raw)
+        log.scan_started()
+        future.add_done_callback(log.scan_finished)
+        # the callbacks run in a thread of the executor, in a copy of the context to be traced with the request
+        future.add_done_callback(functools.partial(contextvars.copy_context().run, _count_scanned, chunk))
+        futures.append(future)
+    return futures
+
+
+def _count_scanned(chunk: list, future):
+    if not future.cancelled() and future.exception() is None:
+        metrics.BYTES_READ.inc(sum(length for _, length in chunk))
+        metrics.DOCUMENTS_SCANNED.inc(len(chunk))
+        metrics.DOCUMENTS_RETURNED.inc(len(future.result()))
+
+
+def iter_results(futures: list):
+    """Yields the results of the futures, in order, as each one is done. The futures that are left are cancelled
+    when the generator is closed, like when a page is full or a stream is closed."""
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def parallel_scan(executor, log: DocumentLog, query, after: int = -1, raw: bool = False, chunks: int = 1):
+    """iter_entries_where(query.matches) of the log, computed by the processes of executor, see submit_scan"""
+    return iter_results(submit_scan(executor, log, query, after, raw, chunks))
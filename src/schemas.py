@@ -4,11 +4,16 @@ from .exception import ValidationException
 
 class CreateCollection(BaseModel):
     name: str
+    # record format of the collection file, "json" (one JSON document per line) or "binary" (length-prefixed records)
+    format: str = "json"
+    # number of files the documents are spread over, searches that read every document scan them in parallel
+    shards: int = 1
 
     class Config:
         json_schema_extra = {
             "example": {
-                "name": "molecules"
+                "name": "molecules",
+                "format": "json"
             }
         }
 
@@ -38,3 +43,14 @@ class CreateDocument(BaseModel):
                 }
             }
         }
+
+
+class CreateIndex(BaseModel):
+    field: str
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "field": "smiles"
+            }
+        }
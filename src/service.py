@@ -1,21 +1,101 @@
+import base64
+import binascii
+import io
+import itertools
 import logging
+import math
+import multiprocessing
 import os
 import json
+import shutil
+import tarfile
+import threading
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
 
-from .exception import NoSuchCollectionException, CollectionAlreadyExistsException, NoSuchDocumentException
+from . import metrics
+from .exception import NoSuchCollectionException, CollectionAlreadyExistsException, NoSuchDocumentException, \
+    IndexAlreadyExistsException, NoSuchIndexException, ValidationException, SnapshotRequiredException
+from .cache import LRUCache
+from .codec import get_codec
+from .index import FieldIndex
+from .locks import ReadWriteLock
+from .query import Aggregation, FieldEquals, Filter, project
+from .scan import parallel_scan
+from .shards import MAX_SHARDS, ShardedLog, shard_paths
+from .storage import DocumentLog, generation_path, index_checkpoint_path, index_fields_path, FORMATS, DEFAULT_FORMAT
+from .wal import WriteAheadLog
+
+# write-ahead log operations that change the catalog, the others change the documents of a collection
+COLLECTION_OPS = {"create_collection", "delete_collection", "update_collection", "convert_collection", "clean_up"}
 
 
 class CollectionService:
     """
     TODO: FIX Potential bug: It is possible to create a collection with the name "collections" which will overwrite the collections.json file.
-    TODO: This implementation is not efficient. We don't use memory to store the collections at all.
-    TODO: Currently every deletion removes the entry from the file and shifts the rest of the entries. This is bad. Fix it.
     TODO: Fixed fields like collection name, document id, are not validated.
+
+    Collection files are append-only logs (see DocumentLog). Updates and deletions append a new version or a tombstone
+    of the document, and the file is compacted in a background thread once the ratio of dead records in it reaches
+    compaction_ratio.
+
+    The service is shared by the request threads. Every collection has a ReadWriteLock: reads of a collection run in
+    parallel, writes to it are serialized, and collections don't wait for each other. The catalog lock protects the
+    catalog and collections.json, it is always taken after the lock of a collection, never before.
+
+    Every mutation is first written to the write-ahead log (see WriteAheadLog), then applied to the files, and the
+    call returns once the entry is committed according to wal_fsync. The entries after the last checkpoint are
+    replayed on startup:
+    - collections.json records the lsn of the last collection-level mutation (create, delete, rename, clean up)
+      applied to it, the ones up to it are skipped. These mutations change the collection files first and the catalog
+      last, so a mutation that was interrupted is applied again from the start.
+    - a document-level entry sets the version of documents, so it has no effect if it already reached the file. It is
+      applied to the collection under the name the collection has now, following the renames that were already
+      applied after it.
+
+    Startup only reads the catalog and replays the write-ahead log, which is empty after close. A collection is
+    opened on first access, and its indexes are loaded from the index checkpoint (see DocumentLog) that checkpoint
+    and close write for the collections that changed. Only the records appended after the checkpoint are read, and a
+    collection whose checkpoint is missing or stale is indexed from its records.
+
+    Documents and write-ahead log entries are encoded with the JSON codec named by codec (see codec.get_codec). The
+    *_raw read methods return documents as JSON bytes, for callers that send them as they are. In the JSON format
+    these are the bytes stored in the collection file.
+
+    Every collection has a record format (see storage.FORMATS), chosen when it is created. The catalog only records
+    the format of the collections that don't use the default JSON format, and convert_collection rewrites a
+    collection in another format.
+
+    The service of a leader serves its write-ahead log and snapshots of its collections to followers, the service of
+    a follower applies them (see replication). A follower's write-ahead log holds the entries of the leader with their
+    lsn on the leader, so last_lsn is how far the follower got. Index creations and deletions are logged too, so the
+    followers get the same indexes.
+
+    A collection can be split into shards when it is created (see ShardedLog): its documents are spread over several
+    files by a hash of their id. The searches that read every document of a sharded collection, or of a collection
+    file of at least parallel_scan_bytes, are parallel: the records are parsed and filtered in chunks by a pool of
+    scan_processes processes (every core by default), see scan. The pool is only started when it is first needed.
+
+    Single documents that are read are kept in an LRU cache of cache_bytes (see LRUCache), so repeated reads of a
+    document don't read the file. Every mutation invalidates the cached documents it changes, under the write lock of
+    the collection, and documents are only cached under its read lock, so the cache never serves a stale document.
     """
 
-    def __init__(self, base_path: str):
+    def __init__(self, base_path: str, compaction_ratio: float = 0.5, wal_fsync: str = "always",
+                 wal_fsync_interval_ms: int = 100, wal_checkpoint_bytes: int = 64 * 1024 * 1024,
+                 codec: str = "auto", cache_bytes: int = 64 * 1024 * 1024, scan_processes: int = None,
+                 parallel_scan_bytes: int = 32 * 1024 * 1024):
         self.base_path = base_path
+        self.scan_processes = scan_processes or os.cpu_count()
+        # 0 disables the parallel scans of collections that are not sharded
+        self.parallel_scan_bytes = parallel_scan_bytes
+        self._scan_executor = None
+        self.codec = get_codec(codec)
+        self._cache = LRUCache(cache_bytes)
+        self.compaction_ratio = compaction_ratio
+        self.wal_checkpoint_bytes = wal_checkpoint_bytes
         self.collections_dir_path = os.path.join(self.base_path, "collections")
         self.collections_file_path = os.path.join(self.collections_dir_path, "collections.json")
 
@@ -32,188 +112,1076 @@ class CollectionService:
             with open(self.collections_file_path, "w") as file:
                 file.write("")
 
-    def exists_by_name(self, collection_name: str):
+        # In-memory catalog of the collections, keyed by name. collections.json is read only once, here, and is
+        # rewritten from this dict whenever a collection is created, deleted, renamed or converted, and at every
+        # checkpoint. The sizes of the collections are only saved by the checkpoints, the replay of the write-ahead
+        # log entries after the last one sets them again.
+        self._collections = {}
+        # lsn of the last collection-level write-ahead log entry applied to the catalog
+        self._catalog_lsn = 0
+        self._catalog_lock = threading.RLock()
+        # Lock of every collection, keyed by name
+        self._locks = {}
+        self._load_catalog()
+
+        # Document logs of the collections, opened (and indexed) on first access
+        self._logs = {}
+        # Names of the collections that are being compacted in the background
+        self._compacting = set()
+        self._compaction_lock = threading.Lock()
+
+        self._wal = WriteAheadLog(os.path.join(self.base_path, "wal"), fsync=wal_fsync,
+                                  fsync_interval_ms=wal_fsync_interval_ms, codec=self.codec)
+        self._checkpoint_lock = threading.Lock()
+        self._checkpointing = False
+        self._replay_wal()
+
+    def _load_catalog(self):
         # at this point we are sure that the collections.json file exists
         with open(self.collections_file_path, "r") as file:
             for line in file:
                 if line.strip():  # Ensure the line is not empty
                     collection = json.loads(line)
-                    if collection["name"] == collection_name:
-                        return True
-        return False
+                    if "_lsn" in collection:
+                        self._catalog_lsn = collection["_lsn"]
+                        continue
+                    self._collections[collection["name"]] = collection
+                    self._locks[collection["name"]] = ReadWriteLock()
 
-    def create_collection(self, collection_name: str) -> None:
-        if self.exists_by_name(collection_name):
-            raise CollectionAlreadyExistsException(collection_name)
+    def _save_catalog(self):
+        # must be called with the catalog lock held. The catalog is written next to collections.json, fsynced and
+        # moved over it, so a crash can't leave a truncated catalog
+        catalog_path = self.collections_file_path + ".tmp"
+        with open(catalog_path, "w") as file:
+            file.write(self._catalog_text(self._catalog_lsn))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(catalog_path, self.collections_file_path)
+        self._fsync_collections_directory()
+
+    def _fsync_collections_directory(self):
+        directory = os.open(self.collections_dir_path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _catalog_text(self, lsn: int) -> str:
+        lines = [json.dumps({"_lsn": lsn})] if lsn else []
+        lines += [json.dumps(collection) for collection in self._collections.values()]
+        return "".join(line + "\n" for line in lines)
+
+    def exists_by_name(self, collection_name: str):
+        return collection_name in self._collections
 
+    def _collection_format(self, collection_name: str) -> str:
+        return self._collections[collection_name].get("format", DEFAULT_FORMAT)
+
+    def _collection_shards(self, collection_name: str) -> int:
+        return self._collections[collection_name].get("shards", 1)
+
+    def _collection_file_path(self, collection_name: str, collection_format: str = None) -> str:
+        """returns the path of the file of the collection, in the format it has in the catalog by default. The files
+        of the shards of a sharded collection are named after it, see shard_paths."""
+        collection_format = collection_format or self._collection_format(collection_name)
+        return os.path.join(self.collections_dir_path, collection_name + FORMATS[collection_format].extension)
+
+    def _collection_files(self, collection_name: str) -> list:
+        """returns the paths of every file of the collection: the file of each shard, its indexed fields and its
+        index checkpoint. The checkpoints come first, so that a checkpoint is never left without its file."""
+        paths = shard_paths(self._collection_file_path(collection_name), self._collection_shards(collection_name))
+        return [index_checkpoint_path(path) for path in paths] + paths + \
+            [file_path for path in paths for file_path in (index_fields_path(path), generation_path(path))]
+
+    @contextmanager
+    def _locked(self, collection_name: str, write: bool = False, open_log: bool = True):
+        """Holds the read (or the write) lock of the collection and gives its document log.
+
+        Opening a log builds its indexes, so a log is always opened under the write lock. If the collection is
+        renamed or deleted while waiting for its lock, the lock is looked up again, which raises
+        NoSuchCollectionException if the collection is gone.
+        """
+        while True:
+            lock = self._locks.get(collection_name)
+            if lock is None:
+                raise NoSuchCollectionException(collection_name)
+            if write or (open_log and collection_name not in self._logs):
+                with lock.write():
+                    if self._locks.get(collection_name) is not lock:
+                        continue
+                    if open_log:
+                        self._open_log(collection_name)
+                    if write:
+                        yield self._logs.get(collection_name)
+                        return
+                # the log is open now, take the read lock
+                continue
+            with lock.read():
+                if self._locks.get(collection_name) is not lock:
+                    continue
+                yield self._logs.get(collection_name)
+                return
+
+    def _open_log(self, collection_name: str) -> DocumentLog:
+        """returns the document log of the collection, opened if it isn't yet. The caller holds the write lock of the
+        collection, or is the only thread, like during the replay."""
+        if collection_name not in self._logs:
+            path, shards = self._collection_file_path(collection_name), self._collection_shards(collection_name)
+            collection_format = self._collection_format(collection_name)
+            self._logs[collection_name] = DocumentLog(path, self.codec, collection_format) if shards == 1 else \
+                ShardedLog(path, shards, self.codec, collection_format)
+        return self._logs[collection_name]
+
+    @contextmanager
+    def _locked_all(self):
+        """Holds the write lock of every collection, then the catalog lock, so that no mutation is in progress.
+
+        The locks are taken in the same order by every caller, which the order of the catalog isn't, as a renamed
+        collection moves to its end. Otherwise two callers could each hold a lock that the other waits for.
+        """
+        while True:
+            with ExitStack() as stack:
+                with self._catalog_lock:
+                    locks = sorted(self._locks.values(), key=id)
+                for lock in locks:
+                    stack.enter_context(lock.write())
+                stack.enter_context(self._catalog_lock)
+                # a collection created while waiting for the locks may be written to, wait for it as well
+                if set(self._locks.values()) == set(locks):
+                    yield
+                    return
+
+    @metrics.timed
+    def create_collection(self, collection_name: str, collection_format: str = DEFAULT_FORMAT,
+                          shards: int = 1) -> None:
+        """collection_format is the record format of the collection file, see storage.FORMATS. shards is the number
+        of files that the documents are spread over, see ShardedLog."""
+        self._validate_format(collection_format)
+        if not 1 <= shards <= MAX_SHARDS:
+            raise ValidationException(f"Shards must be between 1 and {MAX_SHARDS}.")
+        with self._catalog_lock:
+            if self.exists_by_name(collection_name):
+                raise CollectionAlreadyExistsException(collection_name)
+
+            entry = {"op": "create_collection", "collection": collection_name, "format": collection_format}
+            if shards > 1:
+                entry["shards"] = shards
+            lsn = self._wal.append(entry)
+            self._apply_create_collection(collection_name, collection_format, lsn, shards)
+        self._commit(lsn)
+
+    @staticmethod
+    def _validate_format(collection_format: str):
+        if collection_format not in FORMATS:
+            raise ValidationException(f"Format must be one of: {', '.join(FORMATS)}.")
+
+    def _apply_create_collection(self, collection_name: str, collection_format: str, lsn: int, shards: int = 1):
         # This should also create the file with the same name as the collection
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "w") as file:
-            file.write("")
+        for path in shard_paths(self._collection_file_path(collection_name, collection_format), shards):
+            with open(path, "w") as file:
+                file.write("")
 
-        with open(self.collections_file_path, "a") as file:
-            file.write(json.dumps({"name": collection_name, "size": 0}) + "\n")
+        collection = {"name": collection_name, "size": 0}
+        if collection_format != DEFAULT_FORMAT:
+            collection["format"] = collection_format
+        if shards > 1:
+            collection["shards"] = shards
+        self._locks[collection_name] = ReadWriteLock()
+        self._collections[collection_name] = collection
+        self._catalog_lsn = lsn
+        self._save_catalog()
 
+    @metrics.timed
     def get_collection(self, collection_name: str):
-        with open(self.collections_file_path, "r") as file:
-            for line in file:
-                if line.strip():
-                    collection = json.loads(line)
-                    if collection["name"] == collection_name:
-                        return collection
-        raise NoSuchCollectionException(collection_name)
+        collection = self._collections.get(collection_name)
+        if collection is None:
+            raise NoSuchCollectionException(collection_name)
+        # return a copy, so that callers can't modify the catalog by accident
+        return dict(collection)
 
+    @metrics.timed
     def get_collections(self):
-        collections = []
-        with open(self.collections_file_path, "r") as file:
-            for line in file:
-                if line.strip():
-                    collections.append(json.loads(line))
-        return collections
+        with self._catalog_lock:
+            return [dict(collection) for collection in self._collections.values()]
 
+    @metrics.timed
     def delete_collection(self, collection_name: str):
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
-
-        collections = self.get_collections()
-        with open(self.collections_file_path, "w") as file:
-            for collection in collections:
-                if collection["name"] != collection_name:
-                    file.write(json.dumps(collection) + "\n")
+        with self._locked(collection_name, write=True, open_log=False), self._catalog_lock:
+            lsn = self._wal.append({"op": "delete_collection", "collection": collection_name})
+            self._apply_delete_collection(collection_name, lsn)
+        self._commit(lsn)
+        return None
 
+    def _apply_delete_collection(self, collection_name: str, lsn: int):
+        self._cache.invalidate_collection(collection_name)
+        self._wait_for_scans(collection_name)
         # Delete the file associated with the collection
-        os.remove(os.path.join(self.collections_dir_path, collection_name + ".json"))
-        return None
+        for path in self._collection_files(collection_name):
+            if os.path.exists(path):
+                os.remove(path)
+        self._logs.pop(collection_name, None)
+        del self._locks[collection_name]
 
+        del self._collections[collection_name]
+        self._catalog_lsn = lsn
+        self._save_catalog()
+
+    @metrics.timed
     def update_collection(self, collection_name: str, new_collection: dict):
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+        with self._locked(collection_name, write=True, open_log=False), self._catalog_lock:
+            if new_collection["name"] != collection_name and self.exists_by_name(new_collection["name"]):
+                raise CollectionAlreadyExistsException(new_collection["name"])
+            if new_collection.get("format", self._collection_format(collection_name)) != \
+                    self._collection_format(collection_name):
+                raise ValidationException("The format of a collection can only be changed by converting it.")
+            if new_collection.get("shards", self._collection_shards(collection_name)) != \
+                    self._collection_shards(collection_name):
+                raise ValidationException("The number of shards of a collection can't be changed.")
 
-        collections = self.get_collections()
-        with open(self.collections_file_path, "w") as file:
-            for collection in collections:
-                if collection["name"] == collection_name:
-                    file.write(json.dumps(new_collection) + "\n")
-                else:
-                    file.write(json.dumps(collection) + "\n")
+            lsn = self._wal.append({"op": "update_collection", "collection": collection_name,
+                                    "new_collection": new_collection})
+            self._apply_update_collection(collection_name, new_collection, lsn)
+        self._commit(lsn)
+        return None
 
+    def _apply_update_collection(self, collection_name: str, new_collection: dict, lsn: int):
         #         change the name of the file associated with the collection
-        os.rename(os.path.join(self.collections_dir_path, collection_name + ".json"),
-                  os.path.join(self.collections_dir_path, new_collection["name"] + ".json"))
-        return None
+        if new_collection["name"] != collection_name:
+            self._cache.invalidate_collection(collection_name)
+            # the files are already renamed if a replayed rename was interrupted before the catalog was saved
+            old_path = self._collection_file_path(collection_name)
+            new_path = self._collection_file_path(new_collection["name"], self._collection_format(collection_name))
+            shards = self._collection_shards(collection_name)
+            self._wait_for_scans(collection_name)
+            for old_shard, new_shard in zip(shard_paths(old_path, shards), shard_paths(new_path, shards)):
+                for old, new in ((index_checkpoint_path(old_shard), index_checkpoint_path(new_shard)),
+                                 (old_shard, new_shard), (index_fields_path(old_shard), index_fields_path(new_shard)),
+                                 (generation_path(old_shard), generation_path(new_shard))):
+                    if os.path.exists(old):
+                        os.rename(old, new)
+            log = self._logs.pop(collection_name, None)
+            if log is not None:
+                log.path = new_path
+                self._logs[new_collection["name"]] = log
+            # the lock moves with the collection, threads waiting for it under the old name will look it up again
+            self._locks[new_collection["name"]] = self._locks.pop(collection_name)
 
-    def exists_document(self, collection_name: str, document_id: str):
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+        # fields that are not given (e.g. size when the collection is only renamed) are kept
+        new_collection = {**self._collections[collection_name], **new_collection}
+        if new_collection.get("format") == DEFAULT_FORMAT:
+            del new_collection["format"]
+        if new_collection.get("shards") == 1:
+            del new_collection["shards"]
+        # rebuild the dict so that the renamed collection keeps its position in the catalog
+        self._collections = {
+            (new_collection["name"] if name == collection_name else name):
+                (new_collection if name == collection_name else collection)
+            for name, collection in self._collections.items()
+        }
+        self._catalog_lsn = lsn
+        self._save_catalog()
 
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "r") as file:
-            for line in file:
-                if line.strip():
-                    document = json.loads(line)
-                    if document["_document_id"] == str(document_id):
-                        return True
-        return False
+    @metrics.timed
+    def convert_collection(self, collection_name: str, collection_format: str):
+        """Rewrites the file of the collection in another record format.
+
+        The documents are written to a new file, which is made durable before the catalog switches to it, then the
+        old file is removed. Readers and writers of the collection wait for the conversion.
+        """
+        self._validate_format(collection_format)
+        with self._locked(collection_name, write=True) as log:
+            if self._collection_format(collection_name) == collection_format:
+                return
+            with self._catalog_lock:
+                lsn = self._wal.append({"op": "convert_collection", "collection": collection_name,
+                                        "format": collection_format})
+                self._apply_convert_collection(collection_name, collection_format, lsn, log)
+        self._commit(lsn)
+
+    def _apply_convert_collection(self, collection_name: str, collection_format: str, lsn: int, log: DocumentLog):
+        self._cache.invalidate_collection(collection_name)
+        old_paths = shard_paths(self._collection_file_path(collection_name), self._collection_shards(collection_name))
+        self._logs[collection_name] = log.convert(self._collection_file_path(collection_name, collection_format),
+                                                  collection_format)
+        if collection_format == DEFAULT_FORMAT:
+            self._collections[collection_name].pop("format", None)
+        else:
+            self._collections[collection_name]["format"] = collection_format
+        self._catalog_lsn = lsn
+        self._save_catalog()
+        log.wait_for_scans()
+        for old_path in old_paths:
+            for path in (index_checkpoint_path(old_path), generation_path(old_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+            os.remove(old_path)
+
+    def exists_document(self, collection_name: str, document_id: str):
+        with self._locked(collection_name) as log:
+            return str(document_id) in log
 
+    @metrics.timed
     def add_document(self, collection_name: str, document: dict) -> str:
         """returns the document_id of the added document"""
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+        return self.add_documents(collection_name, [document])[0]
 
-        document = CollectionService.__set_object_id(document)
+    @metrics.timed
+    def add_documents(self, collection_name: str, documents: list) -> list:
+        """Adds many documents with one write to the collection file.
 
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "a") as file:
-            file.write(json.dumps(document) + "\n")
+        returns the document_ids of the added documents, in the order of the documents
+        """
+        with self._locked(collection_name, write=True) as log:
+            documents = [CollectionService.__set_object_id(document) for document in documents]
+            # encoded before they are logged, so a document that can't be stored leaves no entry to replay
+            encoded = log.encode_many(documents)
+            lsn = self._wal.append({"op": "put_documents", "collection": collection_name, "documents": documents})
+            log.append_many(documents, encoded)
 
-        #         update the size of the collection
-        new_collection = self.get_collection(collection_name)
-        new_collection["size"] += 1
-        self.update_collection(collection_name, new_collection)
-        logging.debug(f"Added document to collection {collection_name}")
-        return document["_document_id"]
+            #         update the size of the collection
+            with self._catalog_lock:
+                self._collections[collection_name]["size"] += len(documents)
+        self._commit(lsn)
+        logging.debug(f"Added {len(documents)} documents to collection {collection_name}")
+        return [document["_document_id"] for document in documents]
 
-    def get_document(self, collection_name: str, document_id: str):
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+    @metrics.timed
+    def get_document(self, collection_name: str, document_id: str, fields: list = None):
+        """fields, like for every read method, restricts the data of the document to the given keys"""
+        document = self.codec.loads(self._get_document_raw(collection_name, document_id))
+        return document if fields is None else project(document, fields)
 
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "r") as file:
-            for line in file:
-                if line.strip():
-                    document = json.loads(line)
-                    if document["_document_id"] == str(document_id):
-                        return document
-        raise NoSuchDocumentException(collection_name, document_id)
-
-    def get_documents(self, collection_name: str):
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+    @metrics.timed
+    def get_document_raw(self, collection_name: str, document_id: str, fields: list = None) -> bytes:
+        """get_document, as the JSON of the document, served from the cache if possible"""
+        document = self._get_document_raw(collection_name, document_id)
+        return document if fields is None else self.codec.dumps(project(self.codec.loads(document), fields))
 
-        documents = []
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "r") as file:
-            for line in file:
-                if line.strip():
-                    documents.append(json.loads(line))
-        return documents
+    def _get_document_raw(self, collection_name: str, document_id: str) -> bytes:
+        with self._locked(collection_name) as log:
+            document = self._cache.get(collection_name, str(document_id))
+            if document is None:
+                document = log.find_raw(str(document_id))
+                if document is not None:
+                    self._cache.put(collection_name, str(document_id), document)
+        if document is None:
+            raise NoSuchDocumentException(collection_name, document_id)
+        return document
 
-    def delete_document(self, collection_name: str, document_id: str):
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+    def get_cache_stats(self) -> dict:
+        """returns the hits, misses and evictions of the document cache, and its number of entries and size"""
+        return self._cache.stats()
 
-        if not self.exists_document(collection_name, document_id):
-            raise NoSuchDocumentException(collection_name, document_id)
+    def collect_metrics(self):
+        """Sets the metrics that describe the state of the service rather than its operations, see metrics."""
+        stats = self._cache.stats()
+        metrics.CACHE_REQUESTS.set(stats["hits"], "hit")
+        metrics.CACHE_REQUESTS.set(stats["misses"], "miss")
+        metrics.CACHE_EVICTIONS.set(stats["evictions"])
+        metrics.CACHE_BYTES.set(stats["bytes"])
+        with self._catalog_lock:
+            collections = {name: (collection["size"], shard_paths(self._collection_file_path(name),
+                                                                  self._collection_shards(name)))
+                           for name, collection in self._collections.items()}
+        metrics.COLLECTION_FILE_BYTES.clear()
+        metrics.COLLECTION_DOCUMENTS.clear()
+        for name, (size, paths) in collections.items():
+            metrics.COLLECTION_FILE_BYTES.set(sum(self._file_size(path) for path in paths), name)
+            metrics.COLLECTION_DOCUMENTS.set(size, name)
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        # the collection may be deleted in the meantime
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    @metrics.timed
+    def get_documents(self, collection_name: str, fields: list = None):
+        return list(self.iter_documents(collection_name, fields))
+
+    @metrics.timed
+    def iter_documents(self, collection_name: str, fields: list = None):
+        """Returns a generator of the documents of the collection, which reads and parses them one at a time.
+
+        The collection is checked right away, not when the iteration starts. The generator doesn't hold the lock of
+        the collection, it reads the documents that were live when it was created.
+        """
+        with self._locked(collection_name) as log:
+            return self._projected(log.iter_documents(), fields)
+
+    @metrics.timed
+    def iter_documents_raw(self, collection_name: str, fields: list = None):
+        """iter_documents, with the encoded documents stored in the collection file"""
+        with self._locked(collection_name) as log:
+            return self._projected_raw(log.iter_raw_documents(), fields)
+
+    @staticmethod
+    def _projected(documents, fields: list = None):
+        """maps the documents to their projection on fields, one at a time, see query.project"""
+        return documents if fields is None else (project(document, fields) for document in documents)
+
+    def _projected_raw(self, documents, fields: list = None):
+        """_projected for documents encoded as JSON"""
+        if fields is None:
+            return documents
+        return (self.codec.dumps(project(self.codec.loads(document), fields)) for document in documents)
 
-        documents = self.get_documents(collection_name)
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "w") as file:
-            for document in documents:
-                if document["_document_id"] != str(document_id):
-                    file.write(json.dumps(document) + "\n")
+    @metrics.timed
+    def delete_document(self, collection_name: str, document_id: str):
+        with self._locked(collection_name, write=True) as log:
+            if str(document_id) not in log:
+                raise NoSuchDocumentException(collection_name, document_id)
 
-        #         update the size of the collection
-        new_collection = self.get_collection(collection_name)
-        new_collection["size"] -= 1
-        self.update_collection(collection_name, new_collection)
+            lsn = self._wal.append({"op": "delete_document", "collection": collection_name,
+                                    "_document_id": str(document_id)})
+            log.append_tombstone(str(document_id))
+            self._cache.invalidate(collection_name, str(document_id))
+
+            #         update the size of the collection
+            with self._catalog_lock:
+                self._collections[collection_name]["size"] -= 1
+            self._maybe_compact(collection_name, log)
+        self._commit(lsn)
         return None
 
+    @metrics.timed
     def update_document(self, collection_name: str, document_id: str, new_document: dict):
         """Every field except the _document_id of the document will be updated."""
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
+        with self._locked(collection_name, write=True) as log:
+            if str(document_id) not in log:
+                raise NoSuchDocumentException(collection_name, document_id)
 
-        if not self.exists_document(collection_name, document_id):
-            raise NoSuchDocumentException(collection_name, document_id)
-
-        # Ensure the _document_id is not changed
-        new_document["_document_id"] = str(document_id)
+            # Ensure the _document_id is not changed
+            new_document["_document_id"] = str(document_id)
 
-        documents = self.get_documents(collection_name)
-        with open(os.path.join(self.collections_dir_path, collection_name + ".json"), "w") as file:
-            for document in documents:
-                if document["_document_id"] == str(document_id):
-                    file.write(json.dumps(new_document) + "\n")
-                else:
-                    file.write(json.dumps(document) + "\n")
+            encoded = log.encode_many([new_document])
+            lsn = self._wal.append({"op": "put_documents", "collection": collection_name, "documents": [new_document]})
+            log.append_many([new_document], encoded)
+            self._cache.invalidate(collection_name, str(document_id))
+            self._maybe_compact(collection_name, log)
+        self._commit(lsn)
         return None
 
+    @metrics.timed
+    def compact(self, collection_name: str):
+        """Removes the dead records from the file of the collection.
+
+        The live records are located under the read lock of the collection, and the compacted file is written
+        without any lock, so neither the reads nor the writes wait for it. The write lock is taken at the end, to add
+        the records appended in the meantime and to replace the file.
+        """
+        with self._compaction_lock:
+            with self._locked(collection_name) as log:
+                compaction = log.start_compaction()
+            try:
+                compaction.write()
+                with self._locked(collection_name, write=True) as current:
+                    if current is not log:
+                        # the collection was replaced by another one with the same name
+                        compaction.abandon()
+                        return
+                    log.finish_compaction(compaction)
+            except BaseException:
+                compaction.abandon()
+                raise
+
+    def _maybe_compact(self, collection_name: str, log: DocumentLog):
+        """Starts a background compaction of the collection if enough of its records are dead. Called with the write
+        lock of the collection held."""
+        with self._catalog_lock:
+            if collection_name in self._compacting or log.dead_ratio() < self.compaction_ratio:
+                return
+            self._compacting.add(collection_name)
+        threading.Thread(target=self._compact_in_background, args=(collection_name,), daemon=True).start()
+
+    def _compact_in_background(self, collection_name: str):
+        try:
+            self.compact(collection_name)
+        except NoSuchCollectionException:
+            # the collection was deleted or renamed before the compaction finished
+            pass
+        except Exception:
+            logging.exception(f"Compaction of collection {collection_name} failed")
+        finally:
+            with self._catalog_lock:
+                self._compacting.discard(collection_name)
+
+    @metrics.timed
     def clean_up(self):
         if not os.path.exists(self.collections_file_path):
             return
+        with self._locked_all():
+            lsn = self._wal.append({"op": "clean_up"})
+            self._apply_clean_up(lsn)
+        self._commit(lsn)
+
+    def _apply_clean_up(self, lsn: int):
+        self._cache.clear()
+        self._wait_for_scans()
         for file in os.listdir(self.collections_dir_path):
             if file != "collections.json":
                 os.remove(os.path.join(self.collections_dir_path, file))
 
         #     now rewrite the collections.json file
-        with open(self.collections_file_path, "w") as file:
-            file.write("")
+        self._collections = {}
+        self._logs = {}
+        self._locks = {}
+        self._catalog_lsn = lsn
+        self._save_catalog()
 
-    def find_documents_by_field(self, collection_name: str, field: str, value):
+    def _commit(self, lsn: int):
+        """Waits for the write-ahead log entry to be committed, called after the locks were released so that
+        concurrent writers can share one fsync."""
+        self._wal.commit(lsn)
+        self._maybe_checkpoint()
 
-        print(f"Finding documents by field {field} with value {value}", type(value))
-        if not self.exists_by_name(collection_name):
-            raise NoSuchCollectionException(collection_name)
-        documents = self.get_documents(collection_name)
-        found_documents = []
+    def _replay_wal(self):
+        entries = self._wal.recover()
+        # collection-level entries that were already applied to the catalog, in order
+        applied = [entry for entry in entries if entry["op"] in COLLECTION_OPS and entry["lsn"] <= self._catalog_lsn]
+        for entry in entries:
+            if entry["op"] in COLLECTION_OPS:
+                if entry["lsn"] > self._catalog_lsn:
+                    self._replay_collection_entry(entry)
+                continue
+            collection_name = self._current_name(entry["collection"], entry["lsn"], applied)
+            if collection_name is not None and self.exists_by_name(collection_name):
+                self._replay_document_entry(collection_name, entry)
+        if entries:
+            logging.info(f"Replayed {len(entries)} write-ahead log entries")
+            self.checkpoint()
+
+    @staticmethod
+    def _current_name(collection_name: str, lsn: int, applied: list):
+        """returns the name that the collection, named collection_name at lsn, has now, None if it was deleted"""
+        for entry in applied:
+            if entry["lsn"] < lsn:
+                continue
+            if entry["op"] == "clean_up" or (entry["op"] == "delete_collection" and
+                                             entry["collection"] == collection_name):
+                return None
+            if entry["op"] == "update_collection" and entry["collection"] == collection_name:
+                collection_name = entry["new_collection"]["name"]
+        return collection_name
+
+    def _replay_collection_entry(self, entry: dict):
+        op = entry["op"]
+        if op == "create_collection":
+            self._apply_create_collection(entry["collection"], entry.get("format", DEFAULT_FORMAT), entry["lsn"],
+                                          entry.get("shards", 1))
+        elif op == "delete_collection":
+            self._apply_delete_collection(entry["collection"], entry["lsn"])
+        elif op == "update_collection":
+            self._apply_update_collection(entry["collection"], entry["new_collection"], entry["lsn"])
+        elif op == "convert_collection":
+            self._apply_convert_collection(entry["collection"], entry["format"], entry["lsn"],
+                                           self._open_log(entry["collection"]))
+        elif op == "clean_up":
+            self._apply_clean_up(entry["lsn"])
+
+    def _replay_document_entry(self, collection_name: str, entry: dict):
+        with self._locked(collection_name, write=True) as log:
+            self._apply_document_entry(collection_name, entry, log)
+
+    def _apply_document_entry(self, collection_name: str, entry: dict, log: DocumentLog):
+        op = entry["op"]
+        if op == "put_documents":
+            log.append_many([document for document in entry["documents"]
+                             if log.find(document["_document_id"]) != document])
+            for document in entry["documents"]:
+                self._cache.invalidate(collection_name, document["_document_id"])
+        elif op == "delete_document" and entry["_document_id"] in log:
+            log.append_tombstone(entry["_document_id"])
+            self._cache.invalidate(collection_name, entry["_document_id"])
+        elif op == "create_index" and entry["field"] not in log.field_indexes:
+            log.create_field_index(entry["field"])
+        elif op == "delete_index" and entry["field"] in log.field_indexes:
+            log.drop_field_index(entry["field"])
+        with self._catalog_lock:
+            self._collections[collection_name]["size"] = len(log)
+
+    @metrics.timed
+    def checkpoint(self):
+        """Makes the collection files durable and drops the write-ahead log entries that are applied to them.
+
+        The log is rotated first. The lock of every collection is then taken once, which waits for the writes that
+        were logged before the rotation to be applied. After the files are fsynced, the entries up to the rotation
+        are no longer needed. The catalog is saved with the current sizes of the collections, and only the files of
+        the open collections are fsynced, the others weren't written to since the service started. The index
+        checkpoints of the open collections are then updated, see _save_index_checkpoints.
+        """
+        with self._checkpoint_lock:
+            lsn = self._wal.rotate()
+            with self._catalog_lock:
+                locks = list(self._locks.values())
+            for lock in locks:
+                with lock.write():
+                    pass
+            with self._catalog_lock:
+                self._save_catalog()
+                paths = []
+                for log in self._logs.values():
+                    for shard in (log.shards if isinstance(log, ShardedLog) else [log]):
+                        paths += [shard.path, index_fields_path(shard.path)]
+                for path in paths:
+                    try:
+                        with open(path, "rb") as file:
+                            os.fsync(file.fileno())
+                    except FileNotFoundError:
+                        # a collection without indexed fields
+                        pass
+                self._fsync_collections_directory()
+            self._wal.checkpoint(lsn)
+            self._save_index_checkpoints()
+
+    def _save_index_checkpoints(self):
+        """Writes the index checkpoints (see DocumentLog) of the open collections whose files or indexed fields
+        changed since their last checkpoint, so that they are loaded instead of rebuilt once the service restarts.
+        Called with the checkpoint lock held.
+
+        A checkpoint is taken under the read lock of its collection, but encoded and written to a temporary file
+        without it. The file is moved over the checkpoint under the read lock again, unless the collection was
+        compacted, converted, renamed or deleted in the meantime. A checkpoint is a cache of the indexes, so it is not
+        fsynced: a checkpoint that doesn't match its file after a crash is ignored.
+        """
+        with self._catalog_lock:
+            collection_names = list(self._logs)
+        for collection_name in collection_names:
+            try:
+                with self._locked(collection_name, open_log=False) as log:
+                    if log is None:
+                        continue
+                    checkpoints = [(shard, shard.generation, shard.checkpoint_state())
+                                   for shard in (log.shards if isinstance(log, ShardedLog) else [log])
+                                   if shard.checkpoint_outdated()]
+            except NoSuchCollectionException:
+                continue
+            if not checkpoints:
+                continue
+            paths = []
+            for shard, _, state in checkpoints:
+                paths.append(index_checkpoint_path(shard.path) + ".tmp")
+                with open(paths[-1], "wb") as file:
+                    file.write(self.codec.dumps(state))
+            try:
+                with self._locked(collection_name, open_log=False) as current:
+                    for (shard, generation, state), path in zip(checkpoints, paths):
+                        if current is log and shard.generation == generation:
+                            shard.replace_checkpoint(path, state)
+            except NoSuchCollectionException:
+                pass
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _maybe_checkpoint(self):
+        if self._wal.size < self.wal_checkpoint_bytes:
+            return
+        with self._catalog_lock:
+            if self._checkpointing:
+                return
+            self._checkpointing = True
+        threading.Thread(target=self._checkpoint_in_background, daemon=True).start()
+
+    def _checkpoint_in_background(self):
+        try:
+            self.checkpoint()
+        except Exception:
+            logging.exception("Checkpoint failed")
+        finally:
+            with self._catalog_lock:
+                self._checkpointing = False
+
+    def close(self):
+        """Checkpoints (see checkpoint), so that the next start has no write-ahead log to replay, stops the background
+        work of the write-ahead log and makes it durable, and stops the scan processes."""
+        self.checkpoint()
+        self._wal.close()
+        if self._scan_executor is not None:
+            self._scan_executor.shutdown()
+
+    @property
+    def last_lsn(self) -> int:
+        """lsn of the last mutation written to the write-ahead log"""
+        return self._wal.last_lsn
+
+    def wait_for_lsn(self, lsn: int, timeout: float) -> bool:
+        """Waits up to timeout seconds until the mutation lsn is written, returns whether it is."""
+        return self._wal.wait_for(lsn, timeout)
+
+    @metrics.timed
+    def get_log_entries(self, after: int, limit: int = 1000, wait: float = 0) -> list:
+        """Returns at most limit write-ahead log entries with an lsn greater than after, in order, for a follower.
+
+        If there is no such entry yet, waits up to wait seconds for one. Raises SnapshotRequiredException if the
+        entries were checkpointed away, the follower has to restore a snapshot (see write_snapshot) first.
+
+        Only durable entries are returned, the entries that are waited for are fsynced. A crash loses the entries
+        that are not, and their lsns are then reused by other mutations, which a follower that got them would skip.
+        """
+        if after < self._wal.checkpoint_lsn:
+            raise SnapshotRequiredException(after)
+        self._wal.wait_for_durable(after + 1, wait)
+        durable_lsn = self._wal.durable_lsn
+        try:
+            entries = list(itertools.islice(itertools.takewhile(lambda entry: entry["lsn"] <= durable_lsn,
+                                                                self._wal.entries(after)), limit))
+        except FileNotFoundError:
+            # a checkpoint deleted the segment while it was read
+            raise SnapshotRequiredException(after)
+        # a checkpoint that finished before the segments were listed deleted the first entries, the log then starts
+        # further on
+        if (entries and entries[0]["lsn"] != after + 1) or (not entries and after < self._wal.checkpoint_lsn):
+            raise SnapshotRequiredException(after)
+        return entries
+
+    @metrics.timed
+    def apply_log_entries(self, entries: list):
+        """Applies write-ahead log entries of the leader on a follower, in order.
+
+        Every entry is written to the write-ahead log of the follower with its lsn on the leader, and applied like
+        during the replay, under the locks that the mutation takes on the leader. Entries up to last_lsn were already
+        applied and are skipped.
+        """
+        lsn = None
+        for entry in entries:
+            if entry["lsn"] <= self._wal.last_lsn:
+                continue
+            mutation = {key: value for key, value in entry.items() if key != "lsn"}
+            if entry["op"] in COLLECTION_OPS:
+                with self._locked_all():
+                    lsn = self._wal.append(mutation, entry["lsn"])
+                    self._replay_collection_entry(entry)
+            elif self.exists_by_name(entry["collection"]):
+                with self._locked(entry["collection"], write=True) as log:
+                    lsn = self._wal.append(mutation, entry["lsn"])
+                    self._apply_document_entry(entry["collection"], entry, log)
+        if lsn is not None:
+            self._commit(lsn)
+
+    @metrics.timed
+    def write_snapshot(self, fileobj) -> int:
+        """Writes a consistent snapshot of the collections to fileobj, as a tar.gz archive, and returns its lsn.
+
+        The collection files are append-only, so while no mutation is in progress, the files are opened and their
+        size is taken. They are then copied up to that size without holding any lock, an open file keeps its content
+        even if a compaction replaces it. The catalog of the snapshot records its lsn.
+
+        The indexes of the open collections are copied too, and written as index checkpoints (see DocumentLog), so
+        the collections of a restored snapshot are opened without reading their records.
+        """
+        with self._locked_all():
+            lsn = self._wal.last_lsn
+            catalog = self._catalog_text(lsn).encode()
+            checkpoints = {}
+            for log in self._logs.values():
+                for shard in (log.shards if isinstance(log, ShardedLog) else [log]):
+                    checkpoints[os.path.basename(index_checkpoint_path(shard.path))] = shard.checkpoint_state()
+            files = []
+            for collection_name in self._collections:
+                for file_path in self._collection_files(collection_name):
+                    if os.path.exists(file_path) and os.path.basename(file_path) not in checkpoints:
+                        file = open(file_path, "rb")
+                        files.append((os.path.basename(file_path), file, os.fstat(file.fileno()).st_size))
+        with ExitStack() as stack:
+            for _, file, _ in files:
+                stack.enter_context(file)
+            with tarfile.open(fileobj=fileobj, mode="w:gz", compresslevel=1) as archive:
+                for name, file, size in files:
+                    info = tarfile.TarInfo(f"collections/{name}")
+                    info.size = size
+                    archive.addfile(info, file)
+                for name, checkpoint in checkpoints.items():
+                    data = self.codec.dumps(checkpoint)
+                    info = tarfile.TarInfo(f"collections/{name}")
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+                info = tarfile.TarInfo("collections/collections.json")
+                info.size = len(catalog)
+                archive.addfile(info, io.BytesIO(catalog))
+        return lsn
+
+    @metrics.timed
+    def save_snapshot(self, directory: str) -> dict:
+        """Writes a snapshot (see write_snapshot) to a new archive in directory, which only appears there once it is
+        complete and durable. Returns the path, the lsn and the size in bytes of the archive."""
+        os.makedirs(directory, exist_ok=True)
+        partial_path = os.path.join(directory, f".snapshot-{uuid.uuid4().hex}.partial")
+        try:
+            with open(partial_path, "wb") as file:
+                lsn = self.write_snapshot(file)
+                file.flush()
+                os.fsync(file.fileno())
+        except BaseException:
+            os.remove(partial_path)
+            raise
+        path = os.path.join(directory, f"snapshot-{lsn:020d}-{time.strftime('%Y%m%d-%H%M%S')}.tar.gz")
+        os.replace(partial_path, path)
+        return {"path": path, "lsn": lsn, "bytes": os.path.getsize(path)}
+
+    @metrics.timed
+    def restore_snapshot(self, fileobj) -> int:
+        """Replaces every collection with the ones of a snapshot written by write_snapshot, returns its lsn.
+
+        The snapshot is extracted next to the collections directory, which is swapped with it once no mutation is in
+        progress. The write-ahead log is then reset to continue after the lsn of the snapshot. The collections are
+        opened on first access as usual, with the indexes of their checkpoints.
+        """
+        restore_path = self.collections_dir_path + ".restore"
+        shutil.rmtree(restore_path, ignore_errors=True)
+        os.makedirs(restore_path)
+        with tarfile.open(fileobj=fileobj, mode="r:*") as archive:
+            for member in archive:
+                directory, _, name = member.name.partition("/")
+                if not member.isfile() or directory != "collections" or not name or "/" in name or \
+                        name.startswith("."):
+                    raise ValidationException(f"Invalid snapshot: unexpected file {member.name}.")
+                with archive.extractfile(member) as source, open(os.path.join(restore_path, name), "wb") as target:
+                    shutil.copyfileobj(source, target)
+                    target.flush()
+                    os.fsync(target.fileno())
+        if not os.path.exists(os.path.join(restore_path, "collections.json")):
+            shutil.rmtree(restore_path)
+            raise ValidationException("Invalid snapshot: it has no catalog.")
+
+        old_path = self.collections_dir_path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        with self._checkpoint_lock, self._locked_all():
+            self._wait_for_scans()
+            os.rename(self.collections_dir_path, old_path)
+            os.rename(restore_path, self.collections_dir_path)
+            # threads waiting for the locks of the old collections will look them up again
+            self._cache.clear()
+            self._logs = {}
+            self._locks = {}
+            self._collections = {}
+            self._catalog_lsn = 0
+            self._load_catalog()
+            # a crash before the reset replays the old entries on the snapshot, the follower then falls behind the
+            # checkpoint of its leader and restores a snapshot again
+            self._wal.reset(self._catalog_lsn)
+        shutil.rmtree(old_path)
+        return self._catalog_lsn
+
+    @metrics.timed
+    def create_index(self, collection_name: str, field: str):
+        """Creates a secondary index on a field of the documents' data, which find_documents_by_field will use."""
+        with self._locked(collection_name, write=True) as log:
+            if field in log.field_indexes:
+                raise IndexAlreadyExistsException(collection_name, field)
+            lsn = self._wal.append({"op": "create_index", "collection": collection_name, "field": field})
+            log.create_field_index(field)
+        self._commit(lsn)
+
+    @metrics.timed
+    def get_indexes(self, collection_name: str) -> list:
+        with self._locked(collection_name) as log:
+            return list(log.field_indexes)
+
+    @metrics.timed
+    def delete_index(self, collection_name: str, field: str):
+        with self._locked(collection_name, write=True) as log:
+            if field not in log.field_indexes:
+                raise NoSuchIndexException(collection_name, field)
+            lsn = self._wal.append({"op": "delete_index", "collection": collection_name, "field": field})
+            log.drop_field_index(field)
+        self._commit(lsn)
+
+    @metrics.timed
+    def find_documents_by_field(self, collection_name: str, field: str, value, fields: list = None):
+        return list(self.iter_documents_by_field(collection_name, field, value, fields))
+
+    @metrics.timed
+    def iter_documents_by_field(self, collection_name: str, field: str, value, fields: list = None):
+        """Generator version of find_documents_by_field, see iter_documents."""
+        logging.debug(f"Finding documents by field {field} with value {value}")
+        with self._locked(collection_name) as log:
+            return self._projected((document for _, document in self._field_entries(log, field, value)), fields)
+
+    @metrics.timed
+    def iter_documents_by_field_raw(self, collection_name: str, field: str, value, fields: list = None):
+        """iter_documents_by_field, with the encoded documents stored in the collection file. Without an index on
+        the field, the documents are still parsed to be compared, but they are not encoded again."""
+        with self._locked(collection_name) as log:
+            if field in log.field_indexes:
+                metrics.INDEX_QUERIES.inc(1, "hit")
+                return self._projected_raw(log.iter_raw_by_field(field, value), fields)
+            if fields is not None:
+                # the documents are parsed anyway, they are only encoded once, projected
+                return (self.codec.dumps(document) for document in
+                        self._projected((document for _, document in self._field_entries(log, field, value)),
+                                        fields))
+            return (raw for _, raw in self._scan(log, FieldEquals(field, value), raw=True))
+
+    def _field_entries(self, log: DocumentLog, field: str, value, after: int = -1, parallel: bool = True):
+        if field in log.field_indexes:
+            metrics.INDEX_QUERIES.inc(1, "hit")
+            return log.iter_entries_by_field(field, value, after)
+        return self._scan(log, FieldEquals(field, value), after, parallel=parallel)
+
+    def _scan(self, log: DocumentLog, query, after: int = -1, raw: bool = False, parallel: bool = True):
+        """returns (offset, document) of the live documents after the offset that match the query (a Filter or a
+        FieldEquals), reading every document. With parallel, sharded collections and large files are scanned by the
+        scan processes, which are submitted under the lock of the collection, see scan.submit_scan. Pages with a
+        limit read the documents lazily instead, as they usually stop long before the end of the file."""
+        metrics.INDEX_QUERIES.inc(1, "miss")
+        if parallel and isinstance(log, ShardedLog):
+            chunks = math.ceil(self.scan_processes / len(log.shards))
+            return log.scan(self._scan_processes(), query, after, raw, chunks)
+        if parallel and self.parallel_scan_bytes and os.path.getsize(log.path) >= self.parallel_scan_bytes:
+            return parallel_scan(self._scan_processes(), log, query, after, raw, self.scan_processes)
+        return log.iter_entries_where(query.matches, None, after, raw)
+
+    def _wait_for_scans(self, collection_name: str = None):
+        """waits for the scan processes reading the files of the open collection, or of every open collection,
+        before they are renamed or removed"""
+        logs = self._logs.values() if collection_name is None else filter(None, [self._logs.get(collection_name)])
+        for log in logs:
+            log.wait_for_scans()
+
+    def _scan_processes(self) -> ProcessPoolExecutor:
+        with self._catalog_lock:
+            if self._scan_executor is None:
+                # spawned, not forked, as a fork would copy the locks held by the other threads
+                self._scan_executor = ProcessPoolExecutor(self.scan_processes,
+                                                          mp_context=multiprocessing.get_context("spawn"))
+            return self._scan_executor
+
+    @metrics.timed
+    def find_documents_by_filter(self, collection_name: str, expression: dict, fields: list = None) -> list:
+        """Returns the documents that match the filter expression, see query.Filter for its syntax.
+
+        The expression is compiled once. If indexes narrow the documents down, only those are read, otherwise the
+        collection is scanned once.
+        """
+        return list(self.iter_documents_by_filter(collection_name, expression, fields))
+
+    @metrics.timed
+    def iter_documents_by_filter(self, collection_name: str, expression: dict, fields: list = None):
+        """Generator version of find_documents_by_filter, see iter_documents."""
+        return self._projected(self._iter_by_filter(collection_name, expression, raw=False), fields)
+
+    @metrics.timed
+    def iter_documents_by_filter_raw(self, collection_name: str, expression: dict, fields: list = None):
+        """iter_documents_by_filter, with the documents as JSON, see iter_documents_raw."""
+        if fields is not None:
+            # the documents are parsed to be matched, they are only encoded once, projected
+            return (self.codec.dumps(document) for document in
+                    self.iter_documents_by_filter(collection_name, expression, fields))
+        return self._iter_by_filter(collection_name, expression, raw=True)
+
+    def _iter_by_filter(self, collection_name: str, expression: dict, raw: bool):
+        query = Filter(expression)
+        with self._locked(collection_name) as log:
+            return (document for _, document in self._filter_entries(log, query, raw=raw))
+
+    def _filter_entries(self, log: DocumentLog, query: Filter, after: int = -1, raw: bool = False,
+                        parallel: bool = True):
+        candidates = query.candidates(log.field_indexes)
+        if candidates is None:
+            return self._scan(log, query, after, raw, parallel)
+        metrics.INDEX_QUERIES.inc(1, "hit")
+        return log.iter_entries_where(query.matches, candidates, after, raw)
+
+    @metrics.timed
+    def aggregate(self, collection_name: str, group_by: list = None, aggregates: list = None,
+                  expression: dict = None) -> dict:
+        """Returns the aggregates of the documents that match the filter expression (all the documents by default),
+        grouped by the values of the group_by fields, see query.Aggregation.
+
+        The documents are read and parsed one at a time, in a single pass. Counts grouped by one indexed field without
+        a filter come from the index instead when it only has string values, see _aggregate_index.
+        """
+        group_by = group_by or []
+        aggregation = Aggregation(group_by, aggregates or ["count"])
+        query = Filter(expression) if expression else None
+        with self._locked(collection_name) as log:
+            if (query is None and aggregation.counts_only() and len(group_by) == 1 and "." not in group_by[0]
+                    and group_by[0] in log.field_indexes
+                    and all(map(FieldIndex.only_strings, log.field_indexes[group_by[0]].entries))):
+                metrics.INDEX_QUERIES.inc(1, "hit")
+                return self._aggregate_index(log, aggregation, group_by[0])
+            documents = log.iter_documents() if query is None else (
+                document for _, document in self._filter_entries(log, query))
         for document in documents:
-            if field in document["data"] and str(document["data"][field]) == value:
-                found_documents.append(document)
-        return found_documents
+            aggregation.add(document)
+        return aggregation.result()
+
+    @staticmethod
+    def _aggregate_index(log: DocumentLog, aggregation: Aggregation, field: str) -> dict:
+        """Counts the documents of every key of the index on the field without reading them. Values with the same
+        string representation, like 1 and "1", share a key but not a group, so the index must only have keys of
+        strings, see FieldIndex.only_strings."""
+        unindexed = len(log)
+        for key, ids in log.field_indexes[field].entries.items():
+            aggregation.add_count({"data": {field: key}}, len(ids))
+            unindexed -= len(ids)
+        if unindexed:
+            # the documents without the field are not indexed
+            aggregation.add_count({"data": {}}, unindexed)
+        return aggregation.result()
+
+    @metrics.timed
+    def get_documents_page(self, collection_name: str, limit: int = None, cursor: str = None,
+                           fields: list = None) -> dict:
+        """Returns at most limit documents of the collection, starting after the cursor.
+
+        The result has the form {"documents": [...], "next_cursor": "..."}. next_cursor is None on the last page,
+        otherwise it is passed back to get the next page, which is read from where this page ended.
+        """
+        with self._locked(collection_name) as log:
+            return self._page(log, log.iter_entries(self._cursor_offset(log, cursor)), limit, fields)
+
+    @metrics.timed
+    def find_documents_by_field_page(self, collection_name: str, field: str, value, limit: int = None,
+                                     cursor: str = None, fields: list = None) -> dict:
+        """Paginated version of find_documents_by_field, see get_documents_page."""
+        with self._locked(collection_name) as log:
+            entries = self._field_entries(log, field, value, self._cursor_offset(log, cursor), parallel=limit is None)
+            return self._page(log, entries, limit, fields)
+
+    @metrics.timed
+    def find_documents_by_filter_page(self, collection_name: str, expression: dict, limit: int = None,
+                                      cursor: str = None, fields: list = None) -> dict:
+        """Paginated version of find_documents_by_filter, see get_documents_page."""
+        query = Filter(expression)
+        with self._locked(collection_name) as log:
+            entries = self._filter_entries(log, query, self._cursor_offset(log, cursor), parallel=limit is None)
+            return self._page(log, entries, limit, fields)
+
+    @staticmethod
+    def _page(log: DocumentLog, entries, limit: int = None, fields: list = None) -> dict:
+        generation = log.generation
+        # read one more document than needed, to know whether there is a next page
+        page = list(itertools.islice(entries, None if limit is None else limit + 1))
+        next_cursor = None
+        if limit is not None and len(page) > limit:
+            page = page[:limit]
+            next_cursor = CollectionService._encode_cursor(generation, page[-1][0])
+        documents = [document for _, document in page]
+        return {"documents": list(CollectionService._projected(documents, fields)), "next_cursor": next_cursor}
+
+    @staticmethod
+    def _encode_cursor(generation: int, offset: int) -> str:
+        # the cursor is the offset of the last returned record, it is only valid until the log is compacted
+        return base64.urlsafe_b64encode(json.dumps([generation, offset]).encode()).decode()
+
+    @staticmethod
+    def _cursor_offset(log: DocumentLog, cursor: str = None) -> int:
+        if cursor is None:
+            return -1
+        try:
+            generation, offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, ValueError, TypeError):
+            raise ValidationException("Invalid cursor.")
+        if type(generation) is not int or type(offset) is not int:
+            raise ValidationException("Invalid cursor.")
+        if generation != log.generation:
+            raise ValidationException("Cursor has expired, because the collection was compacted. "
+                                      "Start again from the first page.")
+        return offset
 
     @staticmethod
     def __set_object_id(document: dict):
@@ -0,0 +1,248 @@
+import itertools
+import os
+import zlib
+from collections.abc import Mapping
+
+from .scan import submit_scan
+from .storage import DocumentLog, DEFAULT_FORMAT
+
+MAX_SHARDS = 256
+# the position of an entry of a sharded log is its shard number followed by its offset in the file of the shard
+OFFSET_BITS = 40
+
+
+def shard_paths(path: str, shards: int) -> list:
+    """returns the paths of the files of the collection at path, one per shard, e.g. molecules.shard0.json"""
+    if shards == 1:
+        return [path]
+    root, extension = os.path.splitext(path)
+    return [f"{root}.shard{shard}{extension}" for shard in range(shards)]
+
+
+def shard_of(document_id: str, shards: int) -> int:
+    # crc32 gives the same shard in every process and after a restart, unlike hash()
+    return zlib.crc32(document_id.encode()) % shards
+
+
+class _MergedEntries(Mapping):
+    """entries of the FieldIndex of a field in every shard: key -> ids of the documents with that key in any shard"""
+
+    def __init__(self, indexes: list):
+        self._entries = [field_index.entries for field_index in indexes]
+
+    def __getitem__(self, key):
+        ids = [document_id for entries in self._entries for document_id in entries.get(key, ())]
+        if not ids:
+            raise KeyError(key)
+        return ids
+
+    def __iter__(self):
+        return iter(dict.fromkeys(itertools.chain.from_iterable(self._entries)))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class ShardedFieldIndex:
+    """Read-only view of the indexes of a field in every shard, used like a FieldIndex by the queries."""
+
+    def __init__(self, field: str, indexes: list):
+        self.field = field
+        self.indexes = indexes
+        self.entries = _MergedEntries(indexes)
+
+    def lookup(self, value) -> list:
+        return [document_id for field_index in self.indexes for document_id in field_index.lookup(value)]
+
+
+class ShardedCompaction:
+    """Compactions of the shards of a ShardedLog, between start_compaction and finish_compaction."""
+
+    def __init__(self, compactions: list):
+        # (shard, Compaction) of the shards that have dead records
+        self.compactions = compactions
+
+    def write(self):
+        for _, compaction in self.compactions:
+            compaction.write()
+
+    def abandon(self):
+        for _, compaction in self.compactions:
+            compaction.abandon()
+
+
+class ShardedLog:
+    """Document log of a collection that is split into shards, with the interface of DocumentLog.
+
+    Every shard is a DocumentLog with its own file, see shard_paths. A document always goes to the shard given by a
+    hash of its id, so the reads and writes of one document only use one shard, and an update only appends to the
+    file of that shard.
+
+    Entries are numbered with positions that combine the number of the shard with the offset in its file, and are
+    listed shard after shard, so pages can be resumed after any entry. generation changes whenever a shard is
+    compacted. Scans of every document run on the shards in parallel, see scan.
+    """
+
+    def __init__(self, path: str, shards: int, codec=None, record_format: str = DEFAULT_FORMAT, logs: list = None):
+        self._path = path
+        self.shards = logs if logs is not None else [DocumentLog(shard_path, codec, record_format)
+                                                     for shard_path in shard_paths(path, shards)]
+        self.codec = self.shards[0].codec
+        self.format = self.shards[0].format
+
+    @property
+    def path(self) -> str:
+        """path of the collection file that the shard paths are derived from, set when the collection is renamed"""
+        return self._path
+
+    @path.setter
+    def path(self, path: str):
+        self._path = path
+        for shard, shard_path in zip(self.shards, shard_paths(path, len(self.shards))):
+            shard.path = shard_path
+
+    def _shard(self, document_id: str) -> DocumentLog:
+        return self.shards[shard_of(document_id, len(self.shards))]
+
+    def __contains__(self, document_id: str) -> bool:
+        return document_id in self._shard(document_id)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def records(self) -> int:
+        return sum(shard.records for shard in self.shards)
+
+    @property
+    def generation(self) -> int:
+        return sum(shard.generation for shard in self.shards)
+
+    @property
+    def field_indexes(self) -> dict:
+        # every shard has the same indexed fields
+        return {field: ShardedFieldIndex(field, [shard.field_indexes[field] for shard in self.shards])
+                for field in self.shards[0].field_indexes}
+
+    def append(self, record: dict):
+        self.append_many([record])
+
+    def encode_many(self, records: list) -> list:
+        # every shard has the same format
+        return self.shards[0].encode_many(records)
+
+    def append_many(self, records: list, encoded: list = None):
+        """appends the records with a single write per shard"""
+        encoded = encoded if encoded is not None else self.encode_many(records)
+        by_shard = {}
+        for record, data in zip(records, encoded):
+            shard_records = by_shard.setdefault(shard_of(record["_document_id"], len(self.shards)), ([], []))
+            shard_records[0].append(record)
+            shard_records[1].append(data)
+        for shard, (shard_records, shard_encoded) in by_shard.items():
+            self.shards[shard].append_many(shard_records, shard_encoded)
+
+    def append_tombstone(self, document_id: str):
+        self._shard(document_id).append_tombstone(document_id)
+
+    def find(self, document_id: str):
+        return self._shard(document_id).find(document_id)
+
+    def find_raw(self, document_id: str):
+        return self._shard(document_id).find_raw(document_id)
+
+    def _after(self, after: int) -> list:
+        """returns the offset after which every shard is read to resume after the position after, None for the
+        shards that come before it"""
+        if after < 0:
+            return [-1] * len(self.shards)
+        shard, offset = after >> OFFSET_BITS, after & ((1 << OFFSET_BITS) - 1)
+        return [None if number < shard else offset if number == shard else -1 for number in range(len(self.shards))]
+
+    def _chain_entries(self, entries, after: int):
+        """chains entries(shard, offset) of the shards after the position after, with positions instead of offsets.
+        The generators of the shards are all created right away, see DocumentLog._iter_raw."""
+        generators = [(number, entries(shard, shard_after)) for number, (shard, shard_after)
+                      in enumerate(zip(self.shards, self._after(after))) if shard_after is not None]
+        return (((number << OFFSET_BITS) | offset, document)
+                for number, generator in generators for offset, document in generator)
+
+    def iter_entries(self, after: int = -1):
+        return self._chain_entries(lambda shard, shard_after: shard.iter_entries(shard_after), after)
+
+    def iter_documents(self):
+        return (document for _, document in self.iter_entries())
+
+    def iter_raw_documents(self):
+        return itertools.chain(*[shard.iter_raw_documents() for shard in self.shards])
+
+    def documents(self) -> list:
+        return list(self.iter_documents())
+
+    def iter_entries_by_field(self, field: str, value, after: int = -1):
+        return self._chain_entries(lambda shard, shard_after: shard.iter_entries_by_field(field, value, shard_after),
+                                   after)
+
+    def iter_raw_by_field(self, field: str, value):
+        return itertools.chain(*[shard.iter_raw_by_field(field, value) for shard in self.shards])
+
+    def iter_entries_where(self, predicate, ids=None, after: int = -1, raw: bool = False):
+        # every shard ignores the ids of the documents it doesn't have
+        return self._chain_entries(
+            lambda shard, shard_after: shard.iter_entries_where(predicate, ids, shard_after, raw), after)
+
+    def scan(self, executor, query, after: int = -1, raw: bool = False, chunks: int = 1):
+        """iter_entries_where(query.matches) for every document, with the shards scanned in parallel by the processes
+        of executor, each shard in chunks, see scan.submit_scan and scan.iter_results."""
+        scans = [(number, submit_scan(executor, shard, query, shard_after, raw, chunks))
+                 for number, (shard, shard_after) in enumerate(zip(self.shards, self._after(after)))
+                 if shard_after is not None]
+        return self._iter_scan(scans)
+
+    @staticmethod
+    def _iter_scan(scans: list):
+        """yields the results of the futures of scan, see scan.iter_results"""
+        try:
+            for number, futures in scans:
+                for future in futures:
+                    for offset, document in future.result():
+                        yield (number << OFFSET_BITS) | offset, document
+        finally:
+            for _, futures in scans:
+                for future in futures:
+                    future.cancel()
+
+    def wait_for_scans(self):
+        for shard in self.shards:
+            shard.wait_for_scans()
+
+    def create_field_index(self, field: str):
+        for shard in self.shards:
+            shard.create_field_index(field)
+
+    def drop_field_index(self, field: str):
+        for shard in self.shards:
+            shard.drop_field_index(field)
+
+    def dead_ratio(self) -> float:
+        records = self.records
+        return (records - len(self)) / records if records else 0.0
+
+    def compact(self):
+        compaction = self.start_compaction()
+        compaction.write()
+        self.finish_compaction(compaction)
+
+    def start_compaction(self) -> ShardedCompaction:
+        """compacts the shards that have dead records, see DocumentLog.start_compaction"""
+        return ShardedCompaction([(shard, shard.start_compaction()) for shard in self.shards if shard.dead_ratio()])
+
+    def finish_compaction(self, compaction: ShardedCompaction):
+        for shard, shard_compaction in compaction.compactions:
+            shard.finish_compaction(shard_compaction)
+
+    def convert(self, path: str, record_format: str, batch_size: int = 1000) -> "ShardedLog":
+        """converts every shard, see DocumentLog.convert. path is the collection file path in the new format."""
+        logs = [shard.convert(shard_path, record_format, batch_size)
+                for shard, shard_path in zip(self.shards, shard_paths(path, len(self.shards)))]
+        return ShardedLog(path, len(logs), logs=logs)
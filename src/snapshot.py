@@ -0,0 +1,51 @@
+"""Writes and restores snapshots of the collections.
+
+    python -m src.snapshot create [--directory DIRECTORY] [--url URL]
+    python -m src.snapshot restore ARCHIVE
+
+The collections are found like by the server, from BASE_DIRECTORY (see Config). create writes a consistent snapshot
+to a new archive in DIRECTORY, SNAPSHOT_DIRECTORY by default. With --url, the snapshot is written by the server at
+that URL instead, with POST /admin/snapshot, in its own SNAPSHOT_DIRECTORY. restore replaces every collection with the
+ones of the archive, the indexes are loaded from the archive rather than rebuilt from the records.
+
+Without --url, the server must not be running on the same directory.
+"""
+import argparse
+import json
+
+from .dependencies import get_service, get_snapshot_directory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.snapshot", description="Writes and restores snapshots of "
+                                                                                "the collections.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="write a snapshot to a new archive")
+    create.add_argument("--directory", help="directory of the archive, SNAPSHOT_DIRECTORY by default")
+    create.add_argument("--url", help="URL of a running server that writes the snapshot, e.g. http://localhost:8000")
+    restore = commands.add_parser("restore", help="replace the collections with the ones of an archive")
+    restore.add_argument("archive", help="path of the archive")
+    args = parser.parse_args(argv)
+
+    if args.command == "create" and args.url:
+        import httpx
+
+        response = httpx.post(args.url.rstrip("/") + "/admin/snapshot", timeout=None)
+        response.raise_for_status()
+        print(json.dumps(response.json()))
+        return
+
+    service = get_service()
+    try:
+        if args.command == "create":
+            print(json.dumps(service.save_snapshot(args.directory or get_snapshot_directory())))
+        else:
+            with open(args.archive, "rb") as file:
+                lsn = service.restore_snapshot(file)
+            print(f"Restored {args.archive} at lsn {lsn}")
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
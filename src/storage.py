@@ -0,0 +1,616 @@
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+from . import metrics
+from .codec import JsonCodec
+from .index import FieldIndex
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Field that marks a record as a tombstone of a deleted document
+TOMBSTONE_FIELD = "_deleted"
+# bytes at the end of the part of a collection file covered by an index checkpoint, whose crc32 the checkpoint keeps
+CHECKPOINT_CRC_BYTES = 4096
+
+
+def index_fields_path(path: str) -> str:
+    """returns the path of the file, next to the collection file, where the indexed fields of the collection are kept"""
+    return os.path.splitext(path)[0] + ".indexes.json"
+
+
+def generation_path(path: str) -> str:
+    """returns the path of the file where the generation of the collection file at path is kept, see DocumentLog"""
+    return path + ".generation"
+
+
+def index_checkpoint_path(path: str) -> str:
+    """returns the path of the checkpoint of the indexes of the collection file at path, see DocumentLog"""
+    return path + ".checkpoint"
+
+
+class JsonLinesFormat:
+    """Record format of the collection files by default: one JSON record per line."""
+    name = "json"
+    extension = ".json"
+    # written after every record
+    separator = b"\n"
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def encode(self, record: dict) -> bytes:
+        return self.codec.dumps(record)
+
+    def decode(self, raw: bytes) -> dict:
+        return self.codec.loads(raw)
+
+    def to_json(self, raw: bytes) -> bytes:
+        return raw
+
+    def scan(self, data, parse: bool = True, start: int = 0):
+        """yields (offset, length, end, record) of the complete records of data from the offset start, end is the
+        offset after the record
+
+        Finding the end of a line doesn't need the record to be parsed, but the id of the record does, so parse is
+        ignored.
+        """
+        offset = start
+        while offset < len(data):
+            end = data.find(b"\n", offset)
+            if end == -1:
+                return
+            line = data[offset:end]
+            if line.strip():
+                yield offset, len(line.rstrip(b"\r")), end + 1, self.codec.loads(line)
+            offset = end + 1
+
+
+class BinaryFormat:
+    """Length-prefixed binary records.
+
+    Every record starts with a header holding the length of its payload, flags and the length of the document id,
+    followed by the id and the payload. Ids that are UUIDs (the ids given by the service) are stored as their 16
+    bytes. The payload is the document without its id, encoded with msgpack if it is installed and supports its
+    values (not integers beyond 64 bits), and with the JSON codec otherwise. Tombstones have no payload. Records are
+    found from their headers, so building the primary-key index doesn't parse the documents.
+    """
+    name = "binary"
+    extension = ".bin"
+    separator = b""
+    # payload length, flags, id length
+    HEADER = struct.Struct("<IBH")
+    TOMBSTONE_FLAG = 1
+    MSGPACK_FLAG = 2
+    UUID_FLAG = 4
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def encode(self, record: dict) -> bytes:
+        flags, document_id = self._encode_id(record["_document_id"])
+        if record.get(TOMBSTONE_FIELD):
+            flags, payload = flags | self.TOMBSTONE_FLAG, b""
+        else:
+            body = {key: value for key, value in record.items() if key != "_document_id"}
+            payload = None
+            if msgpack is not None:
+                try:
+                    payload = msgpack.packb(body)
+                    flags |= self.MSGPACK_FLAG
+                except (OverflowError, TypeError, ValueError):
+                    # values that only the JSON codec supports, like integers beyond 64 bits
+                    pass
+            if payload is None:
+                payload = self.codec.dumps(body)
+        return self.HEADER.pack(len(payload), flags, len(document_id)) + document_id + payload
+
+    def _encode_id(self, document_id: str):
+        """returns the flags of the id and its encoding"""
+        try:
+            if str(uuid.UUID(document_id)) == document_id:
+                return self.UUID_FLAG, uuid.UUID(document_id).bytes
+        except ValueError:
+            pass
+        return 0, document_id.encode()
+
+    def _decode_id(self, data, offset: int, flags: int, id_length: int) -> str:
+        start = offset + self.HEADER.size
+        if flags & self.UUID_FLAG:
+            # str(uuid.UUID(bytes=...)), without building a UUID for every record
+            h = data[start:start + 16].hex()
+            return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+        return bytes(data[start:start + id_length]).decode()
+
+    def decode(self, raw: bytes) -> dict:
+        _, flags, id_length = self.HEADER.unpack_from(raw)
+        payload = raw[self.HEADER.size + id_length:]
+        if flags & self.MSGPACK_FLAG:
+            if msgpack is None:
+                raise ValueError("The collection has msgpack records, which can't be read without msgpack")
+            document = msgpack.unpackb(payload)
+        else:
+            document = self.codec.loads(payload)
+        document["_document_id"] = self._decode_id(raw, 0, flags, id_length)
+        return document
+
+    def to_json(self, raw: bytes) -> bytes:
+        return self.codec.dumps(self.decode(raw))
+
+    def scan(self, data, parse: bool = True, start: int = 0):
+        """yields (offset, length, end, record) of the complete records of data from the offset start, end is the
+        offset after the record
+
+        Unless parse is set, the payloads of the documents are skipped and the records only hold their id.
+        """
+        offset = start
+        while offset + self.HEADER.size <= len(data):
+            payload_length, flags, id_length = self.HEADER.unpack_from(data, offset)
+            end = offset + self.HEADER.size + id_length + payload_length
+            if id_length == 0 or end > len(data):
+                # a record whose write was interrupted
+                return
+            document_id = self._decode_id(data, offset, flags, id_length)
+            if flags & self.TOMBSTONE_FLAG:
+                record = {"_document_id": document_id, TOMBSTONE_FIELD: True}
+            elif parse:
+                record = self.decode(data[offset:end])
+            else:
+                record = {"_document_id": document_id}
+            yield offset, end - offset, end, record
+            offset = end
+
+
+# format name -> record format of the collection files
+FORMATS = {format_class.name: format_class for format_class in (JsonLinesFormat, BinaryFormat)}
+DEFAULT_FORMAT = JsonLinesFormat.name
+
+
+class DocumentLog:
+    """Append-only file of the document records of one collection.
+
+    Every line of the file is a JSON record (see record_format for the other formats). Adding or updating a document
+    appends the new version of the document, deleting a document appends a tombstone of the form
+    {"_document_id": "...", "_deleted": true}. The last record of a document id wins.
+
+    When the log is opened, the file is read once to build the primary-key index, which maps the id of every live
+    document to the offset and the length of its last record. The index is kept up to date by every append, so a
+    single document is read with one slice and one parse.
+
+    Records are read through a read-only memory map of the file rather than with file reads, so scans and lookups are
+    served from the page cache without a system call per record. The map is replaced when a record beyond its end is
+    read, after appends, and dropped by a compaction, which replaces the file.
+
+    Secondary indexes (see FieldIndex) can be declared on fields of the documents' data. The indexed fields are
+    persisted next to the collection file, the indexes themselves are built together with the primary-key index.
+
+    The indexes can also be loaded from a checkpoint next to the collection file (see checkpoint_state), which holds
+    them as they were when the file had a given size. As the file is append-only, the checkpoint stays valid for
+    every larger size, only the records appended after it are read. The checkpoint is removed before a compaction
+    replaces the file, and it keeps the crc32 of the last bytes it covers, so a checkpoint of a file that was replaced
+    or lost its tail in a crash is not taken for a checkpoint of the current file.
+
+    Records that were overwritten or deleted are dead. They are only removed when the log is compacted, which rewrites
+    the file with the live documents only.
+
+    Records are encoded and parsed with codec (see codec.get_codec), the stdlib json module by default.
+
+    record_format names the format of the file in FORMATS. Whatever the format, documents are handed out as dicts,
+    and the *raw* methods hand them out as JSON.
+    """
+
+    def __init__(self, path: str, codec=None, record_format: str = DEFAULT_FORMAT):
+        self.path = path
+        self.codec = codec if codec is not None else JsonCodec()
+        self.format = FORMATS[record_format](self.codec)
+        # document id -> (offset, length) of the live record of the document
+        self.index = {}
+        # number of records (live and dead) in the file
+        self.records = 0
+        # incremented by every compaction, which moves the records to new offsets, and kept next to the file so that
+        # offsets given out before a restart are not taken for offsets in a compacted file
+        self.generation = self._load_generation()
+        # read-only memory map of the file, see _mapping
+        self._map = None
+        # field -> secondary index on the field
+        self.field_indexes = {field: FieldIndex(field) for field in self._load_index_fields()}
+        # (size, indexed fields) of the checkpoint file, None if there is none, see checkpoint_outdated
+        self.checkpointed = None
+        # chunks of scans submitted to the scan processes that are not done yet, they read the file by its path
+        self._scans = 0
+        self._scans_done = threading.Condition()
+        self._build_index()
+
+    def scan_started(self):
+        with self._scans_done:
+            self._scans += 1
+
+    def scan_finished(self, _future=None):
+        """called when a chunk of a scan is done or cancelled, see scan.submit_scan"""
+        with self._scans_done:
+            self._scans -= 1
+            if not self._scans:
+                self._scans_done.notify_all()
+
+    def wait_for_scans(self):
+        """Waits until the scan processes are done with the file, before it is renamed, replaced or removed. The
+        scans finish without any lock of the log."""
+        with self._scans_done:
+            self._scans_done.wait_for(lambda: not self._scans)
+
+    def _load_index_fields(self) -> list:
+        if not os.path.exists(index_fields_path(self.path)):
+            return []
+        with open(index_fields_path(self.path), "r") as file:
+            return json.load(file)
+
+    def _save_index_fields(self):
+        # written next to the file and moved over it, so a crash can't leave it empty
+        temporary_path = index_fields_path(self.path) + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(list(self.field_indexes), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, index_fields_path(self.path))
+
+    def _load_generation(self) -> int:
+        if not os.path.exists(generation_path(self.path)):
+            return 0
+        with open(generation_path(self.path), "r") as file:
+            return int(file.read())
+
+    def _save_generation(self):
+        # made durable before the file of the new generation replaces the old one
+        temporary_path = generation_path(self.path) + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write(str(self.generation))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, generation_path(self.path))
+
+    def _mapping(self, size: int):
+        """returns a read-only memory map of the file that covers at least its first size bytes
+
+        A map that is replaced stays valid for the generators that still use it, it is unmapped once they are done.
+        """
+        if size == 0:
+            return b""
+        mapping = self._map
+        if mapping is None or len(mapping) < size:
+            with open(self.path, "rb") as file:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map = mapping
+        return mapping
+
+    def _build_index(self):
+        mapping = self._mapping(os.path.getsize(self.path))
+        end = self._load_checkpoint(mapping)
+        for offset, length, end, record in self.format.scan(mapping, parse=bool(self.field_indexes), start=end):
+            self._index_record(record, offset, length)
+            self.records += 1
+        if end != len(mapping):
+            # the last append was interrupted by a crash, its write-ahead log entry is replayed if it was committed
+            self._map = None
+            with open(self.path, "r+b") as file:
+                file.truncate(end)
+
+    @staticmethod
+    def _checkpoint_crc(mapping, size: int) -> int:
+        return zlib.crc32(mapping[max(0, size - CHECKPOINT_CRC_BYTES):size])
+
+    def _load_checkpoint(self, mapping) -> int:
+        """loads the indexes from the checkpoint of the file if it is valid for the file, mapped by mapping, and
+        returns the size of the file that the checkpoint covers, 0 if there is no usable checkpoint"""
+        path = index_checkpoint_path(self.path)
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "rb") as file:
+                checkpoint = self.codec.loads(file.read())
+            if checkpoint["size"] > len(mapping) or set(checkpoint["fields"]) != set(self.field_indexes) or \
+                    checkpoint["crc"] != self._checkpoint_crc(mapping, checkpoint["size"]):
+                return 0
+            index = dict(zip(checkpoint["ids"], zip(checkpoint["offsets"], checkpoint["lengths"])))
+            for field, entries in checkpoint["fields"].items():
+                self.field_indexes[field].load(entries)
+        except (ValueError, KeyError, TypeError):
+            logging.warning(f"Ignoring the invalid index checkpoint {path}")
+            for field_index in self.field_indexes.values():
+                field_index.load({})
+            return 0
+        self.index = index
+        self.records = checkpoint["records"]
+        self.checkpointed = (checkpoint["size"], tuple(checkpoint["fields"]))
+        return checkpoint["size"]
+
+    def checkpoint_state(self) -> dict:
+        """returns a checkpoint of the indexes for the current size of the file, see _load_checkpoint. It must be taken
+        while no record is appended, and is a copy, it can be encoded (with codec) once appends resume.
+
+        The primary-key index is stored as columns, lists of ids, offsets and lengths, which are parsed faster than
+        an object with a key per document."""
+        size = os.path.getsize(self.path)
+        offsets, lengths = zip(*self.index.values()) if self.index else ((), ())
+        return {"size": size, "crc": self._checkpoint_crc(self._mapping(size), size), "records": self.records,
+                "ids": list(self.index), "offsets": offsets, "lengths": lengths,
+                "fields": {field: field_index.dump() for field, field_index in self.field_indexes.items()}}
+
+    def checkpoint_outdated(self) -> bool:
+        """whether the checkpoint file is missing, or older than the last change of the file or of the indexed
+        fields"""
+        return self.checkpointed != (os.path.getsize(self.path), tuple(self.field_indexes))
+
+    def replace_checkpoint(self, path: str, state: dict):
+        """moves the file at path, where the checkpoint_state state was written with codec, over the checkpoint"""
+        os.replace(path, index_checkpoint_path(self.path))
+        self.checkpointed = (state["size"], tuple(state["fields"]))
+
+    def remove_checkpoint(self):
+        if os.path.exists(index_checkpoint_path(self.path)):
+            os.remove(index_checkpoint_path(self.path))
+        self.checkpointed = None
+
+    def _index_record(self, record: dict, offset: int, length: int):
+        if record.get(TOMBSTONE_FIELD):
+            self.index.pop(record["_document_id"], None)
+            for field_index in self.field_indexes.values():
+                field_index.remove(record["_document_id"])
+        else:
+            self.index[record["_document_id"]] = (offset, length)
+            for field_index in self.field_indexes.values():
+                field_index.add(record)
+
+    def __contains__(self, document_id: str) -> bool:
+        return document_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def append(self, record: dict):
+        self.append_many([record])
+
+    def encode_many(self, records: list) -> list:
+        """returns the records encoded in the format of the file, for append_many"""
+        return [self.format.encode(record) for record in records]
+
+    def append_many(self, records: list, encoded: list = None):
+        """appends the records with a single write, encoded is the result of encode_many if they already are"""
+        encoded = encoded if encoded is not None else self.encode_many(records)
+        separator = self.format.separator
+        with open(self.path, "ab") as file:
+            offset = file.tell()
+            written = file.write(b"".join(data + separator for data in encoded))
+        metrics.BYTES_WRITTEN.inc(written, "collection")
+        for record, data in zip(records, encoded):
+            self._index_record(record, offset, len(data))
+            offset += len(data) + len(separator)
+        self.records += len(records)
+
+    def append_tombstone(self, document_id: str):
+        self.append({"_document_id": document_id, TOMBSTONE_FIELD: True})
+
+    def _iter_raw(self, locations: list):
+        """returns a generator of the records at the given (offset, length) locations, as raw bytes
+
+        The file is mapped right away, not when the iteration starts, and the generator keeps the map, so a
+        compaction that replaces the file in the meantime doesn't move the records under the generator. Together
+        with taking the locations from the index eagerly, this lets a generator be created under a read lock and be
+        consumed after the lock was released.
+        """
+        mapping = self._mapping(max((offset + length for offset, length in locations), default=0))
+        return self._read(mapping, locations)
+
+    @staticmethod
+    def _read(mapping, locations: list):
+        read = 0
+        try:
+            for offset, length in locations:
+                read += length
+                yield mapping[offset:offset + length]
+        finally:
+            metrics.BYTES_READ.inc(read)
+
+    def _iter_raw_entries(self, locations, after: int):
+        """returns a generator of (offset, raw record) of the records at the given locations after the given offset"""
+        locations = sorted(location for location in locations if location[0] > after)
+        return zip((offset for offset, _ in locations), self._iter_raw(locations))
+
+    def _iter_entries(self, locations, after: int):
+        """returns a generator of (offset, document) of the records at the given locations after the given offset"""
+        return ((offset, self.format.decode(raw)) for offset, raw in self._iter_raw_entries(locations, after))
+
+    def iter_entries(self, after: int = -1):
+        """returns a generator of (offset, document) of the live documents after the given offset, in file order
+
+        Only the records after the offset are read, so a listing can be resumed from the offset of the last document
+        it returned, as long as the log was not compacted in the meantime (see generation).
+        """
+        return self._iter_entries(self.index.values(), after)
+
+    def iter_documents(self):
+        """returns a generator of the live documents in the order of the file, which parses them one by one"""
+        return (document for _, document in self.iter_entries())
+
+    def iter_raw_documents(self):
+        """iter_documents, with the documents as JSON. In the JSON format, the records are not parsed."""
+        return (self.format.to_json(raw) for _, raw in self._iter_raw_entries(self.index.values(), -1))
+
+    def documents(self) -> list:
+        return list(self.iter_documents())
+
+    def find(self, document_id: str):
+        """returns the live version of the document, or None if there is no such document"""
+        raw = self._find_record(document_id)
+        return None if raw is None else self.format.decode(raw)
+
+    def find_raw(self, document_id: str):
+        """find, with the document as JSON. In the JSON format, the record is not parsed."""
+        raw = self._find_record(document_id)
+        return None if raw is None else self.format.to_json(raw)
+
+    def _find_record(self, document_id: str):
+        if document_id not in self.index:
+            return None
+        offset, length = self.index[document_id]
+        metrics.BYTES_READ.inc(length)
+        return self._mapping(offset + length)[offset:offset + length]
+
+    def create_field_index(self, field: str):
+        field_index = FieldIndex(field)
+        for document in self.documents():
+            field_index.add(document)
+        self.field_indexes[field] = field_index
+        self._save_index_fields()
+
+    def drop_field_index(self, field: str):
+        del self.field_indexes[field]
+        self._save_index_fields()
+
+    def iter_entries_by_field(self, field: str, value, after: int = -1):
+        """iter_entries of the live documents whose field is equal to the value, using the index on the field"""
+        ids = self.field_indexes[field].lookup(value)
+        return self._iter_entries([self.index[document_id] for document_id in ids], after)
+
+    def iter_by_field(self, field: str, value):
+        return (document for _, document in self.iter_entries_by_field(field, value))
+
+    def iter_raw_by_field(self, field: str, value):
+        """iter_by_field, with the documents as JSON, see iter_raw_documents"""
+        ids = self.field_indexes[field].lookup(value)
+        return (self.format.to_json(raw) for _, raw in
+                self._iter_raw_entries([self.index[document_id] for document_id in ids], -1))
+
+    def iter_entries_where(self, predicate, ids=None, after: int = -1, raw: bool = False):
+        """returns a generator of (offset, document) of the live documents after the given offset for which
+        predicate(document) is true, in file order
+
+        ids restricts the documents that are read, e.g. to the candidates found with an index. With raw, the
+        documents are given as JSON, see iter_raw_documents.
+        """
+        locations = self.index.values() if ids is None else [self.index[document_id] for document_id in ids
+                                                             if document_id in self.index]
+        return self._filter_entries(self._iter_raw_entries(locations, after), predicate, raw)
+
+    def _filter_entries(self, entries, predicate, raw: bool):
+        scanned = returned = 0
+        try:
+            for offset, record in entries:
+                document = self.format.decode(record)
+                scanned += 1
+                if predicate(document):
+                    returned += 1
+                    yield offset, self.format.to_json(record) if raw else document
+        finally:
+            metrics.DOCUMENTS_SCANNED.inc(scanned)
+            metrics.DOCUMENTS_RETURNED.inc(returned)
+
+    def dead_ratio(self) -> float:
+        return (self.records - len(self.index)) / self.records if self.records else 0.0
+
+    def compact(self):
+        """Rewrites the file with the live documents only."""
+        compaction = self.start_compaction()
+        compaction.write()
+        self.finish_compaction(compaction)
+
+    def convert(self, path: str, record_format: str, batch_size: int = 1000) -> "DocumentLog":
+        """Writes the live documents to a new file at path in another format, and returns the log of the new file.
+
+        The new file is fsynced, so the caller can switch to it and remove this one.
+        """
+        with open(path, "wb"):
+            pass
+        if os.path.exists(index_checkpoint_path(path)):
+            os.remove(index_checkpoint_path(path))
+        converted = DocumentLog(path, self.codec, record_format)
+        documents = self.iter_documents()
+        while batch := list(itertools.islice(documents, batch_size)):
+            converted.append_many(batch)
+        with open(path, "rb") as file:
+            os.fsync(file.fileno())
+        # cursors of this log must not be taken for offsets in the new file
+        converted.generation = self.generation + 1
+        converted._save_generation()
+        return converted
+
+    def start_compaction(self) -> "Compaction":
+        """Starts a compaction, which Compaction.write writes to a new file next to the collection file.
+
+        This only takes the locations of the live records and maps the file, under the read lock of the caller. The
+        file is append-only and the map keeps the records even if the file is replaced, so the new file is written
+        without any lock. Records appended after this are copied to the new file by finish_compaction, which then
+        moves the new file over the old one. A crash in the middle of the compaction leaves the old file untouched.
+        """
+        locations = sorted(self.index.items(), key=lambda item: item[1])
+        compaction = Compaction(self.path + ".compact", os.path.getsize(self.path))
+        compaction.records = zip([document_id for document_id, _ in locations],
+                                 self._iter_raw([location for _, location in locations]))
+        compaction.separator = self.format.separator
+        return compaction
+
+    def finish_compaction(self, compaction: "Compaction"):
+        """Moves the file written by the compaction over the collection file. Must not run concurrently with any
+        other use of the log."""
+        with open(self.path, "rb") as file:
+            file.seek(compaction.end)
+            tail = file.read()
+        records = len(compaction.index)
+        offset = compaction.size
+        with open(compaction.path, "ab") as file:
+            file.write(tail)
+            # the new file replaces records that may already be checkpointed out of the write-ahead log
+            file.flush()
+            os.fsync(file.fileno())
+        for record_offset, length, _, record in self.format.scan(tail, parse=False):
+            if record.get(TOMBSTONE_FIELD):
+                compaction.index.pop(record["_document_id"], None)
+            else:
+                compaction.index[record["_document_id"]] = (offset + record_offset, length)
+            records += 1
+        # the offsets of the checkpoint are the ones of the old file
+        self.remove_checkpoint()
+        self.wait_for_scans()
+        self.generation += 1
+        self._save_generation()
+        os.replace(compaction.path, self.path)
+        self._map = None
+        self.index = compaction.index
+        self.records = records
+
+
+class Compaction:
+    """State of a compaction between DocumentLog.start_compaction and DocumentLog.finish_compaction."""
+
+    def __init__(self, path: str, end: int):
+        # path of the new file
+        self.path = path
+        # size of the collection file when the compaction started
+        self.end = end
+        # (document id, raw record) of the live records when the compaction started, and the separator of the format
+        self.records = iter(())
+        self.separator = b""
+        # primary-key index of the new file, and its size
+        self.index = {}
+        self.size = 0
+
+    def write(self):
+        """Writes the live records to the new file, without any lock of the log."""
+        with open(self.path, "wb") as file:
+            for document_id, raw in self.records:
+                file.write(raw + self.separator)
+                self.index[document_id] = (self.size, len(raw))
+                self.size += len(raw) + len(self.separator)
+        metrics.BYTES_WRITTEN.inc(self.size, "collection")
+
+    def abandon(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
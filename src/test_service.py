@@ -1,10 +1,29 @@
+import asyncio
+import base64
+import builtins
+import concurrent.futures
+import io
 import json
+import math
 import os
+import threading
+import time
 import uuid
 import pytest
 from .service import CollectionService
+from .async_service import AsyncCollectionService
+from . import diagnostics, metrics
+from .cache import LRUCache
+from .locks import ReadWriteLock
+from .codec import get_codec, JsonCodec
+from .shards import shard_paths
+from .storage import BinaryFormat, Compaction, DocumentLog, index_checkpoint_path
+from .query import Filter
+from .scan import iter_results
+from .wal import WriteAheadLog
 from pytest_mock import MockerFixture
-from .exception import NoSuchCollectionException, NoSuchDocumentException, CollectionAlreadyExistsException
+from .exception import NoSuchCollectionException, NoSuchDocumentException, CollectionAlreadyExistsException, \
+    IndexAlreadyExistsException, NoSuchIndexException, ValidationException, SnapshotRequiredException
 
 
 
@@ -36,6 +55,8 @@ def test_init_collections_dir_already_exists_but_the_json_does_not_exists_dir_no
     # Create the collections.json file
     collections_file_path = collections_dir_path / "collections.json"
     collections_file_path.touch()
+    # and the write-ahead log directory
+    (temp_directory / "wal").mkdir()
 
     # Mock the os.makedirs function
     mkdir = mocker.patch("os.makedirs")
@@ -46,8 +67,8 @@ def test_init_collections_dir_already_exists_but_the_json_does_not_exists_dir_no
 
     # __init__ should not call os.makedirs, which means the directory is not created
     mkdir.assert_not_called()
-    # __init__ should not call open, which means the file is not created
-    file_open.assert_not_called()
+    # __init__ should only open the file for reading the catalog, which means the file is not created
+    file_open.assert_called_once_with(os.path.join(collections_dir_path, "collections.json"), "r")
 
 
 def test_exists_by_name(temp_directory, mocker: MockerFixture):
@@ -136,6 +157,36 @@ def test_update_collection(collection_service):
     assert os.path.exists(os.path.join(base_path, "collections", "collection3.json"))
 
 
+def test_update_collection_keeps_missing_fields(collection_service):
+    # Test for renaming a collection without providing its size
+    collection_service.create_collection("collection1")
+    collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    collection_service.update_collection("collection1", {"name": "collection2"})
+    assert collection_service.get_collection("collection2") == {"name": "collection2", "size": 1}
+
+
+def test_update_collection_new_name_already_exists(collection_service):
+    # Test for renaming a collection to the name of another collection
+    collection_service.create_collection("collection1")
+    collection_service.create_collection("collection2")
+    with pytest.raises(CollectionAlreadyExistsException):
+        collection_service.update_collection("collection1", {"name": "collection2"})
+
+
+def test_catalog_is_loaded_once(temp_directory, mocker: MockerFixture):
+    # Test that the catalog is read at startup and lookups don't touch collections.json
+    service = CollectionService(temp_directory)
+    service.create_collection("collection1")
+    service.add_document("collection1", {"data": {"name": "doc1"}})
+
+    reloaded = CollectionService(temp_directory)
+    file_open = mocker.patch("builtins.open")
+    assert reloaded.exists_by_name("collection1")
+    assert reloaded.get_collection("collection1") == {"name": "collection1", "size": 1}
+    assert reloaded.get_collections() == [{"name": "collection1", "size": 1}]
+    file_open.assert_not_called()
+
+
 def test_update_collection_not_found(collection_service):
     # Test for updating a non-existing collection
     collection_service.create_collection("collection1")
@@ -146,29 +197,51 @@ def test_update_collection_not_found(collection_service):
 def test_exists_document(collection_service, mocker: MockerFixture):
     # Test for checking if a document exists in a collection
     collection_service.create_collection("collection1")
-    # mock the file content of collection1.json
-    docs = [{"_document_id": str(uuid.uuid4()), "data": {"name": "doc1"}},
-            {"_document_id": str(uuid.uuid4()), "data": {"name": "doc2"}}]
-    file_content = json.dumps(docs[0]) + "\n" + json.dumps(docs[1])
-    mock_open = mocker.mock_open(read_data=file_content)
-    mocker.patch("builtins.open", mock_open)
-    # patch the exists_by_name method to return True
-    mocker.patch.object(CollectionService, "exists_by_name", return_value=True)
-    assert collection_service.exists_document("collection1", docs[0]["_document_id"])
+    document_id = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    # the primary-key index answers without reading the file
+    file_open = mocker.patch("builtins.open")
+    assert collection_service.exists_document("collection1", document_id)
+    file_open.assert_not_called()
 
 
 def test_exists_document_not_found(collection_service, mocker: MockerFixture):
     # Test for checking if a document exists in a collection
     collection_service.create_collection("collection1")
-    # mock the file content of collection1.json
-    docs = [{"_document_id": str(uuid.uuid4()), "data": {"name": "doc1"}},
-            {"_document_id": str(uuid.uuid4()), "data": {"name": "doc2"}}]
-    file_content = json.dumps(docs[0]) + "\n" + json.dumps(docs[1])
-    mock_open = mocker.mock_open(read_data=file_content)
-    mocker.patch("builtins.open", mock_open)
-    # patch the exists_by_name method to return True
-    mocker.patch.object(CollectionService, "exists_by_name", return_value=True)
+    collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    file_open = mocker.patch("builtins.open")
     assert not collection_service.exists_document("collection1", str(uuid.uuid4()))
+    file_open.assert_not_called()
+
+
+def test_index_is_built_when_collection_is_opened(temp_directory):
+    # Test that a new service instance finds the live documents written by another one
+    service = CollectionService(temp_directory)
+    # no background compaction, which would replace the file under the reloaded instance
+    service.compaction_ratio = 1
+    service.create_collection("collection1")
+    document_id1 = service.add_document("collection1", {"data": {"name": "doc1"}})
+    document_id2 = service.add_document("collection1", {"data": {"name": "doc2"}})
+    service.update_document("collection1", document_id1, {"data": {"name": "doc3"}})
+    service.delete_document("collection1", document_id2)
+
+    reloaded = CollectionService(temp_directory)
+    assert reloaded.get_document("collection1", document_id1)["data"] == {"name": "doc3"}
+    assert not reloaded.exists_document("collection1", document_id2)
+
+
+def test_get_document_after_compaction(collection_service):
+    # Test that the index points to the new offsets after a compaction
+    collection_service.compaction_ratio = 1
+    collection_service.create_collection("collection1")
+    document_id1 = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    document_id2 = collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    collection_service.delete_document("collection1", document_id1)
+    collection_service.compact("collection1")
+    assert collection_service.get_document("collection1", document_id2)["data"] == {"name": "doc2"}
+    document_id3 = collection_service.add_document("collection1", {"data": {"name": "doc3"}})
+    assert collection_service.get_document("collection1", document_id3)["data"] == {"name": "doc3"}
 
 
 def test_exists_document_collection_not_found(collection_service):
@@ -330,3 +403,1185 @@ def test_find_documents_by_field_integer_field(collection_service):
     assert len(found) == 1
 
     assert {"name": "Methane", "smiles": "C", "molecule_id": 1} in [doc["data"] for doc in found]
+
+
+def read_records(collection_service, collection_name):
+    with open(os.path.join(collection_service.base_path, "collections", collection_name + ".json")) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def test_update_and_delete_document_append_to_the_file(collection_service):
+    # Test that updates and deletions append records instead of rewriting the file
+    collection_service.compaction_ratio = 1
+    collection_service.create_collection("collection1")
+    document_id1 = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    document_id2 = collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    collection_service.update_document("collection1", document_id1, {"data": {"name": "doc3"}})
+    collection_service.delete_document("collection1", document_id2)
+
+    records = read_records(collection_service, "collection1")
+    assert len(records) == 4
+    assert records[2] == {"data": {"name": "doc3"}, "_document_id": document_id1}
+    assert records[3] == {"_document_id": document_id2, "_deleted": True}
+    assert collection_service.get_documents("collection1") == [{"data": {"name": "doc3"}, "_document_id": document_id1}]
+    assert collection_service.get_collection("collection1") == {"name": "collection1", "size": 1}
+
+
+def test_update_document_moves_it_to_the_end(collection_service):
+    # Test that the updated document is returned after the documents that were not updated
+    collection_service.create_collection("collection1")
+    document_id1 = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    collection_service.update_document("collection1", document_id1, {"data": {"name": "doc3"}})
+    assert [document["data"]["name"] for document in collection_service.get_documents("collection1")] == \
+        ["doc2", "doc3"]
+
+
+def test_compact(collection_service):
+    # Test that compaction keeps only the live documents
+    collection_service.compaction_ratio = 1
+    collection_service.create_collection("collection1")
+    document_id1 = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    document_id2 = collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    collection_service.update_document("collection1", document_id1, {"data": {"name": "doc3"}})
+    collection_service.delete_document("collection1", document_id2)
+    documents = collection_service.get_documents("collection1")
+
+    collection_service.compact("collection1")
+    assert read_records(collection_service, "collection1") == documents
+    assert collection_service.get_documents("collection1") == documents
+
+
+def test_compaction_writes_without_lock(collection_service, mocker: MockerFixture):
+    # Test that the reads and the writes of a collection don't wait for the compacted file to be written
+    collection_service.compaction_ratio = 1
+    collection_service.create_collection("collection1")
+    document_id1 = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    collection_service.update_document("collection1", document_id1, {"data": {"name": "doc2"}})
+    writing, release = threading.Event(), threading.Event()
+    write = Compaction.write
+
+    def blocked_write(compaction):
+        writing.set()
+        release.wait(5)
+        write(compaction)
+
+    mocker.patch.object(Compaction, "write", blocked_write)
+    compaction = threading.Thread(target=collection_service.compact, args=("collection1",))
+    compaction.start()
+    assert writing.wait(5)
+    # a writer that waited for a lock held by the compaction would make the reads wait too
+    writer = threading.Thread(target=collection_service.add_document, args=("collection1", {"data": {"name": "doc3"}}))
+    writer.start()
+    writer.join(5)
+    assert not writer.is_alive()
+    assert collection_service.get_document("collection1", document_id1)["data"] == {"name": "doc2"}
+    release.set()
+    compaction.join(5)
+
+    documents = collection_service.get_documents("collection1")
+    assert [document["data"]["name"] for document in documents] == ["doc2", "doc3"]
+    assert read_records(collection_service, "collection1") == documents
+
+
+def test_compaction_starts_when_dead_ratio_is_reached(collection_service, mocker: MockerFixture):
+    # Test that a background compaction is started once half of the records are dead
+    compact = mocker.patch.object(CollectionService, "compact")
+    collection_service.create_collection("collection1")
+    document_id1 = collection_service.add_document("collection1", {"data": {"name": "doc1"}})
+    collection_service.add_document("collection1", {"data": {"name": "doc2"}})
+    collection_service.update_document("collection1", document_id1, {"data": {"name": "doc3"}})
+    compact.assert_not_called()
+
+    collection_service.delete_document("collection1", document_id1)
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join(timeout=5)
+    compact.assert_called_once_with("collection1")
+
+
+def test_create_index(collection_service):
+    # Test for creating an index and listing the indexes of a collection
+    collection_service.create_collection("molecules")
+    collection_service.create_index("molecules", "name")
+    assert collection_service.get_indexes("molecules") == ["name"]
+    with pytest.raises(IndexAlreadyExistsException):
+        collection_service.create_index("molecules", "name")
+
+
+def test_delete_index(collection_service):
+    # Test for deleting an index
+    collection_service.create_collection("molecules")
+    collection_service.create_index("molecules", "name")
+    collection_service.delete_index("molecules", "name")
+    assert collection_service.get_indexes("molecules") == []
+    with pytest.raises(NoSuchIndexException):
+        collection_service.delete_index("molecules", "name")
+
+
+def test_find_documents_by_field_uses_index(collection_service, mocker: MockerFixture):
+    # Test that the index is kept up to date by add, update and delete and used by the search
+    collection_service.compaction_ratio = 1
+    collection_service.create_collection("molecules")
+    methane_id = collection_service.add_document("molecules", {"data": {"name": "Methane", "molecule_id": 1}})
+    collection_service.create_index("molecules", "name")
+    collection_service.create_index("molecules", "molecule_id")
+    ethanol_id = collection_service.add_document("molecules", {"data": {"name": "Ethanol", "molecule_id": 2}})
+    water_id = collection_service.add_document("molecules", {"data": {"name": "Water"}})
+    collection_service.update_document("molecules", water_id, {"data": {"name": "Methane"}})
+    collection_service.delete_document("molecules", ethanol_id)
+
+    iter_documents = mocker.spy(DocumentLog, "iter_documents")
+    found = collection_service.find_documents_by_field("molecules", "name", "Methane")
+    assert [document["_document_id"] for document in found] == [methane_id, water_id]
+    assert collection_service.find_documents_by_field("molecules", "name", "Ethanol") == []
+    assert [document["_document_id"] for document in
+            collection_service.find_documents_by_field("molecules", "molecule_id", "1")] == [methane_id]
+    iter_documents.assert_not_called()
+
+
+def test_indexes_are_persisted(temp_directory):
+    # Test that indexes survive a restart and a rename of the collection
+    service = CollectionService(temp_directory)
+    service.create_collection("molecules")
+    service.create_index("molecules", "name")
+    document_id = service.add_document("molecules", {"data": {"name": "Methane"}})
+    service.update_collection("molecules", {"name": "chemicals"})
+
+    reloaded = CollectionService(temp_directory)
+    assert reloaded.get_indexes("chemicals") == ["name"]
+    assert [document["_document_id"] for document in
+            reloaded.find_documents_by_field("chemicals", "name", "Methane")] == [document_id]
+    reloaded.delete_collection("chemicals")
+    assert os.listdir(os.path.join(temp_directory, "collections")) == ["collections.json"]
+
+
+def test_iter_documents(collection_service):
+    # Test that documents are streamed one by one and that a missing collection is reported before iterating
+    collection_service.create_collection("molecules")
+    collection_service.add_document("molecules", {"data": {"name": "Methane"}})
+    collection_service.add_document("molecules", {"data": {"name": "Ethanol"}})
+    documents = collection_service.iter_documents("molecules")
+    assert next(documents)["data"] == {"name": "Methane"}
+    assert next(documents)["data"] == {"name": "Ethanol"}
+    assert next(documents, None) is None
+    with pytest.raises(NoSuchCollectionException):
+        collection_service.iter_documents("collection1")
+
+
+def test_iter_documents_survives_compaction(collection_service):
+    # Test that a compaction during the iteration doesn't break it
+    collection_service.compaction_ratio = 1
+    collection_service.create_collection("molecules")
+    document_id = collection_service.add_document("molecules", {"data": {"name": "Methane"}})
+    collection_service.add_document("molecules", {"data": {"name": "Ethanol"}})
+    collection_service.add_document("molecules", {"data": {"name": "Water"}})
+    documents = collection_service.iter_documents("molecules")
+    assert next(documents)["data"] == {"name": "Methane"}
+    collection_service.delete_document("molecules", document_id)
+    collection_service.compact("molecules")
+    assert [document["data"]["name"] for document in documents] == ["Ethanol", "Water"]
+
+
+def test_document_log_remaps_after_appends(tmp_path, mocker: MockerFixture):
+    # Test that reads go through the memory map, which is extended to the records appended after it was made
+    path = str(tmp_path / "molecules.json")
+    open(path, "w").close()
+    log = DocumentLog(path)
+    log.append({"_document_id": "1", "data": {"name": "Methane"}})
+    assert log.find("1")["data"] == {"name": "Methane"}
+    log.append({"_document_id": "2", "data": {"name": "Ethanol"}})
+    assert [document["_document_id"] for document in log.iter_documents()] == ["1", "2"]
+    file_open = mocker.spy(builtins, "open")
+    assert log.find("2")["data"] == {"name": "Ethanol"}
+    assert log.documents() == [{"_document_id": "1", "data": {"name": "Methane"}},
+                               {"_document_id": "2", "data": {"name": "Ethanol"}}]
+    file_open.assert_not_called()
+
+
+def test_get_documents_page(collection_service):
+    # Test for reading a collection page by page
+    collection_service.create_collection("molecules")
+    for i in range(5):
+        collection_service.add_document("molecules", {"data": {"number": i}})
+
+    page = collection_service.get_documents_page("molecules", limit=2)
+    assert [document["data"]["number"] for document in page["documents"]] == [0, 1]
+    page = collection_service.get_documents_page("molecules", limit=2, cursor=page["next_cursor"])
+    assert [document["data"]["number"] for document in page["documents"]] == [2, 3]
+    page = collection_service.get_documents_page("molecules", limit=2, cursor=page["next_cursor"])
+    assert [document["data"]["number"] for document in page["documents"]] == [4]
+    assert page["next_cursor"] is None
+
+
+def test_get_documents_page_does_not_reread_previous_pages(collection_service, mocker: MockerFixture):
+    # Test that the next page only parses the documents after the cursor
+    collection_service.create_collection("molecules")
+    for i in range(5):
+        collection_service.add_document("molecules", {"data": {"number": i}})
+    cursor = collection_service.get_documents_page("molecules", limit=3)["next_cursor"]
+
+    loads = mocker.spy(collection_service.codec, "loads")
+    page = collection_service.get_documents_page("molecules", limit=3, cursor=cursor)
+    assert [document["data"]["number"] for document in page["documents"]] == [3, 4]
+    assert loads.call_count == 2
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_find_documents_by_field_page(collection_service, indexed):
+    # Test for paginating a search, with and without an index on the field
+    collection_service.create_collection("molecules")
+    if indexed:
+        collection_service.create_index("molecules", "parity")
+    for i in range(6):
+        collection_service.add_document("molecules", {"data": {"number": i, "parity": i % 2}})
+
+    page = collection_service.find_documents_by_field_page("molecules", "parity", "0", limit=2)
+    assert [document["data"]["number"] for document in page["documents"]] == [0, 2]
+    page = collection_service.find_documents_by_field_page("molecules", "parity", "0", limit=2,
+                                                           cursor=page["next_cursor"])
+    assert [document["data"]["number"] for document in page["documents"]] == [4]
+    assert page["next_cursor"] is None
+
+
+def test_get_documents_page_invalid_cursor(collection_service, temp_directory):
+    # Test that a malformed cursor and a cursor from before a compaction are rejected, even after a restart
+    collection_service.create_collection("molecules")
+    document_id = collection_service.add_document("molecules", {"data": {"number": 0}})
+    collection_service.add_document("molecules", {"data": {"number": 1}})
+    for values in ["not a cursor", [0, "x"], [0, None], [0, [1]], [True, 0], [0]]:
+        cursor = values if isinstance(values, str) else base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+        with pytest.raises(ValidationException):
+            collection_service.get_documents_page("molecules", limit=1, cursor=cursor)
+
+    cursor = collection_service.get_documents_page("molecules", limit=1)["next_cursor"]
+    collection_service.delete_document("molecules", document_id)
+    collection_service.compact("molecules")
+    with pytest.raises(ValidationException):
+        collection_service.get_documents_page("molecules", limit=1, cursor=cursor)
+    collection_service.close()
+    with pytest.raises(ValidationException):
+        CollectionService(temp_directory).get_documents_page("molecules", limit=1, cursor=cursor)
+
+
+def test_add_documents(collection_service):
+    # Test for adding many documents at once
+    collection_service.create_collection("molecules")
+    collection_service.add_document("molecules", {"data": {"name": "Water"}})
+    collection_service.create_index("molecules", "name")
+    document_ids = collection_service.add_documents("molecules", [{"data": {"name": "Methane"}},
+                                                                  {"data": {"name": "Ethanol"}}])
+    assert len(document_ids) == 2
+    assert collection_service.get_collection("molecules") == {"name": "molecules", "size": 3}
+    assert collection_service.get_document("molecules", document_ids[1])["data"] == {"name": "Ethanol"}
+    assert [document["_document_id"] for document in
+            collection_service.find_documents_by_field("molecules", "name", "Methane")] == [document_ids[0]]
+    assert [document["data"]["name"] for document in collection_service.get_documents("molecules")] == \
+        ["Water", "Methane", "Ethanol"]
+
+
+def test_add_documents_collection_not_found(collection_service):
+    # Test for adding many documents to a non-existing collection
+    with pytest.raises(NoSuchCollectionException):
+        collection_service.add_documents("collection1", [{"data": {"name": "doc1"}}])
+
+
+def test_concurrent_writes_are_not_lost(collection_service):
+    # Test that concurrent inserts, updates and compactions of one collection don't lose any document
+    collection_service.compaction_ratio = 0.1
+    collection_service.create_collection("molecules")
+    collection_service.create_index("molecules", "worker")
+
+    def work(worker):
+        for i in range(50):
+            document_id = collection_service.add_document("molecules", {"data": {"worker": worker, "number": i}})
+            collection_service.update_document("molecules", document_id, {"data": {"worker": worker, "number": -i}})
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    collection_service.compact("molecules")
+
+    documents = collection_service.get_documents("molecules")
+    assert len(documents) == 400
+    assert collection_service.get_collection("molecules")["size"] == 400
+    assert all(document["data"]["number"] <= 0 for document in documents)
+    assert len(collection_service.find_documents_by_field("molecules", "worker", "3")) == 50
+    assert len(read_records(collection_service, "molecules")) == 400
+
+
+def test_reads_during_rename(collection_service):
+    # Test that reads of a collection that is renamed concurrently either succeed or report the missing collection
+    collection_service.create_collection("molecules")
+    collection_service.add_documents("molecules", [{"data": {"number": i}} for i in range(100)])
+    errors = []
+
+    def read():
+        for _ in range(200):
+            try:
+                assert len(collection_service.get_documents("molecules")) == 100
+            except NoSuchCollectionException:
+                pass
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(20):
+        collection_service.update_collection("molecules", {"name": "chemicals"})
+        collection_service.update_collection("chemicals", {"name": "molecules"})
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_async_service(collection_service):
+    # Test that the async variant runs the service methods and streams documents in chunks
+    async_service = AsyncCollectionService(collection_service, io_threads=2, stream_chunk_size=2)
+
+    async def run():
+        await async_service.create_collection("molecules")
+        document_ids = await async_service.add_documents("molecules", [{"data": {"number": i}} for i in range(5)])
+        assert (await async_service.get_document("molecules", document_ids[3]))["data"] == {"number": 3}
+        documents = await async_service.iter_documents("molecules")
+        assert [document["data"]["number"] async for document in documents] == [0, 1, 2, 3, 4]
+        with pytest.raises(NoSuchCollectionException):
+            await async_service.iter_documents("collection1")
+
+    asyncio.run(run())
+    async_service.shutdown()
+
+
+def test_wal_replays_lost_writes(temp_directory):
+    # Test that the writes that didn't reach the collection file before a crash are replayed on startup
+    service = CollectionService(temp_directory)
+    service.compaction_ratio = 1
+    service.create_collection("molecules")
+    document_id1 = service.add_document("molecules", {"data": {"name": "water"}})
+    collection_file = temp_directory / "collections" / "molecules.json"
+    committed = collection_file.read_bytes()
+    document_id2 = service.add_document("molecules", {"data": {"name": "salt"}})
+    service.update_document("molecules", document_id1, {"data": {"name": "ice"}})
+    service.delete_document("molecules", document_id2)
+    # the crash loses the last writes and tears the first record after them
+    collection_file.write_bytes(committed + b'{"_document_id": "')
+
+    reloaded = CollectionService(temp_directory)
+    assert reloaded.get_document("molecules", document_id1)["data"] == {"name": "ice"}
+    assert not reloaded.exists_document("molecules", document_id2)
+    assert reloaded.get_collection("molecules")["size"] == 1
+    # water, then the replayed salt, ice and the tombstone of salt
+    assert len(read_records(reloaded, "molecules")) == 4
+
+
+def test_wal_replay_is_idempotent(temp_directory):
+    # Test that replaying writes that already reached the files doesn't change them
+    service = CollectionService(temp_directory)
+    service.create_collection("molecules")
+    document_id = service.add_document("molecules", {"data": {"name": "water"}})
+    service.create_collection("salts")
+    service.update_collection("molecules", {"name": "chemicals"})
+    service.delete_collection("salts")
+    service.create_collection("salts")
+
+    reloaded = CollectionService(temp_directory)
+    assert reloaded.get_collections() == [{"name": "chemicals", "size": 1}, {"name": "salts", "size": 0}]
+    assert reloaded.get_document("chemicals", document_id)["data"] == {"name": "water"}
+    assert len(read_records(reloaded, "chemicals")) == 1
+
+
+def test_wal_checkpoint_drops_entries(temp_directory):
+    # Test that a checkpoint leaves nothing to replay
+    service = CollectionService(temp_directory, wal_checkpoint_bytes=1)
+    service.create_collection("molecules")
+    service.add_document("molecules", {"data": {"name": "water"}})
+    service.checkpoint()
+    service.close()
+    assert list(WriteAheadLog(str(temp_directory / "wal")).entries()) == []
+
+
+def test_catalog_sizes_saved_by_checkpoints(temp_directory, mocker: MockerFixture):
+    # Test that the documents don't rewrite the catalog, their sizes are saved by the checkpoints and replayed after a
+    # crash
+    service = CollectionService(temp_directory)
+    service.create_collection("molecules")
+    save_catalog = mocker.spy(CollectionService, "_save_catalog")
+    document_id = service.add_document("molecules", {"data": {"name": "water"}})
+    service.add_documents("molecules", [{"data": {"name": "methane"}}, {"data": {"name": "ethanol"}}])
+    service.delete_document("molecules", document_id)
+    save_catalog.assert_not_called()
+    service.checkpoint()
+    save_catalog.assert_called_once()
+    service.add_document("molecules", {"data": {"name": "benzene"}})
+
+    # the service is not closed, like after a crash
+    assert CollectionService(temp_directory).get_collection("molecules")["size"] == 3
+
+
+def test_wal_group_commit(tmp_path, mocker: MockerFixture):
+    # Test that one fsync commits all the entries written before it
+    wal = WriteAheadLog(str(tmp_path))
+    fsync = mocker.spy(os, "fsync")
+    lsns = [wal.append({"op": "clean_up"}) for _ in range(3)]
+    wal.commit(lsns[-1])
+    for lsn in lsns:
+        wal.commit(lsn)
+    assert fsync.call_count == 1
+    wal.close()
+
+
+@pytest.mark.parametrize("fsync", ["interval", "never"])
+def test_wal_commit_does_not_wait(tmp_path, mocker: MockerFixture, fsync):
+    # Test that only the "always" policy fsyncs on commit
+    wal = WriteAheadLog(str(tmp_path), fsync=fsync, fsync_interval_ms=60000)
+    spy = mocker.spy(os, "fsync")
+    wal.commit(wal.append({"op": "clean_up"}))
+    assert spy.call_count == 0
+    wal.close()
+
+
+def test_wal_ignores_torn_entry(tmp_path):
+    # Test that an entry whose write was interrupted is not replayed
+    wal = WriteAheadLog(str(tmp_path))
+    wal.commit(wal.append({"op": "clean_up"}))
+    wal.close()
+    with open(wal._segments()[-1], "ab") as file:
+        file.write(b'{"lsn": 2, "op": "cle')
+    reopened = WriteAheadLog(str(tmp_path))
+    assert [entry["lsn"] for entry in reopened.recover()] == [1]
+    assert reopened.append({"op": "clean_up"}) == 2
+
+
+def test_get_codec():
+    # Test that "auto" picks an installed codec and that unknown codecs are rejected
+    assert get_codec("auto").loads(get_codec("auto").dumps({"a": [1, "é"]})) == {"a": [1, "é"]}
+    assert isinstance(get_codec("json"), JsonCodec)
+    with pytest.raises(ValueError):
+        get_codec("yaml")
+
+
+def test_codecs_read_each_other_files(temp_directory):
+    # Test that a collection written with one codec is read by another one
+    orjson = pytest.importorskip("orjson")
+    service = CollectionService(temp_directory, codec="orjson")
+    service.create_collection("molecules")
+    document_id = service.add_document("molecules", {"data": {"name": "Méthane"}})
+
+    reloaded = CollectionService(temp_directory, codec="json")
+    assert reloaded.get_document("molecules", document_id)["data"] == {"name": "Méthane"}
+    reloaded.add_document("molecules", {"data": {"name": "Ethanol"}})
+    assert len(CollectionService(temp_directory, codec="orjson").get_documents("molecules")) == 2
+
+    # values that only the standard library supports are written and read the same way by every codec
+    values = {"big": 2 ** 70, "negative": -2 ** 70, "nan": float("nan"), "infinity": float("inf"), "none": None}
+    for writer, reader in [("json", "orjson"), ("orjson", "json"), ("orjson", "orjson")]:
+        document_id = CollectionService(temp_directory, codec=writer).add_document("molecules", {"data": values})
+        data = CollectionService(temp_directory, codec=reader).get_document("molecules", document_id)["data"]
+        assert math.isnan(data.pop("nan"))
+        assert data == {key: value for key, value in values.items() if key != "nan"}
+        assert type(data["big"]) is int
+
+    # null values are only encoded once, by the faster library
+    codec = get_codec("orjson")
+    page = {"documents": [{"name": "annulled", "mass": None}], "next_cursor": None}
+    assert codec.dumps(page) == orjson.dumps(page)
+    assert codec.dumps([[{"mass": float("-inf")}]]) == b'[[{"mass": -Infinity}]]'
+
+
+def test_raw_documents(collection_service):
+    # Test that the raw read methods return the stored encoding of the documents
+    collection_service.create_collection("molecules")
+    document_id = collection_service.add_document("molecules", {"data": {"name": "Methane"}})
+    collection_service.add_document("molecules", {"data": {"name": "Ethanol"}})
+    codec = collection_service.codec
+    assert codec.loads(collection_service.get_document_raw("molecules", document_id)) == \
+        collection_service.get_document("molecules", document_id)
+    assert [codec.loads(raw) for raw in collection_service.iter_documents_raw("molecules")] == \
+        collection_service.get_documents("molecules")
+    assert [codec.loads(raw)["_document_id"] for raw in
+            collection_service.iter_documents_by_field_raw("molecules", "name", "Methane")] == [document_id]
+    with pytest.raises(NoSuchDocumentException):
+        collection_service.get_document_raw("molecules", "1")
+
+
+def test_binary_collection(temp_directory):
+    # Test that a binary collection supports the same operations as a JSON one, and is read again after a restart
+    service = CollectionService(temp_directory)
+    service.compaction_ratio = 1
+    service.create_collection("molecules", "binary")
+    assert service.get_collection("molecules") == {"name": "molecules", "size": 0, "format": "binary"}
+    service.create_index("molecules", "name")
+    document_ids = service.add_documents("molecules", [{"data": {"name": "Methane"}}, {"data": {"name": "Ethanol"}},
+                                                       {"data": {"name": "Water"}}])
+    service.update_document("molecules", document_ids[0], {"data": {"name": "Ethane"}})
+    service.delete_document("molecules", document_ids[1])
+    service.compact("molecules")
+    service.add_document("molecules", {"data": {"name": "Ethane"}})
+    assert os.path.exists(temp_directory / "collections" / "molecules.bin")
+    # integers that msgpack doesn't support are stored with the JSON codec
+    service.create_collection("big", "binary")
+    big_id = service.add_document("big", {"data": {"big": 2 ** 70}})
+
+    reloaded = CollectionService(temp_directory)
+    assert reloaded.get_document("big", big_id)["data"] == {"big": 2 ** 70}
+    assert reloaded.get_document("molecules", document_ids[0])["data"] == {"name": "Ethane"}
+    assert [document["data"]["name"] for document in reloaded.get_documents("molecules")] == \
+        ["Water", "Ethane", "Ethane"]
+    assert len(reloaded.find_documents_by_field("molecules", "name", "Ethane")) == 2
+    assert json.loads(reloaded.get_document_raw("molecules", document_ids[2])) == \
+        {"data": {"name": "Water"}, "_document_id": document_ids[2]}
+    assert reloaded.get_documents_page("molecules", limit=1)["next_cursor"] is not None
+
+
+def test_unencodable_document_is_not_logged(collection_service, mocker: MockerFixture):
+    # Test that a document that can't be encoded in the format of the collection leaves no write-ahead log entry
+    collection_service.create_collection("molecules", "binary")
+    lsn = collection_service.last_lsn
+    mocker.patch.object(BinaryFormat, "encode", side_effect=OverflowError)
+    with pytest.raises(OverflowError):
+        collection_service.add_document("molecules", {"data": {"name": "Methane"}})
+    assert collection_service.last_lsn == lsn
+
+
+def test_binary_collection_truncates_torn_record(temp_directory):
+    # Test that a record whose write was interrupted is dropped when the file is opened
+    service = CollectionService(temp_directory)
+    service.create_collection("molecules", "binary")
+    document_id = service.add_document("molecules", {"data": {"name": "Methane"}})
+    collection_file = temp_directory / "collections" / "molecules.bin"
+    size = collection_file.stat().st_size
+    with open(collection_file, "ab") as file:
+        file.write(b"\x40\x00\x00\x00\x00\x24\x00abc")
+
+    reloaded = CollectionService(temp_directory)
+    assert [document["_document_id"] for document in reloaded.get_documents("molecules")] == [document_id]
+    assert collection_file.stat().st_size == size
+
+
+def test_create_collection_invalid_format(collection_service):
+    with pytest.raises(ValidationException):
+        collection_service.create_collection("molecules", "xml")
+
+
+def test_update_collection_keeps_format(collection_service):
+    # Test that renaming keeps the format and that the format can't be changed by an update
+    collection_service.create_collection("molecules", "binary")
+    collection_service.update_collection("molecules", {"name": "chemicals"})
+    assert collection_service.get_collection("chemicals")["format"] == "binary"
+    with pytest.raises(ValidationException):
+        collection_service.update_collection("chemicals", {"name": "chemicals", "format": "json"})
+
+
+def test_convert_collection(temp_directory):
+    # Test that converting a collection back and forth keeps its documents and indexes
+    service = CollectionService(temp_directory)
+    service.create_collection("molecules")
+    service.create_index("molecules", "name")
+    document_ids = service.add_documents("molecules", [{"data": {"name": "Methane", "atoms": 5}},
+                                                       {"data": {"name": "Ethanol", "atoms": 9}}])
+    service.delete_document("molecules", document_ids[1])
+    documents = service.get_documents("molecules")
+    json_size = os.path.getsize(temp_directory / "collections" / "molecules.json")
+
+    service.convert_collection("molecules", "binary")
+    assert service.get_documents("molecules") == documents
+    assert service.get_collection("molecules")["format"] == "binary"
+    assert sorted(os.listdir(temp_directory / "collections")) == \
+        ["collections.json", "molecules.bin", "molecules.bin.generation", "molecules.indexes.json"]
+    assert os.path.getsize(temp_directory / "collections" / "molecules.bin") < json_size
+    assert CollectionService(temp_directory).find_documents_by_field("molecules", "name", "Methane") == documents
+
+    service.convert_collection("molecules", "json")
+    assert service.get_collection("molecules") == {"name": "molecules", "size": 1}
+    assert CollectionService(temp_directory).get_documents("molecules") == documents
+
+
+def test_lru_cache_evicts_least_recently_used():
+    # Test that the cache stays under its size by evicting the least recently used documents
+    cache = LRUCache(max_bytes=10)
+    cache.put("molecules", "1", b"aaaa")
+    cache.put("molecules", "2", b"bbbb")
+    assert cache.get("molecules", "1") == b"aaaa"
+    cache.put("molecules", "3", b"cccc")
+    assert cache.get("molecules", "2") is None
+    assert cache.get("molecules", "1") == b"aaaa"
+    cache.put("molecules", "4", b"d" * 11)
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "entries": 2, "bytes": 8, "max_bytes": 10}
+    cache.invalidate_collection("molecules")
+    assert cache.stats()["entries"] == 0
+
+
+def test_get_document_is_cached(collection_service, mocker: MockerFixture):
+    # Test that repeated reads of a document are served from the cache
+    collection_service.create_collection("molecules")
+    document_id = collection_service.add_document("molecules", {"data": {"name": "Methane"}})
+    find_raw = mocker.spy(DocumentLog, "find_raw")
+    for _ in range(3):
+        assert collection_service.get_document("molecules", document_id)["data"] == {"name": "Methane"}
+    assert find_raw.call_count == 1
+    stats = collection_service.get_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+
+
+def test_cache_is_invalidated_by_mutations(collection_service):
+    # Test that no mutation leaves a stale document in the cache
+    collection_service.create_collection("molecules")
+    document_id1, document_id2 = collection_service.add_documents("molecules", [{"data": {"name": "Methane"}},
+                                                                                {"data": {"name": "Ethanol"}}])
+    collection_service.get_document("molecules", document_id1)
+    collection_service.get_document("molecules", document_id2)
+    collection_service.update_document("molecules", document_id1, {"data": {"name": "Ethane"}})
+    assert collection_service.get_document("molecules", document_id1)["data"] == {"name": "Ethane"}
+    collection_service.delete_document("molecules", document_id2)
+    with pytest.raises(NoSuchDocumentException):
+        collection_service.get_document("molecules", document_id2)
+
+    collection_service.update_collection("molecules", {"name": "chemicals"})
+    with pytest.raises(NoSuchCollectionException):
+        collection_service.get_document("molecules", document_id1)
+    assert collection_service.get_cache_stats()["entries"] == 0
+    collection_service.get_document("chemicals", document_id1)
+    collection_service.delete_collection("chemicals")
+    assert collection_service.get_cache_stats()["entries"] == 0
+    collection_service.create_collection("chemicals")
+    with pytest.raises(NoSuchDocumentException):
+        collection_service.get_document("chemicals", document_id1)
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ({"name": "Methane"}, ["Methane"]),
+    ({"atoms": 9}, ["Ethanol"]),
+    ({"atoms": "9"}, []),
+    ({"atoms": 5.0}, ["Methane"]),
+    ({"atoms": {"$gt": 3, "$lt": 9}}, ["Methane"]),
+    ({"atoms": {"$gte": 3}}, ["Water", "Methane", "Ethanol"]),
+    ({"atoms": {"$gt": "3"}}, []),
+    ({"name": {"$in": ["Water", "Ethanol", 9]}}, ["Water", "Ethanol"]),
+    ({"name": {"$ne": "Water"}}, ["Methane", "Ethanol", "Unknown"]),
+    ({"properties.weight": {"$lt": 20}}, ["Water", "Methane"]),
+    ({"synonyms.0": "methyl hydride"}, ["Methane"]),
+    ({"$or": [{"name": "Water"}, {"atoms": {"$gt": 8}}]}, ["Water", "Ethanol"]),
+    ({"$and": [{"atoms": {"$gt": 2}}, {"properties.weight": {"$gt": 17}}], "name": {"$ne": "Water"}}, ["Ethanol"]),
+    ({}, ["Water", "Methane", "Ethanol", "Unknown"]),
+])
+@pytest.mark.parametrize("indexed", [False, True])
+def test_find_documents_by_filter(collection_service, expression, expected, indexed):
+    # Test the operators of the filters, with and without indexes on the fields
+    collection_service.create_collection("molecules")
+    collection_service.add_documents("molecules", [
+        {"data": {"name": "Water", "atoms": 3, "properties": {"weight": 18.02}}},
+        {"data": {"name": "Methane", "atoms": 5, "properties": {"weight": 16.04}, "synonyms": ["methyl hydride"]}},
+        {"data": {"name": "Ethanol", "atoms": 9, "properties": {"weight": 46.07}}},
+        {"data": {"name": "Unknown", "atoms": True}},
+    ])
+    if indexed:
+        collection_service.create_index("molecules", "name")
+        collection_service.create_index("molecules", "atoms")
+    documents = collection_service.find_documents_by_filter("molecules", expression)
+    assert [document["data"]["name"] for document in documents] == expected
+
+
+def test_filter_uses_indexes(collection_service, mocker: MockerFixture):
+    # Test that only the candidates found with the index are parsed and checked
+    collection_service.create_collection("molecules")
+    collection_service.add_documents("molecules", [{"data": {"number": i, "even": i % 2 == 0}} for i in range(10)])
+    collection_service.create_index("molecules", "number")
+    matches = mocker.spy(Filter, "matches")
+    documents = collection_service.find_documents_by_filter(
+        "molecules", {"$or": [{"number": 2}, {"number": {"$in": [4, 5]}}], "even": True})
+    assert [document["data"]["number"] for document in documents] == [2, 4]
+    assert matches.call_count == 3
+
+
+@pytest.mark.parametrize("expression", [[], {"$nor": []}, {"$or": []}, {"atoms": {"$gt": [1]}},
+                                        {"atoms": {"$in": 1}}, {"atoms": {"$regex": "a"}}])
+def test_find_documents_by_invalid_filter(collection_service, expression):
+    collection_service.create_collection("molecules")
+    with pytest.raises(ValidationException):
+        collection_service.find_documents_by_filter("molecules", expression)
+
+
+def test_find_documents_by_filter_page(collection_service):
+    # Test for paginating a filtered listing
+    collection_service.create_collection("molecules")
+    collection_service.add_documents("molecules", [{"data": {"number": i}} for i in range(10)])
+    page = collection_service.find_documents_by_filter_page("molecules", {"number": {"$gte": 5}}, limit=3)
+    assert [document["data"]["number"] for document in page["documents"]] == [5, 6, 7]
+    page = collection_service.find_documents_by_filter_page("molecules", {"number": {"$gte": 5}}, limit=3,
+                                                            cursor=page["next_cursor"])
+    assert [document["data"]["number"] for document in page["documents"]] == [8, 9]
+    assert page["next_cursor"] is None
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_field_projection(collection_service, indexed):
+    # Test that fields restricts the data of the documents returned by the reads and searches
+    collection_service.create_collection("molecules")
+    water_id, methane_id = collection_service.add_documents("molecules", [
+        {"data": {"name": "Water", "atoms": 3, "formula": "H2O"}},
+        {"data": {"name": "Methane", "atoms": 5}},
+    ])
+    if indexed:
+        collection_service.create_index("molecules", "name")
+    fields = ["name", "formula"]
+    water = {"data": {"name": "Water", "formula": "H2O"}, "_document_id": water_id}
+    methane = {"data": {"name": "Methane"}, "_document_id": methane_id}
+    assert collection_service.get_document("molecules", water_id, fields) == water
+    assert json.loads(collection_service.get_document_raw("molecules", water_id, fields)) == water
+    assert collection_service.get_documents("molecules", fields) == [water, methane]
+    assert [json.loads(raw) for raw in collection_service.iter_documents_raw("molecules", fields)] == [water, methane]
+    assert collection_service.find_documents_by_field("molecules", "name", "Methane", fields) == [methane]
+    assert [json.loads(raw) for raw in
+            collection_service.iter_documents_by_field_raw("molecules", "name", "Methane", fields)] == [methane]
+    assert collection_service.find_documents_by_filter("molecules", {"atoms": {"$gt": 4}}, fields) == [methane]
+    assert [json.loads(raw) for raw in
+            collection_service.iter_documents_by_filter_raw("molecules", {"atoms": 3}, fields)] == [water]
+    assert collection_service.get_documents_page("molecules", limit=1, fields=fields)["documents"] == [water]
+    # the cache keeps the whole document
+    assert collection_service.get_document("molecules", water_id)["data"]["atoms"] == 3
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_aggregate(collection_service, indexed):
+    # Test grouping and aggregate functions, counts grouped by an indexed field come from the index
+    collection_service.create_collection("molecules")
+    collection_service.add_documents("molecules", [
+        {"data": {"kind": "liquid", "atoms": 3, "name": "Water"}},
+        {"data": {"kind": "gas", "atoms": 5, "name": "Methane"}},
+        {"data": {"kind": "liquid", "atoms": 9.0, "name": "Ethanol"}},
+        {"data": {"kind": "gas", "atoms": "many", "name": "Propane"}},
+        {"data": {"atoms": 2}},
+    ])
+    if indexed:
+        collection_service.create_index("molecules", "kind")
+    counts = collection_service.aggregate("molecules", ["kind"])["groups"]
+    assert sorted((group["key"]["kind"] or "", group["count"]) for group in counts) == [
+        ("", 1), ("gas", 2), ("liquid", 2)]
+
+    result = collection_service.aggregate("molecules", ["kind"], ["count", "sum:atoms", "avg:atoms", "min:atoms",
+                                                                  "max:atoms", "max:name"],
+                                          {"kind": {"$ne": "solid"}})
+    assert result["groups"] == [
+        {"key": {"kind": "liquid"}, "count": 2, "sum:atoms": 12.0, "avg:atoms": 6.0, "min:atoms": 3, "max:atoms": 9.0,
+         "max:name": "Water"},
+        {"key": {"kind": "gas"}, "count": 2, "sum:atoms": 5, "avg:atoms": 5.0, "min:atoms": 5, "max:atoms": "many",
+         "max:name": "Propane"},
+        {"key": {"kind": None}, "count": 1, "sum:atoms": 2, "avg:atoms": 2.0, "min:atoms": 2, "max:atoms": 2,
+         "max:name": None},
+    ]
+    assert collection_service.aggregate("molecules", aggregates=["count"], expression={"atoms": {"$gt": 4}}) == {
+        "groups": [{"key": {}, "count": 2}]}
+
+    # values with the same string representation are in different groups, with or without an index
+    collection_service.create_collection("mixed")
+    collection_service.add_documents("mixed", [{"data": {"a": value}} for value in [1, "1", 1.0, True, "True", "x"]])
+    if indexed:
+        collection_service.create_index("mixed", "a")
+    hits = dict(metrics.INDEX_QUERIES._values).get(("hit",), 0)
+    counts = collection_service.aggregate("mixed", ["a"])["groups"]
+    assert sorted((json.dumps(group["key"]["a"]), group["count"]) for group in counts) == [
+        ('"1"', 1), ('"True"', 1), ('"x"', 1), ("1", 2), ("true", 1)]
+    # the index doesn't tell the values apart, the documents are read instead
+    assert dict(metrics.INDEX_QUERIES._values).get(("hit",), 0) == hits
+
+
+@pytest.mark.parametrize("aggregates", [["median:atoms"], ["sum"], ["count:atoms"]])
+def test_aggregate_invalid(collection_service, aggregates):
+    collection_service.create_collection("molecules")
+    with pytest.raises(ValidationException):
+        collection_service.aggregate("molecules", aggregates=aggregates)
+
+
+def replica_state(service: CollectionService) -> list:
+    return [(collection, service.get_indexes(collection["name"]), service.get_documents(collection["name"]))
+            for collection in service.get_collections()]
+
+
+def test_follower_applies_leader_log(tmp_path):
+    # Test that a follower ends up with the collections, documents and indexes of its leader
+    leader = CollectionService(base_path=tmp_path / "leader")
+    follower = CollectionService(base_path=tmp_path / "follower")
+    leader.create_collection("molecules")
+    document_id = leader.add_document("molecules", {"data": {"name": "Water"}})
+    leader.add_documents("molecules", [{"data": {"name": "Methane"}}, {"data": {"name": "Ethanol"}}])
+    leader.create_index("molecules", "name")
+    follower.apply_log_entries(leader.get_log_entries(0, limit=3))
+    assert follower.last_lsn == 3
+    follower.get_document("molecules", document_id)
+
+    leader.update_document("molecules", document_id, {"data": {"name": "Ice"}})
+    leader.update_collection("molecules", {"name": "chemicals"})
+    leader.convert_collection("chemicals", "binary")
+    leader.create_collection("gases")
+    leader.delete_collection("gases")
+    entries = leader.get_log_entries(follower.last_lsn)
+    follower.apply_log_entries(entries)
+    # entries that were already applied are skipped
+    follower.apply_log_entries(entries)
+    assert follower.last_lsn == leader.last_lsn
+    assert replica_state(follower) == replica_state(leader)
+    assert follower.get_document("chemicals", document_id)["data"] == {"name": "Ice"}
+
+    follower.close()
+    assert CollectionService(base_path=tmp_path / "follower").last_lsn == leader.last_lsn
+
+
+def test_leader_only_serves_durable_entries(tmp_path, mocker: MockerFixture):
+    # Test that the entries served to followers are fsynced first, a crash could otherwise reuse their lsns
+    leader = CollectionService(base_path=tmp_path / "leader", wal_fsync="never")
+    leader.create_collection("molecules")
+    lsn = leader.last_lsn
+    leader.add_document("molecules", {"data": {"name": "Water"}})
+    sync = mocker.patch.object(leader._wal, "_sync")
+    assert leader.get_log_entries(lsn) == []
+    mocker.stopall()
+    assert [entry["lsn"] for entry in leader.get_log_entries(lsn)] == [lsn + 1]
+    assert leader._wal.durable_lsn == lsn + 1
+    sync.assert_called_once_with(lsn + 1)
+
+
+def test_follower_catches_up_from_snapshot(tmp_path, mocker: MockerFixture):
+    # Test that a follower behind the checkpoint of the leader restores a snapshot, then follows the log again
+    leader = CollectionService(base_path=tmp_path / "leader")
+    follower = CollectionService(base_path=tmp_path / "follower")
+    follower.create_collection("stale")
+    leader.create_collection("molecules")
+    leader.add_documents("molecules", [{"data": {"name": "Water"}}, {"data": {"name": "Methane"}}])
+    leader.create_index("molecules", "name")
+    leader.checkpoint()
+    with pytest.raises(SnapshotRequiredException):
+        leader.get_log_entries(0)
+
+    # a checkpoint that runs while the entries are looked up doesn't make the follower skip entries
+    lsn = leader.last_lsn
+    leader.add_document("molecules", {"data": {"name": "Benzene"}})
+
+    def checkpoint(*args):
+        leader.checkpoint()
+        leader.add_document("molecules", {"data": {"name": "Propane"}})
+
+    mocker.patch.object(leader._wal, "wait_for", side_effect=checkpoint)
+    with pytest.raises(SnapshotRequiredException):
+        leader.get_log_entries(lsn)
+    mocker.stopall()
+
+    snapshot = io.BytesIO()
+    lsn = leader.write_snapshot(snapshot)
+    snapshot.seek(0)
+    assert follower.restore_snapshot(snapshot) == lsn == leader.last_lsn
+    assert replica_state(follower) == replica_state(leader)
+
+    leader.add_document("molecules", {"data": {"name": "Ethanol"}})
+    follower.apply_log_entries(leader.get_log_entries(follower.last_lsn))
+    assert replica_state(follower) == replica_state(leader)
+    assert follower.find_documents_by_field("molecules", "name", "Ethanol")
+
+
+def test_sharded_collection(temp_directory):
+    # Test that a sharded collection spreads its documents over its shard files, and reads, searches and changes
+    # them like any collection, with the scans running in the scan processes
+    service = CollectionService(base_path=temp_directory, scan_processes=2)
+    service.create_collection("molecules", shards=4)
+    document_ids = service.add_documents("molecules", [{"data": {"number": i, "even": i % 2 == 0}}
+                                                       for i in range(40)])
+    shard_files = sorted(path.name for path in (temp_directory / "collections").glob("molecules.shard*.json"))
+    assert shard_files == [f"molecules.shard{shard}.json" for shard in range(4)]
+    assert all((temp_directory / "collections" / name).stat().st_size for name in shard_files)
+    assert service.get_collection("molecules") == {"name": "molecules", "size": 40, "shards": 4}
+
+    service.update_document("molecules", document_ids[0], {"data": {"number": 100, "even": True}})
+    service.delete_document("molecules", document_ids[1])
+    assert service.get_document("molecules", document_ids[0])["data"]["number"] == 100
+    assert len(service.get_documents("molecules")) == 39
+    assert len(service.find_documents_by_field("molecules", "even", "True")) == 20
+    numbers = [document["data"]["number"] for document in
+               service.find_documents_by_filter("molecules", {"number": {"$gte": 30}})]
+    assert sorted(numbers) == list(range(30, 40)) + [100]
+
+    service.create_index("molecules", "even")
+    assert len(service.find_documents_by_field("molecules", "even", "False")) == 19
+    counts = service.aggregate("molecules", ["even"])["groups"]
+    assert sorted((group["key"]["even"], group["count"]) for group in counts) == [(False, 19), (True, 20)]
+
+    # pages are read shard after shard, and resume across shards
+    pages, cursor = [], None
+    while True:
+        page = service.find_documents_by_filter_page("molecules", {"even": False}, limit=7, cursor=cursor)
+        pages.append(page["documents"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert sorted(document["data"]["number"] for page in pages for document in page) == list(range(3, 40, 2))
+
+    service.update_collection("molecules", {"name": "chemicals"})
+    service.convert_collection("chemicals", "binary")
+    service.compact("chemicals")
+    assert sorted(path.name for path in (temp_directory / "collections").glob("chemicals.*")) == sorted(
+        [f"chemicals.shard{shard}.bin" for shard in range(4)] +
+        [f"chemicals.shard{shard}.indexes.json" for shard in range(4)] +
+        [f"chemicals.shard{shard}.bin.generation" for shard in range(4)])
+    service.close()
+
+    service = CollectionService(base_path=temp_directory, scan_processes=2)
+    assert service.get_indexes("chemicals") == ["even"]
+    assert len(service.find_documents_by_field("chemicals", "number", "100")) == 1
+    with pytest.raises(ValidationException):
+        service.update_collection("chemicals", {"name": "chemicals", "shards": 2})
+    with pytest.raises(ValidationException):
+        service.create_collection("molecules", shards=0)
+    service.delete_collection("chemicals")
+    assert os.listdir(temp_directory / "collections") == ["collections.json"]
+    service.close()
+
+
+@pytest.mark.parametrize("collection_format", ["json", "binary"])
+def test_parallel_scan(temp_directory, collection_format):
+    service = CollectionService(base_path=temp_directory, scan_processes=2, parallel_scan_bytes=1)
+    service.create_collection("chemicals", collection_format)
+    ids = service.add_documents("chemicals", [{"data": {"number": i, "even": i % 2 == 0}} for i in range(50)])
+    for i in range(0, 50, 5):
+        service.delete_document("chemicals", ids[i])
+    results = []
+    for parallel_scan_bytes in (1, 0):
+        service.parallel_scan_bytes = parallel_scan_bytes
+        assert [document["_document_id"] for document in service.find_documents_by_field("chemicals", "even", "True")
+                ] == [ids[i] for i in range(50) if i % 2 == 0 and i % 5]
+        assert service.find_documents_by_filter("chemicals", {"number": {"$gte": 45}}) == [
+            {"data": {"number": i, "even": i % 2 == 0}, "_document_id": ids[i]} for i in (46, 47, 48, 49)]
+        page = service.find_documents_by_filter_page("chemicals", {"number": {"$lt": 20}}, 4)
+        page = service.find_documents_by_filter_page("chemicals", {"number": {"$lt": 20}}, 20, page["next_cursor"])
+        assert [document["_document_id"] for document in page["documents"]] == [ids[i] for i in range(6, 20) if i % 5]
+        results.append(list(service.iter_documents_by_field_raw("chemicals", "number", "7")))
+    assert results[0] == results[1] and len(results[0]) == 1
+    assert service._scan_executor is not None
+    service.close()
+
+
+def test_parallel_scan_stops_early(temp_directory):
+    service = CollectionService(base_path=temp_directory, scan_processes=2, parallel_scan_bytes=1)
+    service.create_collection("chemicals")
+    ids = service.add_documents("chemicals", [{"data": {"number": i}} for i in range(1000)])
+    scanned = dict(metrics.DOCUMENTS_SCANNED._values).get((), 0)
+    page = service.find_documents_by_filter_page("chemicals", {"number": {"$lt": 500}}, 1)
+    assert [document["_document_id"] for document in page["documents"]] == [ids[0]]
+    # pages with a limit read the file lazily, up to the document after the page
+    assert dict(metrics.DOCUMENTS_SCANNED._values)[()] - scanned == 2
+
+    documents = service.iter_documents_by_filter("chemicals", {"number": {"$gte": 0}})
+    assert next(documents)["_document_id"] == ids[0]
+    documents.close()
+    # the compaction replaces the file once the scan processes are done with it
+    service.delete_document("chemicals", ids[0])
+    service.compact("chemicals")
+    assert service._logs["chemicals"]._scans == 0
+    assert len(service.find_documents_by_filter("chemicals", {"number": {"$gte": 0}})) == 999
+    service.close()
+
+
+def test_iter_results_cancels_the_remaining_futures():
+    futures = [concurrent.futures.Future() for _ in range(3)]
+    futures[0].set_result([1, 2])
+    results = iter_results(futures)
+    assert next(results) == 1
+    results.close()
+    assert not futures[0].cancelled() and futures[1].cancelled() and futures[2].cancelled()
+
+
+def test_metrics(collection_service):
+    def value(metric, *labels):
+        return dict(metric._values).get(labels, 0)
+
+    collection_service.create_collection("chemicals")
+    ids = collection_service.add_documents("chemicals", [{"data": {"number": i}} for i in range(10)])
+    scanned, returned = value(metrics.DOCUMENTS_SCANNED), value(metrics.DOCUMENTS_RETURNED)
+    misses, hits = value(metrics.INDEX_QUERIES, "miss"), value(metrics.INDEX_QUERIES, "hit")
+    # the counts of the buckets, which add up to the number of calls, and their sum
+    calls = sum((value(metrics.SERVICE_SECONDS, "find_documents_by_field") or [0])[:-1])
+
+    assert len(collection_service.find_documents_by_field("chemicals", "number", "3")) == 1
+    collection_service.create_index("chemicals", "number")
+    assert len(collection_service.find_documents_by_field("chemicals", "number", "3")) == 1
+    assert value(metrics.DOCUMENTS_SCANNED) - scanned == 10 and value(metrics.DOCUMENTS_RETURNED) - returned == 1
+    assert value(metrics.INDEX_QUERIES, "miss") - misses == 1 and value(metrics.INDEX_QUERIES, "hit") - hits == 1
+    assert sum(value(metrics.SERVICE_SECONDS, "find_documents_by_field")[:-1]) - calls == 2
+
+    collection_service.get_document("chemicals", ids[0])
+    collection_service.delete_document("chemicals", ids[1])
+    collection_service.collect_metrics()
+    assert value(metrics.COLLECTION_DOCUMENTS, "chemicals") == 9
+    assert value(metrics.COLLECTION_FILE_BYTES, "chemicals") == os.path.getsize(
+        collection_service._collection_file_path("chemicals"))
+    assert value(metrics.CACHE_REQUESTS, "miss") >= 1
+
+    rendered = metrics.render()
+    assert '# TYPE http_database_service_duration_seconds histogram' in rendered
+    assert 'http_database_service_duration_seconds_bucket{method="find_documents_by_field",le="+Inf"}' in rendered
+    assert 'http_database_collection_documents{collection="chemicals"} 9' in rendered
+
+
+def test_request_trace(collection_service, temp_directory):
+    collection_service.create_collection("chemicals")
+    collection_service.add_documents("chemicals", [{"data": {"number": i}} for i in range(10)])
+    trace = metrics.RequestTrace()
+    token = metrics.TRACE.set(trace)
+    try:
+        assert len(collection_service.find_documents_by_field("chemicals", "number", "3")) == 1
+    finally:
+        metrics.TRACE.reset(token)
+    assert trace.counts["scanned"] == 10 and trace.counts["returned"] == 1 and trace.counts["index_miss"] == 1
+    assert set(trace.durations) == {"find_documents_by_field", "iter_documents_by_field"}
+
+    # a request that is not traced doesn't change the trace
+    collection_service.find_documents_by_field("chemicals", "number", "3")
+    assert trace.counts["scanned"] == 10
+
+    profiler = diagnostics.SamplingProfiler(interval=0.001)
+    profiler.start()
+    deadline = time.monotonic() + 0.2
+    while time.monotonic() < deadline:
+        collection_service.find_documents_by_field("chemicals", "number", "3")
+    profiler.stop()
+    profiler.write(temp_directory / "profile.folded")
+    lines = (temp_directory / "profile.folded").read_text().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("find_documents_by_field (service.py" in line for line in lines)
+
+
+def test_trace_request_stops_the_profiler(temp_directory, mocker: MockerFixture):
+    from starlette.requests import Request
+    from starlette.responses import StreamingResponse
+
+    async def call_next(request):
+        async def body():
+            yield b"[]"
+        return StreamingResponse(body())
+
+    async def serve(read_body: bool):
+        request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(b"x-profile", b"1")]})
+        response = await diagnostics.trace_request(request, call_next, 0, str(temp_directory))
+        if read_body:
+            assert [chunk async for chunk in response.body_iterator] == [b"[]"]
+        return response.headers[diagnostics.PROFILE_HEADER]
+
+    threads = []
+    stop = diagnostics.SamplingProfiler.stop
+    mocker.patch.object(diagnostics.SamplingProfiler, "stop",
+                        lambda profiler: threads.append(threading.get_ident()) or stop(profiler))
+    path = asyncio.run(serve(read_body=True))
+    # the profile is written out of the event loop
+    assert os.path.exists(path) and len(threads) == 1 and threading.get_ident() not in threads
+
+    # the response of a client that disconnected before it started is never read
+    path = asyncio.run(serve(read_body=False))
+    deadline = time.monotonic() + 5
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert os.path.exists(path) and len(threads) == 2
+
+
+def test_snapshot_restores_indexes(tmp_path, mocker: MockerFixture):
+    # Test that a saved snapshot restores the collections with their indexes, which are not rebuilt from the records
+    source = CollectionService(base_path=tmp_path / "source")
+    source.create_collection("molecules")
+    source.create_collection("chemicals", "binary", shards=2)
+    source.create_collection("opened")
+    source.create_index("opened", "name")
+    ids = source.add_documents("molecules", [{"data": {"name": f"molecule {i}", "atoms": i % 3}} for i in range(20)])
+    source.create_index("molecules", "atoms")
+    source.delete_document("molecules", ids[0])
+    source.update_document("molecules", ids[1], {"data": {"name": "Water", "atoms": 3}})
+    source.add_documents("chemicals", [{"data": {"number": i}} for i in range(10)])
+    # the restart has no write-ahead log to replay, so molecules and chemicals are not opened before the snapshot and
+    # their checkpoints are the ones written when the service closed, opened is
+    source.close()
+    source = CollectionService(base_path=tmp_path / "source")
+    source.add_document("opened", {"data": {"name": "Methane"}})
+    snapshot = source.save_snapshot(tmp_path / "snapshots")
+    source.get_documents("molecules")
+    assert os.listdir(tmp_path / "snapshots") == [os.path.basename(snapshot["path"])]
+    assert snapshot["lsn"] == source.last_lsn and snapshot["bytes"] == os.path.getsize(snapshot["path"])
+
+    expected = replica_state(source)
+    target = CollectionService(base_path=tmp_path / "target")
+    with open(snapshot["path"], "rb") as file:
+        assert target.restore_snapshot(file) == snapshot["lsn"]
+    load_checkpoint = mocker.spy(DocumentLog, "_load_checkpoint")
+    assert replica_state(target) == expected
+    # every collection has a checkpoint that covers its whole file
+    paths = [target._collection_file_path("molecules"), *shard_paths(target._collection_file_path("chemicals"), 2),
+             target._collection_file_path("opened")]
+    assert load_checkpoint.spy_return_list == [os.path.getsize(path) for path in paths]
+    assert [document["data"] for document in target.find_documents_by_field("opened", "name", "Methane")] == [
+        {"name": "Methane"}]
+    assert target.find_documents_by_field("molecules", "atoms", "3") == [
+        {"data": {"name": "Water", "atoms": 3}, "_document_id": ids[1]}]
+
+    # the checkpoint stays valid as the file grows, and is dropped when the file is compacted
+    target.add_document("opened", {"data": {"name": "Ethanol"}})
+    target.close()
+    target = CollectionService(base_path=tmp_path / "target")
+    assert [document["data"]["name"] for document in target.get_documents("opened")] == ["Methane", "Ethanol"]
+    assert load_checkpoint.spy_return_list[-1] > 0
+    target.delete_document("opened", target.find_documents_by_field("opened", "name", "Methane")[0][
+        "_document_id"])
+    target.compact("opened")
+    assert not os.path.exists(index_checkpoint_path(target._collection_file_path("opened")))
+    target.close()
+
+
+def test_restart_loads_index_checkpoints(temp_directory, mocker: MockerFixture):
+    # Test that a restarted service opens its collections on first access, from the index checkpoints written when
+    # it closed, and rebuilds the indexes whose checkpoint is stale
+    service = CollectionService(temp_directory)
+    service.create_collection("molecules")
+    service.create_collection("chemicals")
+    service.add_documents("molecules", [{"data": {"name": f"molecule {i}", "atoms": i % 3}} for i in range(20)])
+    service.create_index("molecules", "atoms")
+    service.close()
+    path = service._collection_file_path("molecules")
+    assert os.path.exists(index_checkpoint_path(path))
+    assert not os.path.exists(index_checkpoint_path(service._collection_file_path("chemicals")))
+
+    load_checkpoint = mocker.spy(DocumentLog, "_load_checkpoint")
+    service = CollectionService(temp_directory)
+    assert len(service.get_collections()) == 2 and not service._logs
+    assert len(service.find_documents_by_field("molecules", "atoms", "1")) == 7
+    assert load_checkpoint.spy_return_list == [os.path.getsize(path)]
+    # a new index makes the checkpoint stale until the next one
+    service.create_index("molecules", "name")
+    service.checkpoint()
+    service.close()
+    service = CollectionService(temp_directory)
+    assert service.find_documents_by_field("molecules", "name", "molecule 4")[0]["data"]["atoms"] == 1
+    assert load_checkpoint.spy_return_list[-1] == os.path.getsize(path)
+    service.close()
+
+    # a checkpoint that doesn't match the end of its file is ignored
+    with open(path, "r+b") as file:
+        content = file.read().replace(b"molecule 19", b"molecule 91")
+        file.seek(0)
+        file.write(content)
+    service = CollectionService(temp_directory)
+    assert service.find_documents_by_field("molecules", "name", "molecule 91")[0]["data"]["atoms"] == 1
+    assert load_checkpoint.spy_return_list[-1] == 0
+    service.close()
+
+
+def test_locked_all_takes_locks_in_a_stable_order(collection_service, mocker: MockerFixture):
+    # Test that every caller of _locked_all takes the locks in the same order, even after a rename reorders the
+    # collections, so that concurrent callers can't deadlock
+    for name in ["molecules", "chemicals", "gases"]:
+        collection_service.create_collection(name)
+    write = mocker.spy(ReadWriteLock, "write")
+
+    def order():
+        write.reset_mock()
+        with collection_service._locked_all():
+            return [call.args[0] for call in write.call_args_list]
+
+    before = order()
+    collection_service.update_collection("molecules", {"name": "liquids"})
+    assert order() == before
@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+
+from . import metrics
+from .codec import JsonCodec
+
+FSYNC_POLICIES = {"always", "interval", "never"}
+
+
+class WriteAheadLog:
+    """Log of the mutations of the service, written before the mutations are applied to the collection files.
+
+    Every entry gets a log sequence number (lsn) and is written as a JSON line to the current segment file of the
+    directory. Segments are named after the lsn of their first entry. A checkpoint records the last lsn whose
+    mutation is durable in the collection files and deletes the segments before it, only the entries after the
+    checkpoint are replayed on startup.
+
+    fsync decides when the entries are made durable:
+        "always": commit waits until the entry is fsynced. Concurrent commits are grouped, one thread fsyncs for all
+                  the entries written so far while the others wait for it (group commit).
+        "interval": a background thread fsyncs every fsync_interval_ms, commit doesn't wait. A crash loses at most
+                    the last interval.
+        "never": entries are only written to the OS, which flushes them when it wants to.
+
+    Entries are encoded with codec (see codec.get_codec), the stdlib json module by default.
+
+    The log is also what a leader sends to its followers (see replication): entries can be read after any lsn that
+    wasn't checkpointed away, and a follower appends them with the lsn they have on the leader.
+    """
+
+    def __init__(self, directory: str, fsync: str = "always", fsync_interval_ms: int = 100, codec=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy '{fsync}'")
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval_ms = fsync_interval_ms
+        self.codec = codec if codec is not None else JsonCodec()
+        self.checkpoint_path = os.path.join(self.directory, "checkpoint")
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # serializes the writes to the current segment
+        self._write_lock = threading.Lock()
+        # notified on every append, for the readers that wait for new entries
+        self._appended = threading.Condition(self._write_lock)
+        self._file = None
+        # bytes written since the last checkpoint
+        self.size = 0
+        self.checkpoint_lsn = self._read_checkpoint()
+        self.last_lsn = self.checkpoint_lsn
+        # last lsn written to the current segment and last lsn known to be fsynced
+        self._written_lsn = self.checkpoint_lsn
+        self._durable_lsn = self.checkpoint_lsn
+        # group commit state, the thread that fsyncs sets _syncing and the others wait on the condition
+        self._synced = threading.Condition()
+        self._syncing = False
+
+        self._closed = threading.Event()
+        if self.fsync == "interval":
+            threading.Thread(target=self._sync_periodically, daemon=True).start()
+
+    def _read_checkpoint(self) -> int:
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path, "r") as file:
+            return int(file.read())
+
+    def _segments(self) -> list:
+        """returns the paths of the segment files, in order"""
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.endswith(".log")]
+
+    @staticmethod
+    def _first_lsn(path: str) -> int:
+        return int(os.path.basename(path)[:-len(".log")])
+
+    def entries(self, after: int = None):
+        """Yields the entries with an lsn greater than after (the checkpoint by default), in order.
+
+        A partially written last line, left by a crash in the middle of a write, is ignored. Raises
+        FileNotFoundError if a checkpoint deletes a segment that is being read.
+        """
+        after = self.checkpoint_lsn if after is None else after
+        segments = self._segments()
+        for i, path in enumerate(segments):
+            if i + 1 < len(segments) and self._first_lsn(segments[i + 1]) <= after + 1:
+                # the next segment starts at or before the first entry wanted
+                continue
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    entry = self.codec.loads(line)
+                    if entry["lsn"] > after:
+                        yield entry
+
+    def recover(self) -> list:
+        """Returns the entries after the checkpoint, and continues the lsn sequence after them."""
+        entries = list(self.entries())
+        if entries:
+            self.last_lsn = self._written_lsn = self._durable_lsn = entries[-1]["lsn"]
+        return entries
+
+    def append(self, entry: dict, lsn: int = None) -> int:
+        """Writes the entry and returns its lsn. The entry is not durable before commit returns.
+
+        lsn is only given by followers, for the entries of their leader, it must be greater than the last lsn.
+        """
+        with self._write_lock:
+            if lsn is not None and lsn <= self.last_lsn:
+                raise ValueError(f"lsn {lsn} is not after the last lsn {self.last_lsn}")
+            self.last_lsn = self.last_lsn + 1 if lsn is None else lsn
+            data = self.codec.dumps({"lsn": self.last_lsn, **entry}) + b"\n"
+            if self._file is None:
+                self._file = open(os.path.join(self.directory, f"{self.last_lsn:020d}.log"), "ab")
+            self._file.write(data)
+            self._file.flush()
+            metrics.BYTES_WRITTEN.inc(len(data), "wal")
+            self._written_lsn = self.last_lsn
+            self.size += len(data)
+            self._appended.notify_all()
+            return self.last_lsn
+
+    def wait_for(self, lsn: int, timeout: float) -> bool:
+        """Waits up to timeout seconds until the entry lsn is written, returns whether it is."""
+        with self._appended:
+            return self._appended.wait_for(lambda: self.last_lsn >= lsn, timeout)
+
+    @property
+    def durable_lsn(self) -> int:
+        """last lsn known to be fsynced, a crash can't lose or change the entries up to it"""
+        return self._durable_lsn
+
+    def wait_for_durable(self, lsn: int, timeout: float) -> bool:
+        """Waits up to timeout seconds until the entry lsn is written, then makes it durable if it isn't yet, whatever
+        the fsync policy. Returns whether it is."""
+        if not self.wait_for(lsn, timeout):
+            return False
+        self._sync(lsn)
+        return True
+
+    def commit(self, lsn: int):
+        """Waits until the entry is durable, if the fsync policy is "always"."""
+        if self.fsync == "always":
+            self._sync(lsn)
+
+    def _sync(self, lsn: int):
+        with self._synced:
+            while self._durable_lsn < lsn:
+                if self._syncing:
+                    # another thread is fsyncing, its fsync may cover this entry too
+                    self._synced.wait()
+                    continue
+                self._syncing = True
+                with self._write_lock:
+                    target, file = self._written_lsn, self._file
+                self._synced.release()
+                try:
+                    if file is not None:
+                        os.fsync(file.fileno())
+                finally:
+                    self._synced.acquire()
+                    self._syncing = False
+                    self._synced.notify_all()
+                self._durable_lsn = max(self._durable_lsn, target)
+
+    def _sync_periodically(self):
+        while not self._closed.wait(self.fsync_interval_ms / 1000):
+            try:
+                self._sync(self._written_lsn)
+            except Exception:
+                logging.exception("Periodic fsync of the write-ahead log failed")
+
+    def rotate(self) -> int:
+        """Closes the current segment, the next entry starts a new one. Returns the last lsn of the closed segment."""
+        with self._synced:
+            while self._syncing:
+                self._synced.wait()
+            with self._write_lock:
+                if self._file is not None:
+                    os.fsync(self._file.fileno())
+                    self._file.close()
+                    self._file = None
+                self._durable_lsn = self._written_lsn
+                return self._written_lsn
+
+    def checkpoint(self, lsn: int):
+        """Records that the mutations up to lsn are durable in the collection files, and deletes the segments that
+        only hold entries up to lsn. Must be called after rotate returned lsn."""
+        self._write_checkpoint(lsn)
+        with self._write_lock:
+            current = self._file.name if self._file is not None else None
+            for path in self._segments():
+                if path != current:
+                    os.remove(path)
+            self.size = os.path.getsize(current) if current is not None else 0
+
+    def _write_checkpoint(self, lsn: int):
+        checkpoint_path = self.checkpoint_path + ".tmp"
+        with open(checkpoint_path, "w") as file:
+            file.write(str(lsn))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(checkpoint_path, self.checkpoint_path)
+        self.checkpoint_lsn = lsn
+
+    def reset(self, lsn: int):
+        """Deletes every entry and continues the lsn sequence after lsn, for a follower that restored a snapshot of
+        its leader taken at lsn. No entry must be appended concurrently."""
+        self.rotate()
+        self._write_checkpoint(lsn)
+        with self._write_lock:
+            for path in self._segments():
+                os.remove(path)
+            self.size = 0
+            self.last_lsn = self._written_lsn = self._durable_lsn = lsn
+
+    def close(self):
+        self._closed.set()
+        with self._write_lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None